@@ -10,11 +10,125 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+from collections import OrderedDict
+
+import bgzf
 import file_utils as fu
+import lookup_cache as lc
+import transcripts as tm
 import utils as u
+import vcf_record as vr
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
+
+"""Counters of the .count.log
+   Stages record their counters once their input is exhausted. They are
+   written to fh as they are recorded; with fh=None they are only kept in
+   records, e.g. for the shards of a parallel run, whose counters are summed
+   with mergeCounts() and written once with write()
+"""
+class CountLog(object):
+
+    def __init__(self, fh=None):
+        self.fh = fh
+        self.records = []
+
+    def record(self, kind, label, **counts):
+        self.records.append((kind, label, counts))
+        if self.fh is not None:
+            self.write(kind, label, counts)
+
+    def write(self, kind, label, counts):
+        fh_log = self.fh
+        if (kind == 'dbSNP'):
+            # the total has always counted one more than the variants
+            total = counts['variants'] + 1
+            ratioInDbSnp = (counts['found'] / float(total)) * 100
+            fh_log.write("## Please notice that all Isoforms were counted\n")
+            fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+            fh_log.write(f"Total: {str(total)}\n")
+            fh_log.write(f"In dbSNP: {str(counts['found'])} ({str(ratioInDbSnp)}%)\n")
+
+        elif (kind == 'location'):
+            print("Variants located:")
+            fh_log.write("Variants located:\n")
+            for region, count in counts.items():
+                print(f"In {LOCATION_NAMES[region]} {str(count)}")
+                fh_log.write(f"In {LOCATION_NAMES[region]} {str(count)}\n")
+
+        elif (kind == 'cpg'):
+            fh_log.write(f"In {str(label)}: {str(counts['lookups'])} " + \
+                f"lookups, {str(counts['avoided'])} repeated lookups avoided\n")
+
+        else:
+            fh_log.write(f"In {str(label)}: {str(counts['found'])} in " + \
+                f"{str(counts['variants'])} variants\n")
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+
+
+# Positions whose CpG island a stage keeps (the least recently used are
+# dropped first)
+CPG_CACHE_SIZE = 100000
+
+# Column of REF in the dbSNP rows (RSID and GMAF are 3 and 7)
+DBSNP_REF = 2
+
+
+"""Region counters of getGenes/getExonsEtAl, in .count.log order
+"""
+LOCATION_NAMES = {'interGenic': 'interGenic', 'cds': 'CDS',
+    'utr3': "\'3 UTR", 'utr5': "\'5 UTR", 'intronic': 'Intronic',
+    'non_coding_intronic': 'Non_coding_intronic', 'exonic': 'Exonic',
+    'non_coding_exonic': 'Non_coding_exonic',
+    'promoter': 'Putative Promoter Region'}
+
+
+"""First cpgIslandExt row containing chr:pos, or None
+   The island depends on the position only, so the transcripts of a variant
+   (and later variants at the same position) share one lookup: cache, an
+   OrderedDict, holds the CPG_CACHE_SIZE answers of the job used last,
+   counts the lookups made and avoided
+"""
+def cpgIslandAt(cursor, cpg_index, chr, pos, cache, counts):
+    key = (chr, pos)
+    if key in cache:
+        counts['avoided'] = counts['avoided'] + 1
+        cache.move_to_end(key)
+        return cache[key]
+
+    if (cpg_index is not None):
+        row = cpg_index.first(chr, pos)
+    else:
+        sql = 'select chrom, chromStart, chromEnd, name from cpgIslandExt ' + \
+            'where chrom="' + str(chr) + '" AND (chromStart <= ' + str(pos) + \
+            ' AND ' + str(pos) + ' <= chromEnd);'
+        row = lc.fetchRow(cursor, ('cpgIslandExt', chr, pos), sql)
+    counts['lookups'] = counts['lookups'] + 1
+
+    cache[key] = row
+    while (len(cache) > CPG_CACHE_SIZE):
+        cache.popitem(last=False)
+    return row
+
+
+"""Sums the counters recorded by the same stage over several shards
+   records_list holds one CountLog.records list per shard
+"""
+def mergeCounts(records_list):
+    merged = []
+    for records in records_list:
+        for i, (kind, label, counts) in enumerate(records):
+            if (i == len(merged)):
+                merged.append((kind, label, dict(counts)))
+            else:
+                for name, count in counts.items():
+                    merged[i][2][name] = merged[i][2][name] + count
+    return merged
+
 def collapseGeneNames(row, indices, region, cnt):
     names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
         'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
@@ -52,6 +166,13 @@ def collapseRefSeq(line):
     return  ';'.join(collapsed)
 
 
+"""INFO fragment written for a row of the bigRefGene tables; the index and
+   snapshot engines render it once per row when they are built
+"""
+def refSeqFragment(row):
+    return collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]]))
+
+
 def binarySearchUniqueAndSorted(arg0, key):
     low = 0;
     high = len(arg0) - 1
@@ -109,87 +230,179 @@ def getComplementary(nuc):
 
 """"Format must be pileup or vcf
     Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    batch_size > 1 resolves that many variants with a single query
 """ 
 def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
+    varclass='SNV', sep='\t', batch_size=1):
     
     outfile = vcf + tmpextout
     fh_out = open(outfile, "w")
     logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+    fh_log = CountLog(open(logcountfile, 'w'))
 
-    inds = getFormatSpecificIndices(format=format)
+    fh = bgzf.openText(vcf)
+    conn = u.db_acquire()
+    cursor = lc.cachedCursor(conn.cursor())
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    for line in iterSnpsFromDbSnp(fh, cursor, fh_log, format=format,
+        varclass=varclass, sep=sep, batch_size=batch_size):
+        fh_out.write(str(line) + '\n')
+
+    fh_log.close()
+
+    u.db_release(conn)
+    fh.close()
+    fh_out.close()
+
+
+"""Per-record form of getSnpsFromDbSnp for the fused pipeline
+"""
+def iterSnpsFromDbSnp(lines, cursor, fh_log, format='vcf', varclass='SNV',
+    sep='\t', batch_size=1, index=None):
+
+    var_count = 0
+    inds = getFormatSpecificIndices(format=format)
     linenum = 1
+    pending = []
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
+    if (index is not None):
+        ref_ind = index.columns.index('REF')
+        info_ind = index.columns.index('INFO')
 
-            pos = fields[inds[1]].strip()
+    for record in vr.records(lines, sep=sep):
+        if isinstance(record, vr.VcfRecord):
+            fields = record.fields
+            chr = record.code
+            pos = record.pos
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
 
             compRef = getComplementary(ref)
             compAlt = getComplementary(alt)
 
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            if (index is not None):
+                rows = [row for row in index.stab(chr, pos)
+                    if str(row[ref_ind]) in (ref, compRef) and
+                    str(row[info_ind]) == varclass]
 
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
+                if addDbSnpInfo(record, rows, varclass):
+                    var_count = var_count + 1
+                yield record
+
+            elif (batch_size > 1):
+                pending.append((record, chr, pos, ref, compRef))
+                if (len(pending) >= batch_size):
+                    for l, found in resolveDbSnpBatch(cursor, pending,
+                        varclass):
+                        var_count = var_count + found
+                        yield l
+                    pending = []
+            else:
+                sql = 'select * from dbSNP where CHR="' + str(chr) + \
+                    '" AND POS=' + str(pos) + ' AND INFO = "' + varclass + \
+                    '" ;'
+                rows = dbSnpAlleles(lc.fetchRows(cursor,
+                    dbSnpKey(chr, pos, varclass), sql), ref, compRef)
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+                if addDbSnpInfo(record, rows, varclass):
+                    var_count = var_count + 1
+                yield record
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+            linenum = linenum + 1
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+        elif (len(pending) > 0):
+            pending.append((record, None, None, None, None))
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+        else:
+            yield record
+
+    for l, found in resolveDbSnpBatch(cursor, pending, varclass):
+        var_count = var_count + found
+        yield l
+
+    fh_log.record('dbSNP', 'dbSNP', variants=linenum - 1, found=var_count)
 
-            linenum = linenum + 1
 
+"""Sets rsids and GMAF of a record from its dbSNP rows
+   Returns True if the variant is in dbSNP
+"""
+def addDbSnpInfo(record, rows, varclass):
+    ## reset rsid to "." - in case there was annotation from old release of dbSNP
+    record.fields[2] = '.'
+    rsids = []
+    mafs = []
+    if (len(rows) > 0):
+        for row in rows:
+            rsids.append(str(row[3]))
+            if (str(row[7]) != '.'):
+                mafs.append('GMAF=' + str(row[7]))
+
+        maf_str=''
+        if (len(mafs) > 0):
+            maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+        if (record.infoText() == '.'):
+            record.setInfo('DB' + maf_str)
         else:
-            fh_out.write(line + '\n')
+            record.addInfo(';DB;VC=' + varclass + maf_str)
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+        record.fields[2] = str(';'.join(rsids))
+        return True
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return False
+
+
+"""Lookup key of the dbSNP rows of a position (see lookup_cache.fetchRows);
+   every allele of the position is looked up and the rows of the alleles
+   of the variant kept with dbSnpAlleles
+"""
+def dbSnpKey(chr, pos, varclass):
+    return ('dbSNP', str(chr).upper(), int(pos), varclass)
+
+
+"""dbSNP rows whose REF is ref or compRef, compared without case as MySQL
+   compares them
+"""
+def dbSnpAlleles(rows, ref, compRef):
+    alleles = (str(ref).upper(), str(compRef).upper())
+    return [row for row in rows if str(row[DBSNP_REF]).upper() in alleles]
+
+
+"""Resolves a batch of buffered records with one set-based dbSNP query
+   Entries are (record, chr, pos, ref, compRef), or (line, None, ...) for
+   header lines met inside the batch; yields (record or line, 1 if in dbSNP
+   else 0) in input order. The rows are looked up per position (see
+   dbSnpKey), so a cache in front of cursor answers the positions it
+   holds and the statement only selects the others.
+"""
+def resolveDbSnpBatch(cursor, pending, varclass):
+    chroms = {dbSnpKey(chr, pos, varclass): chr
+        for record, chr, pos, ref, compRef in pending if chr is not None}
+
+    def sql(keys):
+        return 'select * from dbSNP where INFO = "' + varclass + \
+            '" AND (CHR, POS) IN (' + ', '.join('("' + str(chroms[key]) + \
+            '", ' + str(key[2]) + ')' for key in keys) + ');'
+
+    def keyOf(names):
+        names = [name.upper() for name in names]
+        chr_ind = names.index('CHR')
+        pos_ind = names.index('POS')
+        return lambda row: dbSnpKey(row[chr_ind], row[pos_ind], varclass)
+
+    found = lc.fetchRowsMany(cursor, list(chroms), sql, keyOf)
+
+    for record, chr, pos, ref, compRef in pending:
+        if chr is None:
+            yield record, 0
+            continue
+
+        rows = dbSnpAlleles(found[dbSnpKey(chr, pos, varclass)], ref,
+            compRef)
+        if addDbSnpInfo(record, rows, varclass):
+            yield record, 1
+        else:
+            yield record, 0
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -202,104 +415,79 @@ def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
     fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
+    fh = bgzf.openText(vcf)
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
+    conn = u.db_acquire()
+    cursor = lc.cachedCursor(conn.cursor())
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
+    for line in iterBigRefGene(fh, cursor, None, format=format, sep=sep):
+        fh_out.write(str(line) + '\n')
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
+    u.db_release(conn)
+    fh.close()
+    fh_out.close()
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
 
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
+"""Per-record form of getBigRefGene for the fused pipeline
+"""
+def iterBigRefGene(lines, cursor, fh_log, format='vcf', sep='\t', index=None):
 
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
+    inds = getFormatSpecificIndices(format=format)
+    vcf_linenum = 1
 
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
+    for record in vr.records(lines, sep=sep):
+        if isinstance(record, vr.VcfRecord):
+            fields = record.fields
+            chr = record.code
+            pos = record.pos
+            ref = clean_mysql_chars(fields[inds[2]]).strip()
+            alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+            compRef = getComplementary(ref)
+            compAlt = getComplementary(alt)
 
-            if (len(rows) > 0):
-                keep_going = False
+            if (index is not None):
+                fragments = index.fragments(chr, pos, ref, alt, compRef,
+                    compAlt)
+            else:
+                sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
+                    str(chr) + '" AND start = ' + str(pos) + \
+                    ' AND ((haplotypeReference="' + str(ref) + \
+                    '" AND haplotypeAlternate ="' + str(alt) + \
+                    '") OR (haplotypeReference="' + str(compRef) + \
+                    '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
+
+                sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
+                    str(chr) + '" AND start = ' + str(pos) + ';'
+
+                sql3 = 'select * from chrom_pos_unequal where CHR="' + \
+                    str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
+                    str(pos) + ' <= end ;'
+
+                for key, sql in ((('chrom_pos_equal_base', chr, pos, ref,
+                    alt), sql1), (('chrom_pos_equal_nobase', chr, pos), sql2),
+                    (('chrom_pos_unequal', chr, pos), sql3)):
+                    rows = lc.fetchRows(cursor, key, sql)
+                    if (len(rows) > 0):
+                        break
+                fragments = [refSeqFragment(row) for row in rows]
+
+            if (len(fragments) > 0):
                 m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+                for fragment in fragments:
+                    m.add(fragment)
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+                record.addInfo(';' + ';'.join(m))
+                info = record.infoText()
+                if (info.startswith(".;")):
+                    record.setInfo(info.replace('.;', '', 1))
 
-            if (keep_going):
-                fh_out.write(line + '\n')
+            yield record
 
             vcf_linenum = vcf_linenum + 1
 
         else:
-            fh_out.write(line + '\n')
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+            yield record
 
 
 """Get information about location in gene structures
@@ -313,7 +501,26 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh_out = open(outfile, "w")
 
     logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+    fh_log = CountLog(open(logcountfile, 'a'))
+
+    fh = bgzf.openText(vcf)
+    conn = u.db_acquire()
+    cursor = lc.cachedCursor(conn.cursor())
+
+    for line in iterGenes(fh, cursor, fh_log, format=format, table=table,
+        promoter_offset=promoter_offset, sep=sep):
+        fh_out.write(str(line) + '\n')
+
+    fh_out.close()
+    fh_log.close()
+    fh.close()
+    u.db_release(conn)
+
+
+"""Per-record form of getGenes for the fused pipeline
+"""
+def iterGenes(lines, cursor, fh_log, format='vcf', table='refGene',
+    promoter_offset=500, sep='\t', index=None, cpg_index=None):
 
     interGenic_count = 0
     cds_count = 0
@@ -325,42 +532,40 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     non_coding_exonic_count = 0
     promoter_count = 0
 
+    # CpG islands already looked up in this job, by position
+    cpg_cache = OrderedDict()
+    cpg_counts = {'lookups': 0, 'avoided': 0}
+
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
+    for record in vr.records(lines, sep=sep):
+        if isinstance(record, vr.VcfRecord):
+            fields = record.fields
+            chr = record.ucsc
+            pos = record.pos
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
+            this_gene_name = record.infoValue('name')
 
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
+            if (index is not None):
+                rows = index.overlap(chr, pos - int(promoter_offset),
+                    pos + int(promoter_offset))
+            else:
+                sql = 'select * from ' + table + ' where chrom="' + \
+                    str(chr) + '" AND (txStart - ' + str(promoter_offset) + \
+                    ') <= ' + str(pos) + ' AND ' + str(pos) + \
+                    ' <= (txEnd + ' + str(promoter_offset) + ');'
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+                rows = lc.fetchRows(cursor, (table, chr, pos, 'promoter',
+                    int(promoter_offset)), sql)
             info = []
 
             if (len(rows) > 0):
                 cnt = 1
                 for row in rows:
                     #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
+                    positionType = record.infoValue('positionType')
                     
                     if (positionType == 'intron'):
                         intronic_count = intronic_count + 1
@@ -375,54 +580,43 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                     elif (positionType == 'utr3'):
                         utr3_count = utr3_count + 1
 
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
+                    tx = tm.getTranscript(row)
+                    txtStart = tx.txStart
+                    txtEnd = tx.txEnd
+                    cdsStart = tx.cdsStart
+                    cdsEnd = tx.cdsEnd
+                    exonCount = tx.exonCount
+                    strand = tx.strand
 
                     promoter_plus = txtStart - int(promoter_offset)
                     promoter_minus = txtEnd + int(promoter_offset)
                     region = ""
-                    pos = int(pos)
                     exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
 
                     if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
+                        for e in tx.exonsAt(pos):
+                            exnum = e + 1
+                            if (strand == '-'):
+                                exnum = exonCount - e
+                            exons.append("non_coding_exon=" + "ex" + \
+                                str(exnum) + '/' + str(exonCount))
                         if (len(exons) > 0):
                             region = ";".join(exons)
                     elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
+                        for e in tx.exonsAt(pos):
+                            exnum = e + 1
+                            if (strand == '-'):
+                                exnum = exonCount - e
+                            exons.append("exon=" +  "ex" + \
+                                str(exnum) + '/' + str(exonCount))
+                            exonic_count = exonic_count + 1
                         if (len(exons) > 0):
                             region = ";".join(exons)
 
                     elif (u.isBetween(pos, promoter_plus, txtStart) and 
                         (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = cpgIslandAt(cursor, cpg_index, chr, pos,
+                            cpg_cache, cpg_counts)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
@@ -430,13 +624,8 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                             promoter_count = promoter_count + 1
 
                     elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
+                        rows = cpgIslandAt(cursor, cpg_index, chr, pos,
+                            cpg_cache, cpg_counts)
                         if (rows is not None):
                             region = 'putativePromoterRegion=' +  \
                                 "".join(str(rows[3]).split())
@@ -446,59 +635,31 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                         region = ''
 
                     if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
+                        info.append(tx.label + region)
 
                     cnt = cnt + 1
 
                 str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+                record.addInfo(';' + str_info)
+                yield record
 
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
+                record.addInfo(";positionType=interGenic")
+                yield record
                 interGenic_count = interGenic_count + 1
 
             linenum = linenum + 1
 
         else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
-
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
-
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
-
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
-
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
-
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+            yield record
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
-
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    fh_log.record('location', None, interGenic=interGenic_count,
+        cds=cds_count, utr3=utr3_count, utr5=utr5_count,
+        intronic=intronic_count,
+        non_coding_intronic=non_coding_intronic_count,
+        exonic=exonic_count, non_coding_exonic=non_coding_exonic_count,
+        promoter=promoter_count)
+    fh_log.record('cpg', 'cpgIslandExt', **cpg_counts)
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
@@ -512,7 +673,26 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh_out = open(outfile, "w")
 
     logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+    fh_log = CountLog(open(logcountfile, 'a'))
+
+    fh = bgzf.openText(vcf)
+    conn = u.db_acquire()
+    cursor = lc.cachedCursor(conn.cursor())
+
+    for line in iterExonsEtAl(fh, cursor, fh_log, format=format, table=table,
+        promoter_offset=promoter_offset, sep=sep):
+        fh_out.write(str(line) + '\n')
+
+    fh_out.close()
+    fh_log.close()
+    fh.close()
+    u.db_release(conn)
+
+
+"""Per-record form of getExonsEtAl for the fused pipeline
+"""
+def iterExonsEtAl(lines, cursor, fh_log, format='vcf', table='refGene',
+    promoter_offset=500, sep='\t', index=None, cpg_index=None):
 
     interGenic_count = 0
     cds_count = 0
@@ -524,64 +704,57 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     non_coding_exonic_count = 0
     promoter_count = 0
 
+    # CpG islands already looked up in this job, by position
+    cpg_cache = OrderedDict()
+    cpg_counts = {'lookups': 0, 'avoided': 0}
+
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
+    for record in vr.records(lines, sep=sep):
+        if isinstance(record, vr.VcfRecord):
+            fields = record.fields
+            chr = record.ucsc
+            pos = record.pos
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            this_gene_name = record.infoValue('name')
+
+            if (index is not None):
+                rows = index.overlap(chr, pos - int(promoter_offset),
+                    pos + int(promoter_offset))
+            else:
+                sql = 'select * from ' + table + ' where chrom="' + \
+                    str(chr) + '"   AND (txStart - ' + str(promoter_offset) + \
+                    ') <= ' + str(pos) + ' AND ' + str(pos) + \
+                    ' <= (txEnd + ' + str(promoter_offset) + ');'
+                rows = lc.fetchRows(cursor, (table, chr, pos, 'promoter',
+                    int(promoter_offset)), sql)
             info = []
             if (len(rows) > 0):
                 cnt = 1
                 for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
+                    tx = tm.getTranscript(row)
+                    txtStart = tx.txStart
+                    txtEnd = tx.txEnd
+                    cdsStart = tx.cdsStart
+                    cdsEnd = tx.cdsEnd
+                    exonCount = tx.exonCount
+                    strand = tx.strand
 
                     promoter_plus = txtStart - int(promoter_offset)
                     promoter_minus = txtEnd + int(promoter_offset)
                     region = ""
-                    pos = int(pos)
                     exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
 
                     if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
+                        for e in tx.exonsAt(pos):
+                            exnum = e + 1
+                            if (strand == '-'):
+                                exnum =  exonCount - e
+                            exons.append("non_coding_exon=" + "ex" + \
+                                str(exnum) + '/' + str(exonCount))
+                            non_coding_exonic_count = non_coding_exonic_count + 1
                         if (len(exons) > 0):
                             region='positionType=non_coding_exon;' + ";".join(exons)
                         else:
@@ -590,14 +763,13 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
                         cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
+                        for e in tx.exonsAt(pos):
+                            exnum = e + 1
+                            if (strand == '-'):
+                                exnum =  exonCount - e
+                            exons.append("exon=" + "ex" + \
+                                str(exnum) + '/' + str(exonCount))
+                            exonic_count=exonic_count+1
                         if (len(exons) > 0):
                             region = 'positionType=CDS;' + ";".join(exons)
                         else:
@@ -626,12 +798,8 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, promoter_plus, txtStart) and \
                         (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = cpgIslandAt(cursor, cpg_index, chr, pos,
+                            cpg_cache, cpg_counts)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
@@ -640,12 +808,8 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, txtEnd, promoter_minus) and \
                         (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = cpgIslandAt(cursor, cpg_index, chr, pos,
+                            cpg_cache, cpg_counts)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
@@ -656,116 +820,100 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                         region = ''
 
                     if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
+                        info.append(tx.label + region)
 
                     cnt = cnt + 1
 
                 str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+                record.addInfo(';' + str_info)
+                yield record
 
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
+                record.addInfo(";positionType=interGenic")
+                yield record
                 interGenic_count = interGenic_count + 1
 
             linenum = linenum + 1
 
         else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+            yield record
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    fh_log.record('location', None, interGenic=interGenic_count,
+        cds=cds_count, utr3=utr3_count, utr5=utr5_count,
+        intronic=intronic_count,
+        non_coding_intronic=non_coding_intronic_count,
+        exonic=exonic_count, non_coding_exonic=non_coding_exonic_count,
+        promoter=promoter_count)
+    fh_log.record('cpg', 'cpgIslandExt', **cpg_counts)
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+"""Overlap with tfbsConsSites
+"""
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
+    basefile = vcf
+    vcf = basefile + tmpextin
+    outfile = basefile + tmpextout
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+    fh_out = open(outfile, "w")
+    fh = bgzf.openText(vcf)
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+    logcountfile = basefile + '.count.log'
+    fh_log = CountLog(open(logcountfile, 'a'))
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+    conn = u.db_acquire()
+    cursor = lc.cachedCursor(conn.cursor())
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+    for line in iterOverlapWithTfbsConsSites(fh, cursor, fh_log,
+        format=format, table=table, sep=sep):
+        fh_out.write(str(line) + '\n')
 
-    fh_out.close()
     fh_log.close()
+    u.db_release(conn)
     fh.close()
-    conn.close()
+    fh_out.close()
 
 
-"""Overlap with tfbsConsSites
+"""Per-record form of addOverlapWithTfbsConsSites for the fused pipeline
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+def iterOverlapWithTfbsConsSites(lines, cursor, fh_log, format='vcf',
+    table='tfbsConsSites', sep='\t', index=None):
 
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
 
     linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
+    for record in vr.records(lines, sep=sep):
+        ## comments and header line
+        if not isinstance(record, vr.VcfRecord):
+            yield record
 
         else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
+            fields = record.fields
             # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+            chr = record.ucsc
 
-            pos=fields[inds[1]].strip()
+            pos = record.pos
             isOverlap = False
-            chrIndex=chr.replace('chr', '')
+            chrIndex = record.code
 
             if (chrIndex in allowed_chrom):
                 isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                if (index is not None):
+                    rows = index.stab(chrIndex, pos)
+                else:
+                    sql = 'select chrom, chromStart, chromEnd, name ' + \
+                        'from tfbsConsSites' + chrIndex + \
+                        ' where  chromStart <= ' + str(pos) + ' AND ' + \
+                        str(pos) + ' <= chromEnd;'
+                    rows = lc.fetchRows(cursor, ('tfbsConsSites', chrIndex,
+                        pos), sql)
                 records = []
 
                 if (len(rows) > 0):
@@ -780,28 +928,16 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
                         records.append('tfbsRegion' + '=' + t)
                         records_count = records_count + 1
 
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
+                    record.appendInfo(';'.join(records))
 
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+                yield record
 
             else: # chrom is not on the list
-                fh_out.write(line + '\n')
+                yield record
 
         linenum = linenum + 1
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    fh_log.record('overlap', table, found=var_count, variants=line_count)
 
 
 """Overlap with GadAll table
@@ -814,71 +950,74 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
     outfile = basefile + tmpextout
 
     fh_out = open(outfile, "w")
-    fh = open(vcf)
+    fh = bgzf.openText(vcf)
 
     logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
+    fh_log = CountLog(open(logcountfile, 'a'))
+
+    conn = u.db_acquire()
+    cursor = lc.cachedCursor(conn.cursor())
+
+    for line in iterOverlapWithGadAll(fh, cursor, fh_log, format=format,
+        table=table, sep=sep):
+        fh_out.write(str(line) + '\n')
+
+    fh_log.close()
+    u.db_release(conn)
+    fh.close()
+    fh_out.close()
+
+
+"""Per-record form of addOverlapWithGadAll for the fused pipeline
+"""
+def iterOverlapWithGadAll(lines, cursor, fh_log, format='vcf', table='gadAll',
+    sep='\t', index=None):
+
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
+    for record in vr.records(lines, sep=sep):
+        ## not comments nor header line
+        if isinstance(record, vr.VcfRecord):
+            fields = record.fields
+            # For some reason this table has no "chr" preceeding number
+            chr = record.code
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
+            pos = record.pos
+            isOverlap = False
 
+            if (index is not None):
+                rows = index.stab(chr, pos)
+            else:
                 sql = 'select * from ' + table + ' where chromosome="' + \
                     str(chr) + '" AND (chromStart <= ' + str(pos) + \
                     ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+                rows = lc.fetchRows(cursor, (table, chr, pos), sql)
+            records = []
 
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+            if (len(rows) > 0):
+                records_count = 1
+                line_count = line_count + 1
+                r_tmp = []
+                for row in rows:
+                    var_count = var_count + 1
+                    if not fu.isOnTheList(r_tmp, str(row[3])):
+                        r_tmp.append(str(row[3]) )
+                        records.append(str(table) + '=' + str(row[3]))
+                        records_count = records_count + 1
+                record.appendInfo(';'.join(records))
+                record.padFields()
+
+            yield record
 
             linenum = linenum + 1
         else:
-            fh_out.write(line + '\n')
+            yield record
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    fh_log.record('overlap', table, found=var_count, variants=line_count)
 
 
 """ Overlap with gwasCatalog table """
@@ -890,67 +1029,70 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     outfile = basefile + tmpextout
 
     fh_out = open(outfile, "w")
-    fh = open(vcf)
+    fh = bgzf.openText(vcf)
 
     logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
+    fh_log = CountLog(open(logcountfile, 'a'))
+
+    conn = u.db_acquire()
+    cursor = lc.cachedCursor(conn.cursor())
+
+    for line in iterOverlapWithGwasCatalog(fh, cursor, fh_log, format=format,
+        table=table, sep=sep):
+        fh_out.write(str(line) + '\n')
+
+    fh_log.close()
+    u.db_release(conn)
+    fh.close()
+    fh_out.close()
+
+
+"""Per-record form of addOverlapWithGwasCatalog for the fused pipeline
+"""
+def iterOverlapWithGwasCatalog(lines, cursor, fh_log, format='vcf',
+    table='gwasCatalog', sep='\t', index=None):
+
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
+    for record in vr.records(lines, sep=sep):
+        ## not comments nor header line
+        if isinstance(record, vr.VcfRecord):
+            fields = record.fields
+            chr = record.ucsc
 
+            pos = record.pos
+            isOverlap = False
+
+            if (index is not None):
+                rows = index.stab(chr, pos)
+            else:
                 sql = 'select * from ' + table + ' where chrom="' + \
                     str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+                rows = lc.fetchRows(cursor, (table, chr, pos, 'chromEnd'),
+                    sql)
+            records = []
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+            if (len(rows) > 0):
+                line_count = line_count + 1
+                records_count = 1
+                for row in rows:
+                    var_count = var_count + 1
+                    records.append(str(table) + '=' + str('pubMedID') + \
+                        '=' + str(row[5]) + ',trait=' + str(row[10]))
+                    records_count = records_count + 1
+                record.appendInfo(';'.join(records))
+
+            yield record
 
             linenum = linenum + 1
         else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+            yield record
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    fh_log.record('overlap', table, found=var_count, variants=line_count)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
@@ -963,74 +1105,76 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
     outfile = basefile + tmpextout
 
     fh_out = open(outfile, "w")
-    fh = open(vcf)
+    fh = bgzf.openText(vcf)
 
     logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+    fh_log = CountLog(open(logcountfile, 'a'))
+
+    conn = u.db_acquire()
+    cursor = lc.cachedCursor(conn.cursor())
+
+    for line in iterOverlapWitHUGOGeneNomenclature(fh, cursor, fh_log,
+        format=format, table=table, sep=sep):
+        fh_out.write(str(line) + '\n')
+
+    fh_log.close()
+    u.db_release(conn)
+    fh.close()
+    fh_out.close()
+
+
+"""Per-record form of addOverlapWitHUGOGeneNomenclature for the fused pipeline
+"""
+def iterOverlapWitHUGOGeneNomenclature(lines, cursor, fh_log, format='vcf',
+    table='hugo', sep='\t', index=None):
+
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    for record in vr.records(lines, sep=sep):
+        ## not comments nor header line
+        if isinstance(record, vr.VcfRecord):
+            fields = record.fields
+            chr = record.ucsc
 
-                pos=fields[inds[1]].strip()
-                isOverlap = False
+            pos = record.pos
+            isOverlap = False
 
+            if (index is not None):
+                rows = index.stab(chr, pos)
+            else:
                 sql = 'select * from ' + table + ' where chrom="' + \
                     str(chr) + '" AND (chromStart <= ' + str(pos) + \
                     ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+                rows = lc.fetchRows(cursor, (table, chr, pos), sql)
+            records = []
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
+            if (len(rows) > 0):
+                line_count = line_count + 1
+                records_count = 1
+                r_tmp = []
+                for row in rows:
+                    var_count = var_count + 1
+                    t = str(str(row[5]) + ',' + str(row[6])).strip()
+                    if not fu.isOnTheList(r_tmp, t):
+                        r_tmp.append(t)
+                        records.append('HGNC_GeneAnnotation' + '=' + t)
+                    records_count = records_count + 1
 
-                    records_str = ','.join(records).replace(';', ',')
+                records_str = ','.join(records).replace(';', ',')
 
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+                record.appendInfo(records_str)
+
+            yield record
 
             linenum = linenum + 1
         else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+            yield record
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    fh_log.record('overlap', table, found=var_count, variants=line_count)
 
 
 """Overlap with segdup regions genomicSuperDups
@@ -1043,69 +1187,75 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
     outfile = basefile + tmpextout
 
     fh_out = open(outfile, "w")
-    fh = open(vcf)
+    fh = bgzf.openText(vcf)
 
     logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+    fh_log = CountLog(open(logcountfile, 'a'))
+
+    conn = u.db_acquire()
+    cursor = lc.cachedCursor(conn.cursor())
+
+    for line in iterOverlapWithGenomicSuperDups(fh, cursor, fh_log,
+        format=format, table=table, sep=sep):
+        fh_out.write(str(line) + '\n')
+
+    fh_log.close()
+    u.db_release(conn)
+    fh.close()
+    fh_out.close()
+
+
+"""Per-record form of addOverlapWithGenomicSuperDups for the fused pipeline
+"""
+def iterOverlapWithGenomicSuperDups(lines, cursor, fh_log, format='vcf',
+    table='genomicSuperDups', sep='\t', index=None):
+
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    for record in vr.records(lines, sep=sep):
+        ## not comments nor header line
+        if isinstance(record, vr.VcfRecord):
+            fields = record.fields
+            chr = record.ucsc
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
+            pos = record.pos
+            isOverlap = False
+            otherChrom = ''
+            otherStart = ''
+            otherEnd = ''
+            l = str(isOverlap)
 
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
+            if (index is not None):
+                rows = index.first(chr, pos)
+            else:
+                sql = 'select * from ' + table + ' where chrom="' + \
+                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
                     ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+                rows = lc.fetchRow(cursor, (table, chr, pos), sql)
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
+            if rows is not None:
+                line_count = line_count + 1
+                var_count = var_count + 1
+                isOverlap = True
+                otherChrom = rows[7]
+                otherStart = rows[8]
+                otherEnd = rows[9]
+                record.addInfo(';' + str(table) + '=' + \
+                    str(isOverlap) + ';' + 'otherChrom=' + \
+                    str(otherChrom) + ';otherStart=' + \
+                    str(otherStart) + ';otherEnd=' + str(otherEnd))
 
-                fh_out.write('\t'.join(fields) + '\n')
+            yield record
 
             linenum = linenum + 1
         else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+            yield record
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    fh_log.record('overlap', table, found=var_count, variants=line_count)
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
@@ -1118,10 +1268,29 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
     fh_out = open(outfile, "w")
-    fh = open(vcf)
+    fh = bgzf.openText(vcf)
 
     logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+    fh_log = CountLog(open(logcountfile, 'a'))
+
+    conn = u.db_acquire()
+    cursor = lc.cachedCursor(conn.cursor())
+
+    for line in iterOverlapWithRefGene(fh, cursor, fh_log, format=format,
+        table=table, sep=sep):
+        fh_out.write(str(line) + '\n')
+
+    fh_log.close()
+    u.db_release(conn)
+    fh.close()
+    fh_out.close()
+
+
+"""Per-record form of addOverlapWithRefGene for the fused pipeline
+"""
+def iterOverlapWithRefGene(lines, cursor, fh_log, format='vcf',
+    table='refGene', sep='\t'):
+
     var_count = 0
     line_count = 0
     colindex = 1
@@ -1132,59 +1301,41 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     endName = 'txEnd'
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    for record in vr.records(lines, sep=sep):
+        ## not comments nor header line
+        if isinstance(record, vr.VcfRecord):
+            fields = record.fields
+            chr = record.ucsc
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+            pos = record.pos
+            isOverlap = False
+            
+            sql = 'select * from ' + table + ' where chrom="' + \
+                str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
+                ' AND ' + str(pos) + ' <= ' + endName +');'
+            overlapsWith = []
+            rows = lc.fetchRows(cursor, (table, chr, pos, startName, endName),
+                sql)
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
+            if (len(rows) > 0):
+                line_count = line_count + 1
+                for row in rows:
+                    var_count = var_count + 1
+                    overlapsWith.append(name2 + '=' + \
+                        str(row[colindex2]) + ';' + name + '=' + \
+                        str(row[colindex]))
 
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
+                genes = ';'.join([str(x) for x in overlapsWith])
+                record.appendInfo(str(genes))
+            yield record
 
             linenum = linenum + 1
         else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+            yield record
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    fh_log.record('overlap', table, found=var_count, variants=line_count)
 
 
 """Method to find overlap with Cytoband table
@@ -1196,10 +1347,29 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
     fh_out = open(outfile, "w")
-    fh = open(vcf)
+    fh = bgzf.openText(vcf)
 
     logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+    fh_log = CountLog(open(logcountfile, 'a'))
+
+    conn = u.db_acquire()
+    cursor = lc.cachedCursor(conn.cursor())
+
+    for line in iterOverlapWithCytoband(fh, cursor, fh_log, format=format,
+        table=table, sep=sep):
+        fh_out.write(str(line) + '\n')
+
+    fh_log.close()
+    u.db_release(conn)
+    fh.close()
+    fh_out.close()
+
+
+"""Per-record form of addOverlapWithCytoband for the fused pipeline
+"""
+def iterOverlapWithCytoband(lines, cursor, fh_log, format='vcf',
+    table='cytoBand', sep='\t', index=None):
+
     var_count = 0
     line_count = 0
     colindex = 12
@@ -1212,58 +1382,43 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
         endName = 'chromEnd'
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    for record in vr.records(lines, sep=sep):
+        ## not comments nor header line
+        if isinstance(record, vr.VcfRecord):
+            fields = record.fields
+            chr = record.ucsc
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
+            pos = record.pos
+            isOverlap = False
+            
+            overlapsWith = []
+            if (index is not None):
+                rows = index.stab(chr, pos)
+            else:
                 sql = 'select * from ' + table + ' where chrom="' + \
                     str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
                     ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = lc.fetchRows(cursor, (table, chr, pos, startName,
+                    endName), sql)
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
+            if (len(rows) > 0):
+                line_count = line_count + 1
+                for row in rows:
+                    var_count = var_count + 1
+                    overlapsWith.append(str(row[colindex]))
+                overlapsWith = u.dedup(overlapsWith)
+                cytoband = ';'.join([str(x) for x in overlapsWith])
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
+                record.appendInfo(str(table) + '=' + str(cytoband))
+            yield record
 
             linenum = linenum + 1
         else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+            yield record
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    fh_log.record('overlap', table, found=var_count, variants=line_count)
 
 
 """Method to find overlap with CNV tables
@@ -1276,62 +1431,63 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
     outfile = basefile + tmpextout
 
     fh_out = open(outfile, "w")
-    fh = open(vcf)
+    fh = bgzf.openText(vcf)
 
     logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+    fh_log = CountLog(open(logcountfile, 'a'))
+
+    conn = u.db_acquire()
+    cursor = lc.cachedCursor(conn.cursor())
+
+    for line in iterOverlapWithCnvDatabase(fh, cursor, fh_log, format=format,
+        table=table, sep=sep):
+        fh_out.write(str(line) + '\n')
+
+    fh_log.close()
+    u.db_release(conn)
+    fh.close()
+    fh_out.close()
+
+
+"""Per-record form of addOverlapWithCnvDatabase for the fused pipeline
+"""
+def iterOverlapWithCnvDatabase(lines, cursor, fh_log, format='vcf',
+    table='dgv_Cnv', sep='\t', index=None):
+
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    for record in vr.records(lines, sep=sep):
+        ## not comments nor header line
+        if isinstance(record, vr.VcfRecord):
+            fields = record.fields
+            chr = record.ucsc
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
+            pos = record.pos
+            isOverlap = False
+            if (index is not None):
+                rows = index.first(chr, pos)
+            else:
                 sql = 'select * from ' + table + ' where chrom="' + \
                     str(chr) + '" AND (chromStart <= ' + str(pos) + \
                     ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+                rows = lc.fetchRow(cursor, (table, chr, pos), sql)
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
+            if rows is not None:
+                line_count = line_count + 1
+                var_count = var_count + 1
+                isOverlap = True
+                record.appendInfo(str(table) + '=' + str(isOverlap))
+            yield record
 
             linenum = linenum + 1
         else:
-            fh_out.write(line + '\n')
+            yield record
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    fh_log.record('overlap', table, found=var_count, variants=line_count)
 
 
 """Method to find overlap with targetScanS tables
@@ -1344,60 +1500,64 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
     outfile = basefile + tmpextout
 
     fh_out = open(outfile, "w")
-    fh = open(vcf)
+    fh = bgzf.openText(vcf)
 
     logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+    fh_log = CountLog(open(logcountfile, 'a'))
+
+    conn = u.db_acquire()
+    cursor = lc.cachedCursor(conn.cursor())
+
+    for line in iterOverlapWithMiRNA(fh, cursor, fh_log, format=format,
+        table=table, sep=sep):
+        fh_out.write(str(line) + '\n')
+
+    fh_log.close()
+    u.db_release(conn)
+    fh.close()
+    fh_out.close()
+
+
+"""Per-record form of addOverlapWithMiRNA for the fused pipeline
+"""
+def iterOverlapWithMiRNA(lines, cursor, fh_log, format='vcf',
+    table='targetScanS', sep='\t', index=None):
+
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    for record in vr.records(lines, sep=sep):
+        ## not comments nor header line
+        if isinstance(record, vr.VcfRecord):
+            fields = record.fields
+            chr = record.ucsc
 
-                pos = fields[inds[1]].strip()
+            pos = record.pos
+            if (index is not None):
+                rows = index.first(chr, pos)
+            else:
                 sql = 'select * from ' + table + ' where chrom="' + \
                     str(chr) + '" AND (chromStart <= ' + str(pos) + \
                     ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+                rows = lc.fetchRow(cursor, (table, chr, pos), sql)
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
+            if rows is not None:
+                line_count = line_count + 1
+                var_count = var_count + 1
+                t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
+                    str(rows[2]) + '_' + str(rows[3])
+                t = 'miRNAsites=' + t.strip()
+                record.appendInfo(t)
+            yield record
 
             linenum = linenum + 1
         else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+            yield record
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    fh_log.record('overlap', 'miRNAsites', found=var_count,
+        variants=line_count)
 
 ### EOF
\ No newline at end of file
@@ -5,8 +5,10 @@ import uuid
 import subprocess
 import os
 import sys
+import time
 from os.path import exists
 from boto3.dynamodb.conditions import Key, Attr
+import job_scheduler as js
 
 from configparser import ConfigParser
 config = ConfigParser(os.environ)
@@ -20,6 +22,95 @@ iam_username=config['aws']['iam_username']
 AWS_S3_RESULTS_BUCKET=config['s3']['AWS_S3_RESULTS_BUCKET']
 tb=config['dynamodb']['AWS_DYNAMODB_ANNOTATIONS_TABLE']
 stateMachineArn=config['statemachine']['STATE_MACHINE_ARN']
+POOL=config.getboolean('workers', 'Pool', fallback=False)
+WORKERS=config.getint('workers', 'Workers', fallback=0)
+MAX_JOBS_PER_WORKER=config.getint('workers', 'MaxJobsPerWorker', fallback=0)
+RETRIES=config.getint('workers', 'Retries', fallback=1)
+VISIBILITY_TIMEOUT=config.getint('sqs', 'VisibilityTimeout', fallback=300)
+
+if POOL:
+    import driver
+    import run
+    import worker_pool as wp
+
+
+"""Loads the indexes, snapshot and database connections of the pipeline
+   (see driver.preload), once here before the workers are forked and once
+   in every worker; a job run without them loads what it needs itself
+"""
+def preloadPipeline():
+    try:
+        driver.preload()
+    except Exception as e:
+        print(f'Cannot preload the annotation pipeline!: {e}')
+
+
+"""Reports the jobs the worker pool has finished
+"""
+def reportJobs(finished):
+    for job, status, error in finished:
+        if (status == 'done'):
+            print(f'Annotation job {job.job_id} done')
+        else:
+            print(f'Annotation job {job.job_id} failed!: {error}')
+
+
+# Messages of the jobs not started yet, by job id: receipt handle and when
+# their visibility was last extended
+messages = {}
+
+
+"""Marks a job RUNNING and deletes its message once the scheduler starts
+   it; until then the message stays in flight (see extendVisibility)
+"""
+def startJob(job):
+    receipt = messages.pop(job.job_id)['receipt']
+
+    # Update job_status in Dynamodb to Running
+    try:
+        db = boto3.resource('dynamodb', region_name=region)
+        table = db.Table(config['dynamodb']['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+        table.update_item(
+            Key={'job_id':job.job_id},
+            ConditionExpression='#att=:val1',
+            UpdateExpression='SET #att=:val2',
+            ExpressionAttributeNames={"#att": "job_status"},
+            ExpressionAttributeValues={":val2": "RUNNING",":val1": "PENDING"},
+            ReturnValues="UPDATED_NEW"
+        )
+    except ClientError as e:
+        print(f'Cannot update job status to RUNNING!: {e}')
+
+    # Delete the message from the queue, now that the job is running
+    try:
+        response = sqs.delete_message(
+            QueueUrl=config['sqs']['QueueUrl'],
+            ReceiptHandle=receipt
+        )
+    except ClientError as e:
+        print(f'Cannot delete message!: {e}')
+        sys.exit(1)
+
+
+"""Keeps the messages of the jobs waiting in the run queue hidden from
+   other instances, extending their visibility every VisibilityTimeout / 2
+   seconds
+"""
+def extendVisibility():
+    now = time.time()
+    for job_id in scheduler.queued():
+        message = messages[job_id]
+        if (now - message['extended'] < VISIBILITY_TIMEOUT / 2):
+            continue
+        try:
+            sqs.change_message_visibility(
+                QueueUrl=config['sqs']['QueueUrl'],
+                ReceiptHandle=message['receipt'],
+                VisibilityTimeout=VISIBILITY_TIMEOUT
+            )
+            message['extended'] = now
+        except ClientError as e:
+            print(f'Cannot extend message visibility!: {e}')
 
 # reference for A9
 # https://hevodata.com/learn/python-sqs/#:~:text=To%20receive%20a%20message%20from,from%20your%20specified%20SQS%20Queue.
@@ -33,14 +124,36 @@ except UnknownServiceError as e:
     print(f'No sqs service!: {e}')
     sys.exit(1)
 
+# Fork the resident workers that run the annotation jobs
+if POOL:
+    preloadPipeline()
+    pool = wp.WorkerPool(run.annotateJob, js.poolSize(WORKERS),
+        preloadPipeline, MAX_JOBS_PER_WORKER, RETRIES)
+    pool.start()
+
+# Admit the jobs against the CPU, memory and database connection budgets;
+# a job is marked RUNNING and its message deleted once it is started
+scheduler = js.Scheduler(pool=pool if POOL else None, run_file=RUN_FILE,
+    on_launch=startJob)
+
 # Poll the message queue in a loop 
 while True:
+    # Collect finished jobs; while jobs are queued or no more fit, wait on
+    # the running ones instead of taking more messages off the queue, so
+    # other instances pick them up
+    reportJobs(scheduler.poll())
+    while scheduler.saturated():
+        extendVisibility()
+        reportJobs(scheduler.poll(timeout=int(config['sqs']['WaitTimeSeconds'])))
+    max_messages = min(int(config['sqs']['MaxNumberOfMessages']),
+        scheduler.capacity())
+
     # Attempt to read a message from the queue
     # Use long polling - DO NOT use sleep() to wait between polls
     try:
         response = sqs.receive_message(
             QueueUrl=config['sqs']['QueueUrl'],
-            MaxNumberOfMessages=int(config['sqs']['MaxNumberOfMessages']),
+            MaxNumberOfMessages=max_messages,
             WaitTimeSeconds=int(config['sqs']['WaitTimeSeconds']),
         )  
     except ClientError as e:
@@ -110,41 +223,13 @@ while True:
                 continue
                 
 
-            # Launch annotation job as a background process
-            try:
-                process = subprocess.Popen(["python", RUN_FILE, job_input_file, f"{job_id}", 
-                    f"{user_id}", JOBS_DIR, region, iam_username, AWS_S3_RESULTS_BUCKET,tb, stateMachineArn], cwd = JOBS_DIR + f"/{job_id}")
-            except ClientError as e:
-                print(f'Cannot launch annotation job!: {e}')
-                sys.exit(1)
-                
-            
-            # Update job_status in Dynamodb to Running 
-            try:
-                db = boto3.resource('dynamodb', region_name=region)
-                table = db.Table(config['dynamodb']['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-                # response = table.query(KeyConditionExpression=Key('job_id').eq(job_id))
-                # print(response['Items'])
-                table.update_item(
-                    Key={'job_id':job_id},
-                    ConditionExpression='#att=:val1',
-                    UpdateExpression='SET #att=:val2',
-                    ExpressionAttributeNames={"#att": "job_status"},
-                    ExpressionAttributeValues={":val2": "RUNNING",":val1": "PENDING"},
-                    ReturnValues="UPDATED_NEW"
-                )
-            except ClientError as e:
-                print(f'Cannot update job status to RUNNING!: {e}')
-                
-                        
+            # Queue the annotation job; it is started, by a resident worker
+            # or as a background process, once it fits in the budgets, and
+            # only then marked RUNNING and its message deleted (see startJob)
+            messages[job_id] = {'receipt': message['ReceiptHandle'],
+                'extended': 0}
+            scheduler.submit(job_id, f'{JOBS_DIR}/{job_id}', [job_input_file,
+                f"{job_id}", f"{user_id}", JOBS_DIR, region, iam_username,
+                AWS_S3_RESULTS_BUCKET, tb, stateMachineArn], job_input_file)
+            extendVisibility()
 
-            # Delete the message from the queue, if job was successfully submitted
-            try:
-                response = sqs.delete_message(
-                    QueueUrl=config['sqs']['QueueUrl'],
-                    ReceiptHandle=message['ReceiptHandle']
-                )
-            except ClientError as e:
-                print(f'Cannot delete message!: {e}')
-                sys.exit(1)
-                
\ No newline at end of file
@@ -0,0 +1,238 @@
+# bench_data.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Synthetic benchmark data: a VCF of random variants and a small SQLite
+# database with the tables and columns of the annotator schema, so the
+# pipeline can be timed without the RDS instance (see bench_suite.py)
+#
+# Run: python bench_data.py <directory> [variants] [dbsnp_rate]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import random
+import sqlite3
+
+CHROMS = [str(i) for i in range(1, 23)] + ['X', 'Y']
+BASES = ['A', 'C', 'G', 'T']
+
+BIG_REF_GENE_COLUMNS = ['CHR', 'start', 'end', 'haplotypeReference',
+    'haplotypeAlternate', 'name', 'name2', 'transcriptStrand',
+    'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
+    'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
+    'changesAA', 'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+    'inCodingRegion', 'spliceInfo', 'uorfChange']
+BIG_REF_GENE_TABLES = ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+    'chrom_pos_unequal']
+CNV_TABLES = ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv']
+
+SCHEMA = [
+    'create table dbSNP (CHR text, POS int, REF text, RSID text, ALT text, '
+        'QUAL text, INFO text, GMAF text)',
+    'create table refGene (bin int, name text, chrom text, strand text, '
+        'txStart int, txEnd int, cdsStart int, cdsEnd int, exonCount int, '
+        'exonStarts blob, exonEnds blob, score int, name2 text, '
+        'cdsStartStat text, cdsEndStat text, exonFrames blob)',
+    'create table cpgIslandExt (bin int, chrom text, chromStart int, '
+        'chromEnd int, name text)',
+    'create table cytoBand (chrom text, chromStart int, chromEnd int, '
+        'name text, gieStain text)',
+    'create table gadAll (chromosome text, chromStart int, chromEnd int, '
+        'geneSymbol text)',
+    'create table gwasCatalog (bin int, chrom text, chromStart int, '
+        'chromEnd int, name text, pubMedID text, author text, pubDate text, '
+        'journal text, title text, trait text)',
+    'create table hugo (bin int, chrom text, chromStart int, chromEnd int, '
+        'name text, symbol text, description text)',
+    'create table genomicSuperDups (bin int, chrom text, chromStart int, '
+        'chromEnd int, name text, score int, strand text, otherChrom text, '
+        'otherStart int, otherEnd int)',
+    'create table targetScanS (bin int, chrom text, chromStart int, '
+        'chromEnd int, name text, score int, strand text)',
+] + ['create table ' + table + ' (id int, ' + \
+    ', '.join(BIG_REF_GENE_COLUMNS) + ')' for table in BIG_REF_GENE_TABLES] + \
+    ['create table ' + table + ' (bin int, chrom text, chromStart int, '
+        'chromEnd int, name text)' for table in CNV_TABLES] + \
+    ['create table tfbsConsSites' + chrom + ' (chrom text, chromStart int, '
+        'chromEnd int, name text)' for chrom in CHROMS]
+
+INDEXES = [
+    'create index dbSNP_pos on dbSNP (CHR, POS)',
+    'create index chrom_pos_equal_base_pos on chrom_pos_equal_base (CHR, '
+        'start)',
+    'create index chrom_pos_equal_nobase_pos on chrom_pos_equal_nobase '
+        '(CHR, start)',
+    'create index refGene_chrom on refGene (chrom)',
+]
+
+
+"""Parses a chromosome mix such as '1:4,2:2,X:1' (chromosome:weight, the
+   weight defaulting to 1) into a {chromosome: weight} dict
+"""
+def parseChromMix(text):
+    mix = {}
+    for item in text.split(','):
+        chrom, _, weight = item.strip().partition(':')
+        mix[chrom] = float(weight) if weight else 1.0
+    return mix
+
+
+"""n random SNVs (chrom, pos, ref, alt) on chromosomes of length bases,
+   drawn with the weights of chroms ({chromosome: weight}, default all of
+   CHROMS alike) and sorted by chromosome and position
+"""
+def syntheticVariants(n, chroms=None, length=200000, seed=7):
+    rng = random.Random(seed)
+    chroms = chroms or {chrom: 1.0 for chrom in CHROMS}
+    names = list(chroms)
+    picks = rng.choices(names, weights=[chroms[c] for c in names], k=n)
+    variants = [(chrom, rng.randint(1, length), rng.choice(BASES),
+        rng.choice(BASES)) for chrom in picks]
+    rank = {chrom: i for i, chrom in enumerate(CHROMS)}
+    variants.sort(key=lambda v: (rank.get(v[0], len(CHROMS)), v[0], v[1]))
+    return variants
+
+
+"""Writes variants as a single-sample VCF; every third record names its
+   chromosome in the UCSC form (chr1) and the others without the prefix
+"""
+def writeVcf(path, variants, seed=7):
+    rng = random.Random(seed)
+    with open(path, 'w') as fh:
+        fh.write('##fileformat=VCFv4.0\n##source=bench_data\n')
+        fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t'
+            'S1\n')
+        for i, (chrom, pos, ref, alt) in enumerate(variants):
+            info = rng.choice(['.', 'DP=' + str(i), 'DP=3;AF=0.5'])
+            name = 'chr' + chrom if (i % 3 == 0) else chrom
+            fh.write(f"{name}\t{pos}\t.\t{ref}\t{alt}\t50\tPASS\t{info}\t"
+                "GT\t0/1\n")
+
+
+"""Creates the reference database at path for variants
+   About dbsnp_rate of the variants get one or two dbSNP rows and a tenth
+   of them a bigRefGene row; the range tables get a fixed number of
+   random intervals per chromosome of length bases
+"""
+def writeReference(path, variants, dbsnp_rate=0.4, length=200000, seed=7):
+    if os.path.exists(path):
+        os.unlink(path)
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    x = conn.execute
+    for sql in SCHEMA:
+        x(sql)
+
+    holders = '(' + ','.join(['?'] * (len(BIG_REF_GENE_COLUMNS) + 1)) + ')'
+    for i, (chrom, pos, ref, alt) in enumerate(variants):
+        if (rng.random() < dbsnp_rate):
+            for k in range(rng.choice([1, 1, 2])):
+                x('insert into dbSNP values (?,?,?,?,?,?,?,?)', (chrom, pos,
+                    rng.choice([ref, ref, 'A']),
+                    'rs' + str(rng.randint(1, 10 ** 7)), alt, '.',
+                    rng.choice(['SNV', 'SNV', 'DIV']),
+                    rng.choice(['.', '0.1' + str(k)])))
+        if (rng.random() < 0.1):
+            x('insert into chrom_pos_equal_base values ' + holders, (i, chrom,
+                pos, pos, ref, alt, 'NM_' + str(pos), 'G' + str(pos), '+',
+                'CDS', '0', '12', '4', '0', 'AAA', 'K', 'AAC', 'N', 'yes',
+                'missense', 'c.1', 'p.1', 'true', '', '0'))
+        if (rng.random() < 0.1):
+            x('insert into chrom_pos_equal_nobase values ' + holders, (i,
+                chrom, pos, pos, 'A', 'C', 'NM_' + str(pos), 'G' + str(pos),
+                '-', 'intron', '0', '0', '0', '5', '', '', '', '', '',
+                'intron', '', '', 'false', 'x', '0'))
+        if (rng.random() < 0.05):
+            x('insert into gwasCatalog values (?,?,?,?,?,?,?,?,?,?,?)', (0,
+                'chr' + chrom, pos - 1, pos, 'rs', '123' + str(pos), 'a', 'd',
+                'j', 't', 'trait ' + str(pos)))
+
+    for chrom in CHROMS:
+        ucsc = 'chr' + chrom
+        start = 0
+        while (start < length):
+            end = start + rng.randint(1000, 40000)
+            x('insert into cytoBand values (?,?,?,?,?)', (ucsc, start, end,
+                'p' + str(start), 'gneg'))
+            start = end
+
+        for k in range(60):
+            start = rng.randint(1, length)
+            end = start + rng.randint(200, 30000)
+            cds_start = start + rng.randint(0, 500)
+            cds_end = min(end, cds_start + rng.randint(0, 5000))
+            if (rng.random() < 0.2):
+                cds_end = cds_start
+            n = rng.randint(1, 8)
+            bounds = sorted(rng.sample(range(start, end), 2 * n))
+            starts = ''.join([str(b) + ',' for b in bounds[0::2]]).encode()
+            ends = ''.join([str(b) + ',' for b in bounds[1::2]]).encode()
+            x('insert into refGene values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                (0, 'NM_' + str(start), ucsc, rng.choice('+-'), start, end,
+                cds_start, cds_end, n, starts, ends, 0, 'GENE' + str(k % 20),
+                'cmpl', 'cmpl', b''))
+            if (rng.random() < 0.4):
+                x('insert into chrom_pos_unequal values ' + holders, (k,
+                    chrom, start, start + rng.randint(10, 3000), 'A', 'C',
+                    'NM_' + str(start), 'G' + str(start), '+', 'utr3', '0',
+                    '0', '0', '', '', '', '', '', '', 'utr', '', '', 'false',
+                    '', '0'))
+
+        for k in range(40):
+            start = rng.randint(1, length)
+            end = start + rng.randint(100, 3000)
+            x('insert into cpgIslandExt values (?,?,?,?,?)', (0, ucsc, start,
+                end, 'CpG: ' + str(k)))
+            x('insert into gadAll values (?,?,?,?)', (chrom, start,
+                end + 5000, 'GAD' + str(k % 7)))
+            x('insert into hugo values (?,?,?,?,?,?,?)', (0, ucsc, start, end,
+                'h', 'SYM' + str(k % 9), 'desc; ' + str(k)))
+            for table in CNV_TABLES:
+                start = rng.randint(1, length)
+                x('insert into ' + table + ' values (?,?,?,?,?)', (0, ucsc,
+                    start, start + rng.randint(100, 20000), 'cnv'))
+            start = rng.randint(1, length)
+            x('insert into genomicSuperDups values (?,?,?,?,?,?,?,?,?,?)', (0,
+                ucsc, start, start + rng.randint(100, 20000), 'sd', 0, '+',
+                'chr' + rng.choice(CHROMS), k * 10, k * 10 + 99))
+            start = rng.randint(1, length)
+            x('insert into targetScanS values (?,?,?,?,?,?,?)', (0, ucsc,
+                start, start + rng.randint(5, 3000), 'miR-' + str(k), 0, '+'))
+            start = rng.randint(1, length)
+            x('insert into tfbsConsSites' + chrom + ' values (?,?,?,?)', (ucsc,
+                start, start + rng.randint(5, 3000), 'V$TF' + str(k)))
+
+    for sql in INDEXES:
+        x(sql)
+    conn.commit()
+    conn.close()
+
+
+"""Writes a matching pair of benchmark files in directory: bench.vcf and
+   the reference database bench.db
+   Returns (vcf path, database path)
+"""
+def makeDataset(directory, variants=10000, chroms=None, dbsnp_rate=0.4,
+    length=200000, seed=7):
+    os.makedirs(directory, exist_ok=True)
+    vcf = os.path.join(directory, 'bench.vcf')
+    db = os.path.join(directory, 'bench.db')
+    records = syntheticVariants(variants, chroms, length, seed)
+    writeVcf(vcf, records, seed)
+    writeReference(db, records, dbsnp_rate, length, seed)
+    return vcf, db
+
+
+if __name__ == '__main__':
+
+    directory = sys.argv[1]
+    variants = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    dbsnp_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.4
+    print(makeDataset(directory, variants, dbsnp_rate=dbsnp_rate))
+
+### EOF
@@ -0,0 +1,124 @@
+# bench_overlap.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Benchmark of the range table lookups: one SQL query per variant, the
+# in-memory IntervalIndex and the vectorized VectorIndex
+#
+# Run: python bench_overlap.py [variants] [sql_variants] [table ...]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import time
+import random
+
+import interval_index as ix
+import utils as u
+
+BLOCK = 4096
+
+
+"""Random (chromosome, position) pairs spread over the chromosomes of an
+   index, up to the end of their last interval
+"""
+def syntheticVariants(index, n, seed=0):
+    rng = random.Random(seed)
+    spans = [(chrom, int(ends.max()) + 1)
+        for chrom, (_, ends, _, _, _) in index.arrays.items()
+        if (len(ends) > 0)]
+    variants = []
+    for _ in range(n):
+        chrom, span = rng.choice(spans)
+        variants.append((chrom, rng.randrange(span)))
+    return variants
+
+
+"""The query iterOverlapWith* runs for one variant on a range table
+"""
+def rangeQuery(table, chrom, pos):
+    columns, chrom_col, start_col, end_col = ix.RANGE_TABLES[table]
+    if (chrom_col is None):
+        return 'select ' + columns + ' from ' + table + chrom + ' where ' + \
+            start_col + ' <= ' + str(pos) + ' AND ' + str(pos) + ' <= ' + \
+            end_col + ';'
+    return 'select ' + columns + ' from ' + table + ' where ' + chrom_col + \
+        '="' + str(chrom) + '" AND (' + start_col + ' <= ' + str(pos) + \
+        ' AND ' + str(pos) + ' <= ' + end_col + ');'
+
+
+def rate(count, seconds):
+    return f"{count / max(seconds, 1e-9):,.0f} variants/s"
+
+
+"""Times the three lookup paths on one table and checks they agree
+   SQL is timed on the first sql_variants variants only
+"""
+def benchTable(cursor, table, variants, sql_variants):
+    t = time.time()
+    vector = ix.getVectorIndex(cursor, table)
+    print(f"{table}: loaded {vector.index.size} rows in " + \
+        f"{time.time() - t:.2f}s")
+
+    queries = syntheticVariants(vector, variants)
+    sample = queries[:sql_variants]
+
+    t = time.time()
+    sql_hits = []
+    for chrom, pos in sample:
+        cursor.execute(rangeQuery(table, chrom, pos))
+        sql_hits.append(list(cursor.fetchall()))
+    sql_time = time.time() - t
+
+    t = time.time()
+    index_hits = [vector.index.stab(chrom, pos) for chrom, pos in queries]
+    index_time = time.time() - t
+
+    # rows are listed per variant as the stages ask for them
+    t = time.time()
+    vector_hits = []
+    for i in range(0, len(queries), BLOCK):
+        block = queries[i:i + BLOCK]
+        offsets, rows = vector.stabMany([q[0] for q in block],
+            [q[1] for q in block])
+        offsets = offsets.tolist()
+        rows = rows.tolist()
+        vector_hits.extend(rows[offsets[q]:offsets[q + 1]]
+            for q in range(len(block)))
+    vector_time = time.time() - t
+
+    agree = (vector_hits == index_hits) and \
+        all(sorted(map(tuple, s)) == sorted(map(tuple, v))
+            for s, v in zip(sql_hits, vector_hits))
+
+    per_vector = max(vector_time, 1e-9) / len(queries)
+    per_index = index_time / len(queries)
+    per_sql = sql_time / max(len(sample), 1)
+
+    print(f"  sql    {rate(len(sample), sql_time)} " + \
+        f"({len(sample)} variants)")
+    print(f"  index  {rate(len(queries), index_time)}")
+    print(f"  vector {rate(len(queries), vector_time)} " + \
+        f"({per_index / per_vector:.1f}x index, " + \
+        f"{per_sql / per_vector:.0f}x sql)")
+    print(f"  hits {sum(len(h) for h in vector_hits)}, " + \
+        f"{'results agree' if agree else 'RESULTS DIFFER'}")
+    return agree
+
+
+if __name__ == '__main__':
+
+    variants = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    sql_variants = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    tables = sys.argv[3:] or [t for t in ix.RANGE_TABLES]
+
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    ok = all([benchTable(cursor, table, variants, sql_variants)
+        for table in tables])
+    conn.close()
+    sys.exit(0 if ok else 1)
+
+### EOF
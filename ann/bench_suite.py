@@ -0,0 +1,320 @@
+# bench_suite.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Annotation throughput benchmark on the synthetic data of bench_data.py,
+# served from a local SQLite stand-in for the reference database
+#
+# Times driver.run for each of the [benchmark] Cases and every stage of
+# the fused pipeline on its own, reporting variants/s, queries issued and
+# peak RSS, and compares them with the stored Baseline
+#
+# Run: python bench_suite.py [--save-baseline]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import resource
+import threading
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import bench_data as bd
+import bgzf
+import utils as u
+
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+    'ann_config.ini'))
+
+BENCH_DIR = config.get('benchmark', 'Directory', fallback='/tmp/gas_bench')
+BENCH_VARIANTS = config.getint('benchmark', 'Variants', fallback=10000)
+BENCH_CHROMS = config.get('benchmark', 'Chroms', fallback='')
+BENCH_DBSNP_RATE = config.getfloat('benchmark', 'DbSnpRate', fallback=0.4)
+BENCH_CASES = config.get('benchmark', 'Cases', fallback='sql')
+BENCH_BASELINE = config.get('benchmark', 'Baseline',
+    fallback='bench_baseline.json')
+BENCH_TOLERANCE = config.getfloat('benchmark', 'Tolerance', fallback=0.2)
+
+"""driver.run arguments of each case; the fused cases are also timed stage
+   by stage with their engine
+"""
+CASES = {
+    'chained': {'fused': False},
+    'sql': {'fused': True, 'engine': 'sql'},
+    'index': {'fused': True, 'engine': 'index'},
+    'sweep': {'fused': True, 'engine': 'sweep'},
+    'vector': {'fused': True, 'engine': 'vector'},
+    'parallel': {'fused': True, 'engine': 'sql', 'parallel': True},
+}
+
+
+"""SQLite connection counting the queries run on it (the pool's health
+   check pings excepted)
+   Counters are per process: the shards of the parallel case run in worker
+   processes of their own and are not counted
+"""
+class CountingConnection(u.SqliteConnection):
+    queries = 0
+    lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_trace_callback(self.count)
+
+    def count(self, statement):
+        if statement.lstrip()[:6].lower() == 'select' and \
+            statement != 'select 1;':
+            with CountingConnection.lock:
+                CountingConnection.queries = CountingConnection.queries + 1
+
+
+"""Peak resident set size of this process and its finished children (MB)
+"""
+def peakRss():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+"""SHA-256 of the text of a file, BGZF output being inflated first
+"""
+def digest(filename):
+    sha = hashlib.sha256()
+    with bgzf.openText(filename) as fh:
+        for block in iter(lambda: fh.read(1 << 20), ''):
+            sha.update(block.encode())
+    return sha.hexdigest()
+
+
+def countVariants(filename):
+    with open(filename) as fh:
+        return sum(1 for line in fh if not line.startswith('#'))
+
+
+"""Writes the dataset described by params in directory unless the one
+   there was made with the same params
+   Returns (vcf path, database path)
+"""
+def prepareDataset(directory, params):
+    recorded = os.path.join(directory, 'bench_data.json')
+    vcf = os.path.join(directory, 'bench.vcf')
+    db = os.path.join(directory, 'bench.db')
+    if os.path.exists(recorded) and os.path.exists(vcf) and \
+        os.path.exists(db):
+        with open(recorded) as fh:
+            if (json.load(fh) == params):
+                return vcf, db
+
+    print(f"Generating {params['variants']} variants in {directory}")
+    vcf, db = bd.makeDataset(directory, params['variants'],
+        bd.parseChromMix(params['chroms']) if params['chroms'] else None,
+        params['dbsnp_rate'])
+    with open(recorded, 'w') as fh:
+        json.dump(params, fh)
+    return vcf, db
+
+
+"""Runs driver.run for one case on a copy of vcf in workdir
+   Runs in a fresh process (see measure) so peak RSS is its own
+"""
+def measureRun(case, vcf, db, workdir):
+    u.db_use_sqlite(db, CountingConnection)
+    # shards of the parallel case fork from here, as they do from run.py
+    multiprocessing.set_start_method('fork', force=True)
+    import driver
+
+    infile = os.path.join(workdir, case + '.vcf')
+    shutil.copyfile(vcf, infile)
+    variants = countVariants(infile)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.time()
+        driver.run(infile, 'vcf', **CASES[case])
+        seconds = time.time() - start
+
+    outfile = driver.annotatedFileName(infile)
+    result = {
+        'seconds': seconds,
+        'variants_per_sec': variants / max(seconds, 1e-9),
+        'queries': None if CASES[case].get('parallel') else \
+            CountingConnection.queries,
+        'peak_rss_mb': peakRss(),
+        'digest': digest(outfile),
+    }
+    for filename in [infile, outfile, infile + '.count.log']:
+        if os.path.exists(filename):
+            os.remove(filename)
+    return result
+
+
+"""Times each stage of the fused pipeline on its own with engine (or the
+   engine its [backends] entry names), every stage reading the records
+   left by the previous one
+"""
+def measureStages(engine, vcf, db):
+    u.db_use_sqlite(db, CountingConnection)
+    import annotate as ann
+    import driver
+
+    conn = None
+    cursor = None
+    if (engine != 'snapshot'):
+        conn = u.db_acquire()
+        cursor = conn.cursor()
+    streams = []
+
+    with open(vcf) as fh:
+        lines = fh.readlines()
+    variants = countVariants(vcf)
+
+    stages = []
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(len(driver.STAGES)):
+                queries = CountingConnection.queries
+                start = time.time()
+                # every database is the SQLite file, only engines differ
+                stage_engine, _ = driver.stageBackend(i, engine)
+                lines = list(driver.applyStage(i, iter(lines), cursor,
+                    stage_engine, ann.CountLog(), 'vcf', streams))
+                seconds = time.time() - start
+                stages.append({
+                    'stage': driver.stageName(i),
+                    'seconds': seconds,
+                    'variants_per_sec': variants / max(seconds, 1e-9),
+                    'queries': CountingConnection.queries - queries,
+                    'peak_rss_mb': peakRss(),
+                })
+    finally:
+        driver.closeStreams(streams)
+        if conn is not None:
+            u.db_release(conn)
+    return stages
+
+
+"""Calls fn(*args) in a newly spawned process and returns its result
+"""
+def measure(fn, *args):
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(fn, *args).result()
+
+
+"""Differences from the baseline worth a look, as (regression, message)
+   Throughput down or peak RSS up by more than tolerance and more queries
+   than before are regressions, and so is different annotated output
+"""
+def compare(results, baseline, tolerance=BENCH_TOLERANCE):
+    notes = []
+    if (baseline.get('dataset') != results['dataset']):
+        notes.append((False, "baseline was measured on another dataset " + \
+            f"{baseline.get('dataset')}"))
+
+    for case, result in results['cases'].items():
+        base = baseline.get('cases', {}).get(case)
+        if base is None:
+            notes.append((False, f"{case}: not in baseline"))
+            continue
+        if (result['digest'] != base['digest']):
+            notes.append((True, f"{case}: annotated output differs"))
+        change = result['variants_per_sec'] / base['variants_per_sec'] - 1
+        if (change < -tolerance):
+            notes.append((True, f"{case}: {-change:.0%} fewer variants/s"))
+        if (result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance)):
+            notes.append((True, f"{case}: peak RSS " + \
+                f"{base['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB"))
+        if result['queries'] is not None and base['queries'] is not None \
+            and (result['queries'] > base['queries']):
+            notes.append((True, f"{case}: queries {base['queries']} -> " + \
+                f"{result['queries']}"))
+
+        base_stages = {s['stage']: s for s in base.get('stages', [])}
+        for stage in result.get('stages', []):
+            base_stage = base_stages.get(stage['stage'])
+            if base_stage is None:
+                continue
+            change = stage['variants_per_sec'] / \
+                base_stage['variants_per_sec'] - 1
+            if (change < -tolerance):
+                notes.append((False, f"{case}: {stage['stage']} " + \
+                    f"{-change:.0%} fewer variants/s"))
+    return notes
+
+
+def formatQueries(queries):
+    return '-' if queries is None else f"{queries:,}"
+
+
+def report(results, baseline):
+    print(f"{'case':<54}{'seconds':>9}{'variants/s':>12}{'queries':>10}" + \
+        f"{'peak RSS':>11}{'baseline':>10}")
+    for case, result in results['cases'].items():
+        base = baseline.get('cases', {}).get(case) if baseline else None
+        change = ''
+        if base is not None:
+            change = f"{result['variants_per_sec'] / base['variants_per_sec'] - 1:+.0%}"
+        print(f"{case:<54}{result['seconds']:>9.2f}" + \
+            f"{result['variants_per_sec']:>12,.0f}" + \
+            f"{formatQueries(result['queries']):>10}" + \
+            f"{result['peak_rss_mb']:>8.0f} MB{change:>10}")
+        for stage in result.get('stages', []):
+            print(f"  {stage['stage']:<52}{stage['seconds']:>9.2f}" + \
+                f"{stage['variants_per_sec']:>12,.0f}" + \
+                f"{formatQueries(stage['queries']):>10}" + \
+                f"{stage['peak_rss_mb']:>8.0f} MB")
+
+
+if __name__ == '__main__':
+
+    save = '--save-baseline' in sys.argv[1:]
+    # annotations built from sets are ordered by string hashes; the spawned
+    # measuring processes hash alike so their output can be compared
+    os.environ['PYTHONHASHSEED'] = '0'
+
+    params = {'variants': BENCH_VARIANTS, 'chroms': BENCH_CHROMS,
+        'dbsnp_rate': BENCH_DBSNP_RATE}
+    vcf, db = prepareDataset(BENCH_DIR, params)
+    workdir = os.path.join(BENCH_DIR, 'runs')
+    os.makedirs(workdir, exist_ok=True)
+
+    results = {'dataset': params, 'cases': {}}
+    for case in [c.strip() for c in BENCH_CASES.split(',') if c.strip()]:
+        result = measure(measureRun, case, vcf, db, workdir)
+        if not CASES[case].get('parallel') and CASES[case]['fused']:
+            result['stages'] = measure(measureStages,
+                CASES[case]['engine'], vcf, db)
+        results['cases'][case] = result
+
+    baseline_file = os.path.join(BENCH_DIR, BENCH_BASELINE)
+    baseline = None
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as fh:
+            baseline = json.load(fh)
+
+    report(results, baseline)
+    with open(os.path.join(BENCH_DIR, 'bench_results.json'), 'w') as fh:
+        json.dump(results, fh, indent=2)
+
+    regressions = 0
+    if baseline is not None:
+        for regression, message in compare(results, baseline):
+            print(('REGRESSION ' if regression else 'note ') + message)
+            regressions = regressions + regression
+
+    if save:
+        with open(baseline_file, 'w') as fh:
+            json.dump(results, fh, indent=2)
+        print(f"Baseline saved to {baseline_file}")
+    sys.exit(1 if regressions and not save else 0)
+
+### EOF
@@ -0,0 +1,260 @@
+# bgzf.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Compressed VCF input and output: BGZF (the blocked gzip of samtools and
+# tabix, a series of gzip members of at most 64 KB of data each) written and
+# read with the blocks compressed and inflated in a pool of threads, plus
+# plain gzip input
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import gzip
+import zlib
+import struct
+import shutil
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+"""Data bytes per block, as written by htslib
+"""
+BLOCK_SIZE = 0xff00
+
+"""Empty block marking the end of a BGZF file
+"""
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000'
+    '000000000000')
+
+HEADER = struct.Struct('<4BI2BH2BHH')
+FOOTER = struct.Struct('<II')
+
+
+"""True if the file starts with a gzip header (BGZF or not)
+"""
+def isCompressed(filename):
+    with open(filename, 'rb') as fh:
+        return (fh.read(2) == b'\x1f\x8b')
+
+
+"""True if the file starts with a BGZF block
+"""
+def isBgzf(filename):
+    with open(filename, 'rb') as fh:
+        header = fh.read(HEADER.size)
+    return (len(header) == HEADER.size) and \
+        (header[:4] == b'\x1f\x8b\x08\x04') and (header[12:14] == b'BC')
+
+
+"""One BGZF block holding data (at most BLOCK_SIZE bytes)
+"""
+def compressBlock(data, level=6):
+    deflate = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = deflate.compress(data) + deflate.flush()
+    header = HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2,
+        len(cdata) + HEADER.size + FOOTER.size - 1)
+    return header + cdata + FOOTER.pack(zlib.crc32(data), len(data))
+
+
+"""Data of a block read by readBlock
+"""
+def inflateBlock(block):
+    data = zlib.decompress(block[HEADER.size:-FOOTER.size], -15)
+    crc, size = FOOTER.unpack(block[-FOOTER.size:])
+    if (size != len(data)) or (crc != zlib.crc32(data)):
+        raise IOError('BGZF block fails its CRC check')
+    return data
+
+
+"""Next whole block of a BGZF file, b'' at the end of the file
+"""
+def readBlock(fh):
+    header = fh.read(12)
+    if not header:
+        return b''
+    if (len(header) < 12) or (header[:4] != b'\x1f\x8b\x08\x04'):
+        raise IOError('Not a BGZF block')
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = fh.read(xlen)
+    bsize = None
+    i = 0
+    while (i + 4 <= len(extra)):
+        slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+        if (extra[i:i + 2] == b'BC'):
+            bsize = struct.unpack('<H', extra[i + 4:i + 6])[0]
+        i = i + 4 + slen
+    if bsize is None:
+        raise IOError('BGZF block without its size')
+    rest = fh.read(bsize + 1 - 12 - xlen)
+    # inflateBlock expects the fixed 18 byte header
+    return header[:10] + struct.pack('<H', 6) + b'BC\x02\x00' + \
+        struct.pack('<H', bsize) + rest
+
+
+"""Maps fn over items in pool, keeping at most ahead results in flight and
+   yielding them in order (items in this thread when pool is None)
+"""
+def _ordered(fn, items, pool, ahead):
+    if pool is None:
+        for item in items:
+            yield fn(item)
+        return
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if (len(pending) >= ahead):
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+"""Writes text to a BGZF file, threads compressing blocks side by side
+   eof=False leaves out the end-of-file block, for parts that are to be
+   concatenated (see concat)
+"""
+class BgzfWriter(object):
+
+    def __init__(self, filename, threads=1, level=6, eof=True):
+        self.fh = open(filename, 'wb')
+        self.level = level
+        self.eof = eof
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads) if (threads > 1) else None
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+        self.carry = b''
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered = self.buffered + len(text)
+        if (self.buffered >= BLOCK_SIZE):
+            self._cut(final=False)
+
+    """Hands every full block of the buffered text to the pool, and the rest
+       too if final
+    """
+    def _cut(self, final):
+        data = self.carry + ''.join(self.buffer).encode()
+        self.buffer = []
+        self.buffered = 0
+        end = len(data) if final else len(data) - len(data) % BLOCK_SIZE
+        for start in range(0, end, BLOCK_SIZE):
+            self._submit(data[start:min(start + BLOCK_SIZE, end)])
+        self.carry = data[end:]
+
+    def _submit(self, data):
+        if self.pool is None:
+            self.fh.write(compressBlock(data, self.level))
+            return
+        self.pending.append(self.pool.submit(compressBlock, data, self.level))
+        while (len(self.pending) > 4 * self.threads):
+            self.fh.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.fh.closed:
+            return
+        self._cut(final=True)
+        while self.pending:
+            self.fh.write(self.pending.popleft().result())
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.eof:
+            self.fh.write(EOF_BLOCK)
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""Raw stream of the data of a BGZF file, threads inflating blocks ahead
+   of the reader
+"""
+class BgzfReader(io.RawIOBase):
+
+    def __init__(self, filename, threads=1):
+        self.fh = open(filename, 'rb')
+        self.pool = ThreadPoolExecutor(threads) if (threads > 1) else None
+        self.blocks = _ordered(inflateBlock,
+            iter(lambda: readBlock(self.fh), b''), self.pool, 4 * threads)
+        self.data = b''
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while (self.offset >= len(self.data)):
+            self.data = next(self.blocks, None)
+            self.offset = 0
+            if self.data is None:
+                self.data = b''
+                return 0
+        n = min(len(b), len(self.data) - self.offset)
+        b[:n] = self.data[self.offset:self.offset + n]
+        self.offset = self.offset + n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.blocks.close()
+            if self.pool is not None:
+                self.pool.shutdown()
+            self.fh.close()
+        super().close()
+
+
+"""Opens a VCF for reading as text, whether plain, gzip or BGZF
+"""
+def openText(filename, threads=1):
+    if isBgzf(filename):
+        return io.TextIOWrapper(io.BufferedReader(BgzfReader(filename,
+            threads), 1 << 20))
+    if isCompressed(filename):
+        return gzip.open(filename, 'rt')
+    return open(filename)
+
+
+"""Opens filename for writing text, as BGZF if compress is 'bgzf' and as a
+   plain file if it is 'none'
+"""
+def openWrite(filename, compress='none', threads=1, level=6, eof=True):
+    if (compress == 'bgzf'):
+        return BgzfWriter(filename, threads, level, eof)
+    if (compress != 'none'):
+        raise ValueError(f"Unknown compression {compress}")
+    return open(filename, 'w')
+
+
+"""Copies a plain text file into a new BGZF file
+"""
+def compressFile(infile, outfile, threads=1, level=6):
+    with open(infile) as fh, BgzfWriter(outfile, threads, level) as fh_out:
+        for text in iter(lambda: fh.read(1 << 20), ''):
+            fh_out.write(text)
+
+
+"""Writes the data of a compressed (or plain) file to a plain one
+"""
+def inflateFile(infile, outfile, threads=1):
+    with openText(infile, threads) as fh, open(outfile, 'w') as fh_out:
+        shutil.copyfileobj(fh, fh_out, 1 << 20)
+
+
+"""Joins files into outfile byte for byte; BGZF parts written without
+   their end-of-file block (compress='bgzf') are closed with one
+"""
+def concat(parts, outfile, compress='none'):
+    with open(outfile, 'wb') as fh_out:
+        for part in parts:
+            with open(part, 'rb') as fh:
+                shutil.copyfileobj(fh, fh_out, 1 << 20)
+        if (compress == 'bgzf'):
+            fh_out.write(EOF_BLOCK)
+
+### EOF
@@ -0,0 +1,122 @@
+# checkpoint.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Checkpoints of annotation jobs: a manifest of the finished stages (chained
+# mode) or input shards (fused and parallel modes) of a job with checksums
+# of their output files, so a relaunched job resumes after the last good one
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import hashlib
+
+VERSION = 1
+
+
+"""Name of the checkpoint manifest of an input file
+"""
+def manifestFileName(infile):
+    return infile + '.manifest.json'
+
+
+"""SHA-256 of the first size bytes of a file (all of it if size is None)
+"""
+def checksum(filename, size=None):
+    sha = hashlib.sha256()
+    left = size
+    with open(filename, 'rb') as fh:
+        while (left is None) or (left > 0):
+            block = fh.read(1 << 20 if left is None else min(1 << 20, left))
+            if not block:
+                break
+            sha.update(block)
+            if left is not None:
+                left = left - len(block)
+    return sha.hexdigest()
+
+
+"""Manifest of the checkpoints of the job annotating infile
+
+   Entries are kept by name with the files they wrote, each as its size
+   and checksum, plus whatever the caller needs to pick up from there
+   (counters, statistics). A manifest written for another input or other
+   settings is ignored, so its entries are all redone. The manifest is
+   rewritten atomically after every entry.
+"""
+class Manifest(object):
+
+    def __init__(self, infile, settings):
+        self.path = manifestFileName(infile)
+        self.directory = os.path.dirname(os.path.abspath(infile))
+        self.settings = dict(settings, version=VERSION,
+            input=checksum(infile))
+        self.entries = {}
+        self.resumed = 0
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as fh:
+                    saved = json.load(fh)
+            except ValueError:
+                saved = {}
+            if (saved.get('settings') == self.settings):
+                self.entries = saved.get('entries', {})
+
+    """The entry called name if all its files are still as recorded, else
+       None (and the entry is dropped)
+       A file recorded with a size may have grown since, only its first
+       size bytes are checked
+    """
+    def done(self, name):
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        for f in entry['files']:
+            path = os.path.join(self.directory, f['path'])
+            if not os.path.exists(path) or \
+                (os.path.getsize(path) < f['size']) or \
+                (checksum(path, f['size']) != f['sha256']):
+                del self.entries[name]
+                return None
+        self.resumed = self.resumed + 1
+        return entry
+
+    """Records that name is finished, having written files (in the job's
+       directory); data is kept in the entry
+    """
+    def record(self, name, files, **data):
+        entry = dict(data, files=[{'path': os.path.basename(path),
+            'size': os.path.getsize(path), 'sha256': checksum(path)}
+            for path in files])
+        self.entries[name] = entry
+        self.save()
+        return entry
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump({'settings': self.settings, 'entries': self.entries},
+                fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.path)
+
+    """Paths of the files recorded by the entries whose name starts with
+       prefix
+    """
+    def files(self, prefix=''):
+        return [os.path.join(self.directory, f['path'])
+            for name, entry in self.entries.items() if name.startswith(prefix)
+            for f in entry['files']]
+
+    """Drops the manifest once the job is complete
+    """
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+### EOF
@@ -0,0 +1,473 @@
+# columnar.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Columnar export of an annotated VCF: one typed array per column and per
+# INFO key, written in row groups as the file is read, for consumers that
+# memory-map the columns they need instead of parsing INFO strings
+#
+# Layout: MAGIC, then the buffers of every row group (each 8-byte aligned),
+# then a JSON footer describing them, its length (8 bytes, little-endian)
+# and MAGIC again. A column has the same type in every row group, chosen
+# from all its values before the first is written (see ColumnTypes):
+#   int64, float64 - values; valid (uint8) when some rows have none
+#   bool           - values; INFO flags are False where absent
+#   str            - offsets (int64, n + 1) into data (UTF-8)
+#   dict           - codes (int32) into a dictionary held as a str column
+#                    (dict_offsets, dict_data); code -1 where missing
+# A key given more than once in a record (one per transcript) is a list
+# column: list_offsets (int64, rows + 1) into the values, of any of the
+# types above
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import re
+import json
+import mmap
+import struct
+
+import numpy as np
+
+import bgzf
+
+MAGIC = b'GASCOL1\0'
+VERSION = 1
+ROW_GROUP = 65536
+
+"""Fixed VCF columns, named as in the #CHROM header line
+"""
+FIXED = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
+
+BOOLS = {'True': True, 'true': True, 'False': False, 'false': False}
+
+"""Fixed columns kept as strings whatever their values look like
+"""
+STRINGS = ['CHROM', 'ID', 'REF', 'ALT']
+
+"""Types a column may take other than str, in order of preference
+"""
+KINDS = ['int64', 'float64', 'bool']
+
+
+"""Name of the columnar export of an annotated file, x.annot.cols for
+   x.annot.vcf[.gz]
+"""
+def columnarFileName(annotfile):
+    return re.sub(r'(\.vcf)?(\.b?gz)?$', '', annotfile) + '.cols'
+
+
+"""Column names of a header (#CHROM) line
+"""
+def headerNames(header):
+    return header.lstrip('#').rstrip('\n').split('\t')
+
+
+"""Stripped fields of a data line, and the names of the columns of a file
+   without a header line, from the number of fields
+"""
+def splitLine(line):
+    return [field.strip() for field in line.rstrip('\n').split('\t')]
+
+
+def defaultNames(fields):
+    return (FIXED + ['FORMAT'] + ['SAMPLE' + str(i)
+        for i in range(1, len(fields) - 8)])[:len(fields)]
+
+
+"""(key, value) of every key of an INFO field, value None for a flag
+"""
+def infoItems(info):
+    if (info == '.'):
+        return
+    for item in info.split(';'):
+        key, eq, value = item.partition('=')
+        if (key == '') or (key == '.'):
+            continue
+        yield key, (value if eq else None)
+
+
+"""Whether a value is stored as kind and reads back as the same text:
+   '007' or '01' stay strings, as would '1e5' as a float
+"""
+def fits(kind, value):
+    if (kind == 'bool'):
+        return value in BOOLS
+    try:
+        number = int(value) if (kind == 'int64') else float(value)
+    except ValueError:
+        return False
+    if (kind == 'int64') and not (-2 ** 63 <= number < 2 ** 63):
+        return False
+    return (str(number) == value)
+
+
+"""Type of every column of a file, from all of its values: the first of
+   KINDS every value fits, else str; 'flag' for INFO keys never given a
+   value. '.' is a missing value and fits any type.
+"""
+class ColumnTypes(object):
+
+    def __init__(self):
+        self.names = None
+        self.candidates = {}
+        self.given = set()
+
+    def add(self, name, value):
+        kinds = self.candidates.setdefault(name,
+            [] if (name in STRINGS) else list(KINDS))
+        if value is None:
+            return
+        self.given.add(name)
+        if kinds and (value != '.'):
+            kinds[:] = [kind for kind in kinds if fits(kind, value)]
+
+    def append(self, line):
+        fields = splitLine(line)
+        if self.names is None:
+            self.names = defaultNames(fields)
+        for i, name in enumerate(self.names):
+            value = fields[i] if (i < len(fields)) else '.'
+            if (name == 'INFO'):
+                for key, item in infoItems(value):
+                    self.add('INFO/' + key, item)
+            else:
+                self.add(name, value)
+
+    def kinds(self):
+        kinds = {}
+        for name, candidates in self.candidates.items():
+            if name not in self.given:
+                kinds[name] = 'flag'
+            else:
+                kinds[name] = candidates[0] if candidates else 'str'
+        return kinds
+
+
+"""Writes the data lines of an annotated VCF as row groups of columns
+   header is the #CHROM line naming the columns (INFO is split into one
+   column per key, named INFO/key) and kinds the type of every column (see
+   ColumnTypes); lines are appended one at a time
+"""
+class ColumnWriter(object):
+
+    def __init__(self, filename, kinds, header=None, row_group=ROW_GROUP):
+        self.fh = open(filename, 'wb')
+        self.fh.write(MAGIC)
+        self.kinds = kinds
+        self.names = None
+        if header is not None:
+            self.names = headerNames(header)
+        self.row_group = row_group
+        self.groups = []
+        self.rows = 0
+        self._reset()
+
+    def _reset(self):
+        self.fixed = None
+        self.info = {}
+        self.group_rows = 0
+
+    def append(self, line):
+        fields = splitLine(line)
+        if self.names is None:
+            self.names = defaultNames(fields)
+        if self.fixed is None:
+            self.fixed = [[] for _ in self.names]
+        row = self.group_rows
+        for i, name in enumerate(self.names):
+            if (name == 'INFO'):
+                self.appendInfo(row, fields[i] if (i < len(fields)) else '.')
+            else:
+                self.fixed[i].append(fields[i] if (i < len(fields)) else '.')
+        self.group_rows = row + 1
+        if (self.group_rows >= self.row_group):
+            self.flush()
+
+    def appendInfo(self, row, info):
+        for key, value in infoItems(info):
+            rows, values = self.info.setdefault(key, ([], []))
+            rows.append(row)
+            values.append(value)
+
+    """Writes the rows appended since the last row group as a new one
+    """
+    def flush(self):
+        if (self.group_rows == 0):
+            return
+        n = self.group_rows
+        columns = {}
+        for name, values in zip(self.names, self.fixed):
+            if (name != 'INFO'):
+                columns[name] = self.encode(name, values, n)
+        for key in sorted(self.info):
+            rows, values = self.info[key]
+            columns['INFO/' + key] = self.encode('INFO/' + key, values, n,
+                rows)
+        self.groups.append({'rows': n, 'columns': columns})
+        self.rows = self.rows + n
+        self._reset()
+
+    """Writes the buffers of column name in a row group, values at rows (one
+       per row if None), and returns their description
+    """
+    def encode(self, name, values, n, rows=None):
+        kind = self.kinds.get(name, 'str')
+        if rows is None:
+            rows = np.arange(n)
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+        if (kind == 'flag'):
+            flags = np.zeros(n, dtype=np.bool_)
+            flags[rows] = True
+            return {'type': 'bool', 'values': self.buffer(flags)}
+
+        # '.' (and a bare key among valued ones) is a missing value
+        keep = [i for i, v in enumerate(values)
+            if (v is not None) and (v != '.')]
+        if (len(keep) < len(values)):
+            values = [values[i] for i in keep]
+            rows = rows[keep]
+
+        meta = {}
+        valid = None
+        counts = np.bincount(rows, minlength=n)
+        scalar = (len(values) == 0) or (counts.max() <= 1)
+        if not scalar:
+            meta['list_offsets'] = self.buffer(np.concatenate([[0],
+                np.cumsum(counts)]).astype(np.int64))
+        elif (len(values) < n):
+            valid = np.zeros(n, dtype=np.uint8)
+            valid[rows] = 1
+            meta['valid'] = self.buffer(valid)
+
+        if (kind != 'str'):
+            array = toArray(kind, values)
+            if scalar:
+                dense = np.zeros(n, dtype=array.dtype)
+                dense[rows] = array
+                array = dense
+            meta['type'] = kind
+            meta['values'] = self.buffer(array)
+            return meta
+
+        if scalar:
+            dense = [''] * n
+            for row, value in zip(rows.tolist(), values):
+                dense[row] = value
+            values = dense
+        dictionary = dict.fromkeys(values)
+        if (len(dictionary) <= len(values) // 2):
+            for i, value in enumerate(dictionary):
+                dictionary[value] = i
+            codes = np.fromiter((dictionary[v] for v in values),
+                dtype=np.int32, count=len(values))
+            if valid is not None:
+                codes[valid == 0] = -1
+            meta['type'] = 'dict'
+            meta['codes'] = self.buffer(codes)
+            meta['dict_offsets'], meta['dict_data'] = \
+                self.strings(list(dictionary))
+        else:
+            meta['type'] = 'str'
+            meta['offsets'], meta['data'] = self.strings(values)
+        return meta
+
+    """Buffers of a str column
+    """
+    def strings(self, values):
+        encoded = [v.encode() for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64,
+            count=len(encoded)), out=offsets[1:])
+        return self.buffer(offsets), self.buffer(b''.join(encoded))
+
+    """Writes an array (or bytes) 8-byte aligned; returns [offset, count,
+       dtype]
+    """
+    def buffer(self, array):
+        pad = -self.fh.tell() % 8
+        if pad:
+            self.fh.write(b'\0' * pad)
+        offset = self.fh.tell()
+        if isinstance(array, bytes):
+            self.fh.write(array)
+            return [offset, len(array), '|u1']
+        array = np.ascontiguousarray(array)
+        self.fh.write(array.tobytes())
+        return [offset, len(array), array.dtype.str]
+
+    def close(self):
+        if self.fh.closed:
+            return
+        self.flush()
+        footer = json.dumps({'version': VERSION, 'rows': self.rows,
+            'names': self.names, 'row_groups': self.groups},
+            separators=(',', ':')).encode()
+        self.fh.write(footer)
+        self.fh.write(struct.pack('<Q', len(footer)))
+        self.fh.write(MAGIC)
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""Array of kind ('int64', 'float64' or 'bool') of value strings that all
+   fit it
+"""
+def toArray(kind, values):
+    if (kind == 'bool'):
+        return np.array([BOOLS[v] for v in values], dtype=np.bool_)
+    if (kind == 'int64'):
+        return np.array([int(v) for v in values], dtype=np.int64)
+    return np.array([float(v) for v in values], dtype=np.float64)
+
+
+"""Writes the columnar export of an annotated VCF (plain or BGZF) to
+   outfile
+   The file is read twice: once for the type of every column, then to
+   write the columns.
+"""
+def export(annotfile, outfile, row_group=ROW_GROUP):
+    header = None
+    types = ColumnTypes()
+    with bgzf.openText(annotfile) as fh:
+        for line in fh:
+            if line.startswith('#'):
+                if line.startswith('#CHROM'):
+                    header = line
+                    types.names = headerNames(header)
+                continue
+            types.append(line)
+
+    with ColumnWriter(outfile, types.kinds(), header, row_group) as writer:
+        with bgzf.openText(annotfile) as fh:
+            for line in fh:
+                if not line.startswith('#'):
+                    writer.append(line)
+
+
+"""Scalar column values as a list column: one array of zero or one value
+   per row
+"""
+def asLists(values):
+    rows = np.empty(len(values), dtype=object)
+    mask = np.ma.getmaskarray(values)
+    data = np.ma.getdata(values)
+    for i in range(len(values)):
+        rows[i] = data[i:i] if mask[i] else data[i:i + 1]
+    return rows
+
+
+"""A columnar export opened for reading, its buffers memory-mapped
+"""
+class ColumnFile(object):
+
+    def __init__(self, filename):
+        self.fh = open(filename, 'rb')
+        self.map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if (self.map[:8] != MAGIC) or (self.map[-8:] != MAGIC):
+            raise IOError(f"{filename} is not a columnar export")
+        length = struct.unpack('<Q', self.map[-16:-8])[0]
+        footer = json.loads(self.map[-16 - length:-16].decode())
+        self.rows = footer['rows']
+        self.groups = footer['row_groups']
+
+    """Column names, fixed columns first and INFO keys after
+    """
+    def columns(self):
+        names = []
+        for group in self.groups:
+            for name in group['columns']:
+                if name not in names:
+                    names.append(name)
+        return names
+
+    """A buffer of the column name in row group g, as an array over the
+       mapped file (no copy), or None
+    """
+    def buffer(self, g, name, part):
+        meta = self.groups[g]['columns'].get(name)
+        if (meta is None) or (part not in meta):
+            return None
+        offset, count, dtype = meta[part]
+        return np.frombuffer(self.map, dtype=np.dtype(dtype), count=count,
+            offset=offset)
+
+    """Values of column name in row group g: an array of one value per
+       row (masked where missing, an object array for strings), or for a
+       list column an object array of one array per row
+    """
+    def group(self, g, name):
+        n = self.groups[g]['rows']
+        meta = self.groups[g]['columns'].get(name)
+        if meta is None:
+            return np.ma.masked_all(n, dtype=object)
+
+        kind = meta['type']
+        if (kind == 'str'):
+            values = self.strings(g, name, 'offsets', 'data')
+        elif (kind == 'dict'):
+            dictionary = self.strings(g, name, 'dict_offsets', 'dict_data')
+            codes = self.buffer(g, name, 'codes')
+            values = np.append(dictionary, None)[codes]
+        else:
+            values = self.buffer(g, name, 'values')
+
+        offsets = self.buffer(g, name, 'list_offsets')
+        if offsets is not None:
+            rows = np.empty(n, dtype=object)
+            for i in range(n):
+                rows[i] = values[offsets[i]:offsets[i + 1]]
+            return rows
+
+        valid = self.buffer(g, name, 'valid')
+        if (valid is not None):
+            return np.ma.MaskedArray(values, mask=(valid == 0))
+        return values
+
+    """Column name over all row groups (see group); a list column in any
+       row group makes it a list column throughout
+    """
+    def read(self, name):
+        parts = [self.group(g, name) for g in range(len(self.groups))]
+        if not parts:
+            return np.array([], dtype=object)
+        if any('list_offsets' in group['columns'].get(name, {})
+            for group in self.groups):
+            parts = [part if ('list_offsets' in group['columns'].get(name,
+                {})) else asLists(part)
+                for group, part in zip(self.groups, parts)]
+            return np.concatenate(parts)
+        if any(isinstance(p, np.ma.MaskedArray) for p in parts):
+            return np.ma.concatenate(parts)
+        return np.concatenate(parts)
+
+    def strings(self, g, name, offsets, data):
+        offsets = self.buffer(g, name, offsets).tolist()
+        data = bytes(self.buffer(g, name, data))
+        return np.array([data[offsets[i]:offsets[i + 1]].decode()
+            for i in range(len(offsets) - 1)], dtype=object)
+
+    """Unmaps the file; arrays still viewing it keep the mapping open until
+       they are gone
+    """
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+### EOF
@@ -12,110 +12,679 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import file_utils as fu
 import annotate as ann
+import bgzf
+import checkpoint as cp
+import columnar as co
+import interval_index as ix
+import lookup_cache as lc
+import result_index as ri
+import snapshot as sn
+import stage_graph as sg
+import stage_stats as sst
+import utils as u
+
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+    'ann_config.ini'))
+
+DBSNP_BATCH_SIZE = config.getint('pipeline', 'DbSnpBatchSize', fallback=1)
+SNAPSHOT_DIR = config.get('pipeline', 'SnapshotDir', fallback='snapshot')
+CONCURRENT_STAGES = config.getboolean('pipeline', 'ConcurrentStages',
+    fallback=False)
+WORKERS = config.getint('pipeline', 'Workers', fallback=0) or os.cpu_count()
+SPLIT = config.get('pipeline', 'Split', fallback='chrom')
+CHECKPOINT_BYTES = config.getint('pipeline', 'CheckpointBytes',
+    fallback=64 << 20)
+COMPRESS = config.get('pipeline', 'Compress', fallback='none')
+COMPRESS_THREADS = config.getint('pipeline', 'CompressThreads',
+    fallback=0) or os.cpu_count()
+COMPRESS_LEVEL = config.getint('pipeline', 'CompressLevel', fallback=6)
+INDEX = config.getboolean('pipeline', 'Index', fallback=False)
+INDEX_BUCKET = config.getint('pipeline', 'IndexBucket', fallback=16384)
+INDEX_EVERY = config.getint('pipeline', 'IndexEvery', fallback=10000)
+COLUMNAR = config.getboolean('pipeline', 'Columnar', fallback=False)
+COLUMNAR_ROW_GROUP = config.getint('pipeline', 'ColumnarRowGroup',
+    fallback=co.ROW_GROUP)
+
+"""Annotation stages in the order they are applied:
+   (label, file-based stage, per-record stage, stage arguments)
+"""
+STAGES = [
+    ("dbSNP", ann.getSnpsFromDbSnp, ann.iterSnpsFromDbSnp,
+        {'batch_size': DBSNP_BATCH_SIZE}),
+    ("BigRefGene", ann.getBigRefGene, ann.iterBigRefGene, {}),
+    ("BigRefGene", ann.getGenes, ann.iterGenes,
+        {'table': 'refGene', 'promoter_offset': 500}),
+    ("Cytoband", ann.addOverlapWithCytoband, ann.iterOverlapWithCytoband,
+        {'table': 'cytoBand'}),
+    ("gadAll", ann.addOverlapWithGadAll, ann.iterOverlapWithGadAll,
+        {'table': 'gadAll'}),
+    ("GwasCatalog", ann.addOverlapWithGwasCatalog,
+        ann.iterOverlapWithGwasCatalog, {'table': 'gwasCatalog'}),
+    ("miRNA", ann.addOverlapWithMiRNA, ann.iterOverlapWithMiRNA,
+        {'table': 'targetScanS'}),
+    ("HUGO Gene Nomenclature Committee",
+        ann.addOverlapWitHUGOGeneNomenclature,
+        ann.iterOverlapWitHUGOGeneNomenclature, {'table': 'hugo'}),
+    ("dgv_Cnv", ann.addOverlapWithCnvDatabase,
+        ann.iterOverlapWithCnvDatabase, {'table': 'dgv_Cnv'}),
+    ("abParts_IG_T_CelReceptors", ann.addOverlapWithCnvDatabase,
+        ann.iterOverlapWithCnvDatabase, {'table': 'abParts_IG_T_CelReceptors'}),
+    ("mcCarroll_Cnv", ann.addOverlapWithCnvDatabase,
+        ann.iterOverlapWithCnvDatabase, {'table': 'mcCarroll_Cnv'}),
+    ("conrad_Cnv", ann.addOverlapWithCnvDatabase,
+        ann.iterOverlapWithCnvDatabase, {'table': 'conrad_Cnv'}),
+    ("genomicSuperDups", ann.addOverlapWithGenomicSuperDups,
+        ann.iterOverlapWithGenomicSuperDups, {'table': 'genomicSuperDups'}),
+    ("addOverlapWithTfbsConsSites", ann.addOverlapWithTfbsConsSites,
+        ann.iterOverlapWithTfbsConsSites, {'table': 'tfbsConsSites'}),
+]
+
+"""Stages whose output each stage reads, by position in STAGES
+   dbSNP and the gene stages rewrite INFO in ways the next stage depends
+   on; the overlap stages only append their own keys to it, so they all
+   read the records left by the gene stage and can run side by side
+"""
+STAGE_INPUTS = [[], [0], [1]] + [[2] for _ in STAGES[3:]]
+
+"""Reference tables of the stages that do not name one in their arguments
+"""
+STAGE_TABLES = {
+    ann.iterSnpsFromDbSnp: 'dbSNP',
+    ann.iterBigRefGene: 'bigRefGene',
+}
+
+
+"""Name of the final annotated file for an input file (plain or gzipped),
+   ending in .gz if it is written as BGZF
+"""
+def annotatedFileName(infile, compress=COMPRESS):
+    name = (re.sub(r'\.b?gz$', '', infile) + '.annot').replace('.vcf.annot',
+        '.annot.vcf')
+    return name + '.gz' if (compress == 'bgzf') else name
+
+
+"""Annotates infile; fused, engine and parallel default to the [pipeline]
+   settings
+   engine='index' serves the range tables from in-memory interval indexes,
+   engine='sweep' merge-joins coordinate-sorted input against the tables
+   streamed in order, engine='vector' resolves blocks of positions against
+   the in-memory indexes with NumPy, engine='snapshot' answers every lookup
+   from the local snapshot in SnapshotDir without a database (fused mode
+   only)
+   parallel=True annotates shards of the input in a process pool (fused)
+   In fused mode the [backends] settings give stages another engine or
+   database (see stageBackend)
+   checkpoint=True records every finished stage (chained) or input shard
+   (fused, parallel) in a manifest next to the input (see checkpoint.py),
+   and a run of the same job picks up after the last good one
+   infile may be gzip or BGZF compressed; compress='bgzf' writes the
+   annotated file as BGZF (see bgzf.py)
+   index=True writes the random-access index of the annotated file next
+   to it (see result_index.py), columnar=True its columnar export (see
+   columnar.py)
+   Per-stage statistics (see stage_stats.py) are written to the .stats.json
+   sidecar next to the .count.log and returned
+"""
+def run(infile, format, fused=None, engine=None, parallel=None,
+    checkpoint=None, compress=None, index=None, columnar=None):
+
+    if fused is None:
+        fused = config.getboolean('pipeline', 'Fused', fallback=True)
+    if engine is None:
+        engine = config.get('pipeline', 'Engine', fallback='sql')
+    if parallel is None:
+        parallel = config.getboolean('pipeline', 'Parallel', fallback=False)
+    if checkpoint is None:
+        checkpoint = config.getboolean('pipeline', 'Checkpoint',
+            fallback=False)
+    if compress is None:
+        compress = COMPRESS
+    if index is None:
+        index = INDEX
+    if columnar is None:
+        columnar = COLUMNAR
+
+    mode = 'parallel' if parallel else 'fused' if fused else 'chained'
+    manifest = None
+    if checkpoint:
+        manifest = cp.Manifest(infile, {'mode': mode, 'engine': engine,
+            'compress': compress,
+            'stages': [stageName(i) for i in range(len(STAGES))]})
 
-def run(infile, format):
+    cache = lc.getCache()
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    wall = time.perf_counter()
+    cpu = sst.cpuTime()
+    meters = [sst.StageMeter(STAGES[i][0], stageName(i), counted=fused)
+        for i in range(len(STAGES))]
+
+    sharded = parallel or (fused and checkpoint)
+    # shards are byte ranges of the input, which must be inflated first
+    source = infile
+    if sharded and bgzf.isCompressed(infile):
+        source = infile + '.inflated'
+        bgzf.inflateFile(infile, source, COMPRESS_THREADS)
+
+    try:
+        if parallel:
+            cache_stats, stages = runParallel(infile, format, engine=engine,
+                manifest=manifest, source=source, compress=compress)
+        elif sharded:
+            cache_stats, stages = runCheckpointed(infile, format, engine,
+                manifest, source=source, compress=compress)
+        elif fused:
+            runFused(infile, format, engine=engine, meters=meters,
+                compress=compress)
+        else:
+            runChained(infile, format, meters=meters, manifest=manifest,
+                compress=compress)
+    finally:
+        if (source != infile):
+            fu.delete(source)
+
+    outfile = annotatedFileName(infile, compress)
+    if index:
+        ri.write(outfile, ri.buildIndex(outfile, INDEX_BUCKET, INDEX_EVERY))
+    if columnar:
+        co.export(outfile, co.columnarFileName(outfile), COLUMNAR_ROW_GROUP)
+    if not sharded:
+        stages = [meter.record() for meter in meters]
+
+    stats = {
+        'mode': mode,
+        'engine': engine if (fused or parallel) else 'sql',
+        'wall': round(time.perf_counter() - wall, 6),
+        'cpu': round(sst.cpuTime() - cpu, 6),
+        'variants': stages[-1]['variants'],
+        'bytes_read': fu.fileSize(infile),
+        'bytes_written': fu.fileSize(outfile),
+        'resumed': manifest.resumed if manifest else 0,
+        'stages': stages,
+    }
+    sst.write(infile, stats)
+    if manifest is not None:
+        parts = manifest.files('shard')
+        manifest.remove()
+        # kept for a relaunch until now (see runShards)
+        for part in parts:
+            fu.delete(part)
+
+    if cache is not None:
+        cache.flush()
+        if not sharded:
+            cache_stats = cache.stats()
+    if (cache is not None) and cache_stats:
+        print(f"Lookup cache: {cache_stats['hits']} hits " + \
+            f"({cache_stats['disk_hits']} from disk), " + \
+            f"{cache_stats['misses']} misses, " + \
+            f"{cache_stats['evictions']} evictions")
+    return stats
+
+
+"""Name of stage i in the statistics, e.g. iterOverlapWithCnvDatabase(dgv_Cnv)
+"""
+def stageName(i):
+    _, _, stage, kwargs = STAGES[i]
+    if ('table' in kwargs):
+        return stage.__name__ + '(' + kwargs['table'] + ')'
+    return stage.__name__
+
+
+"""Runs every stage as a separate pass over the input, each stage reading
+   the temp file (.1, .2, ...) written by the previous one
+   meters[i] gets the time, variants and file bytes of stage i
+   With a manifest, each finished stage is recorded with its temp file and
+   the .count.log so far; stages up to the last one still intact are not
+   run again
+   The last temp file is compressed into the annotated file if compress is
+   'bgzf'
+"""
+def runChained(infile, format, meters=None, manifest=None, compress='none'):
+
+    first = 0
+    if manifest is not None:
+        first = resumeChained(infile, manifest)
+
+    tmpextin = '.' + str(first) if (first > 0) else ''
+    for i, (label, stage, _, kwargs) in enumerate(STAGES):
+        tmpextout = '.' + str(i + 1)
+        if (i < first):
+            if meters is not None:
+                meters[i].restore(manifest.entries['stage' + str(i)]['stage'])
+            print(f"{label} - resumed.")
+            continue
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        stage(vcf=infile, format=format, tmpextin=tmpextin,
+            tmpextout=tmpextout, **kwargs)
+        if meters is not None:
+            meters[i].backend = 'sql/' + u.DB_BACKEND
+            meters[i].wall = time.perf_counter() - wall
+            meters[i].cpu = time.process_time() - cpu
+            meters[i].bytes_read = fu.fileSize(infile + tmpextin)
+            meters[i].bytes_written = fu.fileSize(infile + tmpextout)
+            meters[i].variants = fu.countRecords(infile + tmpextout)
+        if manifest is not None:
+            manifest.record('stage' + str(i), [infile + tmpextout,
+                infile + '.count.log'], stage=meters[i].record() if \
+                meters is not None else None)
+        print(f"{label} - done.")
+        tmpextin = tmpextout
 
     ## Cleanup
-    for i in range(1, tmpextin):
+    for i in range(1, len(STAGES)):
         fu.delete(infile + '.' + str(i))
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    if (compress == 'bgzf'):
+        bgzf.compressFile(infile + tmpextin, infile + '.annot',
+            COMPRESS_THREADS, COMPRESS_LEVEL)
+        fu.delete(infile + tmpextin)
+    else:
+        os.rename(infile + tmpextin, infile + '.annot')
+    os.rename(infile + '.annot', annotatedFileName(infile, compress))
+
+
+"""Number of chained stages that need not run again: those up to the last
+   one recorded in manifest whose temp file and .count.log are intact
+   The .count.log is cut back to what it held after that stage.
+"""
+def resumeChained(infile, manifest):
+    recorded = 0
+    while ('stage' + str(recorded)) in manifest.entries:
+        recorded = recorded + 1
+
+    for last in range(recorded - 1, -1, -1):
+        entry = manifest.done('stage' + str(last))
+        if entry is not None:
+            with open(infile + '.count.log', 'r+') as fh:
+                fh.truncate(entry['files'][1]['size'])
+            return last + 1
+    return 0
+
+
+"""Runs all stages in a single pass: each record flows through the chain of
+   per-record stages and the annotated file is written once
+"""
+def runFused(infile, format, engine='sql', meters=None, compress='none'):
+
+    fh = bgzf.openText(infile, COMPRESS_THREADS)
+    fh_out = bgzf.openWrite(infile + '.annot', compress, COMPRESS_THREADS,
+        COMPRESS_LEVEL)
+    fh_log = ann.CountLog(open(infile + '.count.log', 'w'))
+
+    logs = [fh_log] * len(STAGES)
+    for line in annotateLines(fh, format, engine, logs, announce_stages=True,
+        meters=meters):
+        fh_out.write(str(line) + '\n')
+
+    fh_log.close()
+    fh_out.close()
+    fh.close()
+
+    os.rename(infile + '.annot', annotatedFileName(infile, compress))
+
+
+"""Runs the fused pipeline on shards of the input in a pool of processes
+   The input is split in byte ranges at line boundaries: by runs of one
+   chromosome (Split=chrom) or in equal chunks (Split=bytes). Shards are
+   annotated concurrently and concatenated in their original order; the
+   per-stage counters of all shards are summed into a single .count.log.
+   Returns the lookup cache counters and the stage statistics, both summed
+   over the shards.
+   The shards are read from source (the plain text of infile if that is
+   compressed)
+"""
+def runParallel(infile, format, engine='sql', workers=WORKERS, split=SPLIT,
+    manifest=None, source=None, compress='none'):
+
+    source = source or infile
+    if (split == 'chrom'):
+        ranges = fu.columnAlignedRanges(source, workers)
+    else:
+        ranges = fu.lineAlignedRanges(source, workers)
+
+    with ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+        return runShards(infile, format, engine, ranges, pool, manifest,
+            source, compress)
+
+
+"""Runs the fused pipeline on shards of CheckpointBytes of the input, one
+   after the other in this process, so that each finished shard can be
+   recorded in the manifest (see runShards)
+"""
+def runCheckpointed(infile, format, engine, manifest,
+    shard_bytes=CHECKPOINT_BYTES, source=None, compress='none'):
+
+    source = source or infile
+    shards = max(1, -(-fu.fileSize(source) // shard_bytes))
+    return runShards(infile, format, engine,
+        fu.lineAlignedRanges(source, shards), None, manifest, source,
+        compress)
+
+
+"""Annotates the byte ranges of infile, in pool or else one by one, and
+   joins them into the annotated file and .count.log
+   With a manifest, every finished shard is recorded with its part file,
+   counters and statistics, and shards recorded by an earlier run whose
+   part file is intact are not annotated again; part files are then kept
+   until run() has removed the manifest, so a relaunch can resume from
+   them whatever happens before.
+   Ranges are of source; with compress='bgzf' each shard compresses its own
+   part, the parts joining into one BGZF file.
+   Returns the lookup cache counters and the stage statistics, both summed
+   over the shards.
+"""
+def runShards(infile, format, engine, ranges, pool=None, manifest=None,
+    source=None, compress='none'):
+
+    parts = [infile + '.part' + str(i) for i in range(len(ranges))]
+    results = [None] * len(ranges)
+    pending = {}
+
+    def finish(i, result):
+        results[i] = result
+        if manifest is not None:
+            start, end = ranges[i]
+            manifest.record(f"shard{start}-{end}", [parts[i]],
+                counts=result[0], stages=result[2])
+
+    try:
+        for i, ((start, end), part) in enumerate(zip(ranges, parts)):
+            entry = None
+            if manifest is not None:
+                entry = manifest.done(f"shard{start}-{end}")
+            if entry is not None:
+                results[i] = (entry['counts'], {}, entry['stages'])
+            elif pool is None:
+                finish(i, annotateShard(source or infile, format, engine,
+                    start, end, part, compress))
+            else:
+                pending[pool.submit(annotateShard, source or infile, format,
+                    engine, start, end, part, compress)] = i
+        for shard in as_completed(pending):
+            finish(pending[shard], shard.result())
+
+        bgzf.concat(parts, infile + '.annot', compress)
+    finally:
+        if manifest is None:
+            for part in parts:
+                fu.delete(part)
+
+    counts = [shard_counts for shard_counts, _, _ in results]
+    cache_stats = {}
+    for _, shard_stats, _ in results:
+        for name, count in shard_stats.items():
+            cache_stats[name] = cache_stats.get(name, 0) + count
+
+    fh_log = ann.CountLog(open(infile + '.count.log', 'w'))
+    for i, (label, _, _, _) in enumerate(STAGES):
+        for kind, name, stage_counts in ann.mergeCounts(
+            [shard_counts[i] for shard_counts in counts]):
+            fh_log.write(kind, name, stage_counts)
+        print(f"{label} - done.")
+    fh_log.close()
+
+    os.rename(infile + '.annot', annotatedFileName(infile, compress))
+    return cache_stats, sst.mergeRecords([stages for _, _, stages in results])
+
+
+"""Annotates the byte range [start, end) of infile into outfile
+   Runs in a worker process of runParallel (or in this process for
+   runCheckpointed); returns the counters recorded
+   by each stage, the lookup cache counters and the stage statistics of the
+   shard
+   With compress='bgzf' outfile is BGZF without its end-of-file block
+"""
+def annotateShard(infile, format, engine, start, end, outfile,
+    compress='none'):
+
+    cache = lc.getCache()
+    before = cache.stats() if cache is not None else {}
+
+    logs = [ann.CountLog() for _ in STAGES]
+    meters = [sst.StageMeter(STAGES[i][0], stageName(i))
+        for i in range(len(STAGES))]
+    with bgzf.openWrite(outfile, compress, COMPRESS_THREADS, COMPRESS_LEVEL,
+        eof=False) as fh_out:
+        for line in annotateLines(fu.readByteRange(infile, start, end),
+            format, engine, logs, meters=meters):
+            fh_out.write(str(line) + '\n')
+
+    cache_stats = {}
+    if cache is not None:
+        cache.flush()
+        cache_stats = {name: count - before[name]
+            for name, count in cache.stats().items()}
+    return [log.records for log in logs], cache_stats, \
+        [meter.record() for meter in meters]
+
+
+"""Reference table of stage i, the name it goes by in [backends]
+"""
+def stageTable(i):
+    _, _, stage, kwargs = STAGES[i]
+    return kwargs.get('table') or STAGE_TABLES[stage]
+
+
+"""(engine, database) serving stage i in fused mode
+   The [backends] entry of the stage's table reads engine or
+   engine/database; the engine defaults to engine and the database to the
+   [database] Backend
+"""
+def stageBackend(i, engine):
+    value = config.get('backends', stageTable(i), fallback='')
+    stage_engine, _, database = value.partition('/')
+    return stage_engine.strip() or engine, database.strip() or u.DB_BACKEND
+
+
+"""Passes lines through the chain of per-record stages, stage i recording
+   its counters in logs[i]
+   Lines are parsed once into vcf_record.VcfRecord by the first stage and
+   yielded as records (str() gives the annotated line); comment and header
+   lines are yielded as they are
+   With ConcurrentStages, stages of the same level of STAGE_INPUTS run side
+   by side (see stage_graph.runLevel)
+   Each stage is served by its backend (see stageBackend), engine being the
+   default; the sequential stages share one connection per database
+   meters[i], if given, gets the statistics of stage i
+"""
+def annotateLines(lines, format, engine, logs, announce_stages=False,
+    concurrent=CONCURRENT_STAGES, meters=None):
+
+    conns = {}
+    streams = []
+    wrap = announce if announce_stages else None
+
+    def cursorFor(stage_engine, database):
+        if (stage_engine == 'snapshot'):
+            return None
+        if database not in conns:
+            conn = u.db_acquire(database)
+            conns[database] = (conn, conn.cursor())
+        return conns[database][1]
+
+    try:
+        for level in sg.levels(STAGE_INPUTS):
+            backends = [stageBackend(i, engine) for i in level]
+            if meters:
+                for i, (stage_engine, database) in zip(level, backends):
+                    meters[i].backend = stage_engine if \
+                        (stage_engine == 'snapshot') else \
+                        stage_engine + '/' + database
+
+            if concurrent and (len(level) > 1):
+                stages = [(STAGES[i][0], logs[i]) for i in level]
+                level_meters = [meters[i] if meters else None for i in level]
+                branches = [openBranch(i, stage_engine, meter, database)
+                    for i, meter, (stage_engine, database) in zip(level,
+                        level_meters, backends)]
+                lines = sg.runLevel(lines, stages, branches, format, wrap,
+                    level_meters)
+                continue
+
+            for i, (stage_engine, database) in zip(level, backends):
+                lines = applyStage(i, lines, cursorFor(stage_engine,
+                    database), stage_engine, logs[i], format, streams,
+                    meters[i] if meters else None, database)
+                if wrap is not None:
+                    lines = wrap(lines, STAGES[i][0])
+
+        for line in lines:
+            yield line
+
+    finally:
+        closeStreams(streams)
+        for conn, _ in conns.values():
+            u.db_release(conn)
+
+
+"""Stage i of STAGES applied to lines, its lookups routed to engine
+   Sweeps opened for it on database are appended to streams (see
+   engineArgs); meter, if given, gets the statistics of the stage
+"""
+def applyStage(i, lines, cursor, engine, log, format, streams, meter=None,
+    database=None):
+    _, _, stage, kwargs = STAGES[i]
+    if meter is not None:
+        cursor = meter.cursor(cursor)
+    kwargs = dict(kwargs, **engineArgs(cursor, engine, stage, kwargs,
+        streams, database))
+    if isinstance(kwargs.get('index'), ix.VectorBatch):
+        lines = kwargs['index'].prefetch(lines)
+    cursor = lc.cachedCursor(cursor)
+    if meter is None:
+        return stage(lines, cursor, log, format=format, **kwargs)
+    meter.watch(cursor)
+    return meter.measure(stage(lines, cursor, log, format=format, **kwargs))
+
+
+"""Opens a connection for stage i of STAGES run in its own thread
+   Returns (apply, close): apply(lines, log, format) is the stage applied to
+   lines by applyStage, its engines opened on that connection; close()
+   closes the sweeps of the stage and releases the connection
+"""
+def openBranch(i, engine, meter=None, database=None):
+
+    conn = None
+    cursor = None
+    if (engine != 'snapshot'):
+        conn = u.db_acquire(database)
+        cursor = conn.cursor()
+
+    streams = []
+
+    def apply(lines, log, format):
+        return applyStage(i, lines, cursor, engine, log, format, streams,
+            meter, database)
+
+    def close():
+        closeStreams(streams)
+        if conn is not None:
+            u.db_release(conn)
+
+    return apply, close
+
+
+"""Closes the sweeps opened by engineArgs and releases their connections
+"""
+def closeStreams(streams):
+    for sweep, stream_conn in streams:
+        sweep.close()
+        u.db_release(stream_conn)
+
+
+"""Extra stage arguments routing the stage's reference lookups to an engine
+   Sweeps stream over their own pooled connection to database; (sweep,
+   connection) pairs are appended to streams so the caller can close and
+   release them
+"""
+def engineArgs(cursor, engine, stage, kwargs, streams, database=None):
+    table = kwargs.get('table')
+
+    if (engine == 'snapshot'):
+        snapshot = sn.getSnapshot(SNAPSHOT_DIR)
+        if stage is ann.iterSnpsFromDbSnp:
+            return {'index': snapshot.table('dbSNP')}
+        if stage is ann.iterBigRefGene:
+            return {'index': sn.SnapshotBigRefGene(snapshot)}
+        if (table == 'refGene'):
+            return {'index': snapshot.table('refGene'),
+                'cpg_index': snapshot.table('cpgIslandExt')}
+        return {'index': snapshot.table(table)}
+
+    if engine not in ('index', 'sweep', 'vector'):
+        return {}
+
+    if stage is ann.iterBigRefGene:
+        return {'index': ix.getBigRefGeneIndex(cursor)}
+
+    arg = 'index'
+    if (table == 'refGene'):
+        table = 'cpgIslandExt'
+        arg = 'cpg_index'
+    if table not in ix.RANGE_TABLES:
+        return {}
+
+    if (engine == 'index'):
+        return {arg: ix.getIndex(cursor, table)}
+
+    if (engine == 'vector'):
+        # CpG islands are only looked up for promoter hits, one at a time
+        if (arg == 'cpg_index'):
+            return {arg: ix.getVectorIndex(cursor, table)}
+        return {arg: ix.VectorBatch(ix.getVectorIndex(cursor, table), table)}
+
+    stream_conn = u.db_acquire(database)
+    sweep = ix.SweepIndex(ix.streamRangeTable(stream_conn, table),
+        lambda: ix.getIndex(cursor, table), name=table)
+    streams.append((sweep, stream_conn))
+    return {arg: sweep}
+
+
+"""Loads what the fused stages keep in memory for engine (the [pipeline]
+   Engine if None) - interval indexes, the snapshot - and opens a pooled
+   connection to every database they use, so that processes forked
+   afterwards (see worker_pool.py) start with them
+   Sweeps are not opened; their tables are streamed per run.
+"""
+def preload(engine=None):
+    if engine is None:
+        engine = config.get('pipeline', 'Engine', fallback='sql')
+    conns = {}
+    try:
+        conns[u.DB_BACKEND] = u.db_acquire(u.DB_BACKEND)
+        for i in range(len(STAGES)):
+            stage_engine, database = stageBackend(i, engine)
+            if (stage_engine == 'snapshot'):
+                engineArgs(None, stage_engine, STAGES[i][2], STAGES[i][3],
+                    [])
+                continue
+            if database not in conns:
+                conns[database] = u.db_acquire(database)
+            if stage_engine in ('index', 'vector'):
+                engineArgs(conns[database].cursor(), stage_engine,
+                    STAGES[i][2], STAGES[i][3], [], database)
+    finally:
+        for conn in conns.values():
+            u.db_release(conn)
+
+
+"""Passes records through and reports the stage once its input is exhausted
+"""
+def announce(lines, label):
+    for line in lines:
+        yield line
+    print(f"{label} - done.")
 
-### EOF
\ No newline at end of file
+### EOF
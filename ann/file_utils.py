@@ -19,6 +19,8 @@ import sys
 
 import itertools, operator
 
+import numpy as np
+
 """Execute command
 """
 def execute(com, debug=False):
@@ -228,6 +230,255 @@ def linecount(filename):
     return linenum
 
 
+"""Count the lines of a file that are not comments or headers
+"""
+def countRecords(filename, commentchar='#'):
+    with open(filename) as fh:
+        return sum([1 for line in fh if not line.startswith(commentchar)])
+
+
+"""Splits a file in at most n byte ranges [start, end) of roughly equal
+   size, each starting at the beginning of a line
+"""
+def lineAlignedRanges(filename, n):
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as fh:
+        for i in range(1, n):
+            fh.seek(max(size * i // n, bounds[-1]))
+            if (fh.tell() > 0):
+                fh.seek(fh.tell() - 1)
+                fh.readline()
+            if (fh.tell() > bounds[-1] and fh.tell() < size):
+                bounds.append(fh.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+"""Splits a file in byte ranges [start, end) that never cut a run of lines
+   with the same value in column c (the chromosome of a VCF); runs are
+   packed together until a range holds about 1/n of the file. Comment
+   lines stay with the lines that follow them.
+"""
+def columnAlignedRanges(filename, n, c=0, sep='\t', commentchar='#'):
+    size = os.path.getsize(filename)
+    target = max(1, size // n)
+    bounds = [0]
+    last = None
+    with open(filename, 'rb') as fh:
+        offset = 0
+        for line in fh:
+            if not line.startswith(commentchar.encode()):
+                value = line.split(sep.encode())[c].strip()
+                if (value != last and last is not None and
+                    offset - bounds[-1] >= target):
+                    bounds.append(offset)
+                last = value
+            offset = offset + len(line)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+"""Lines of the byte range [start, end) of a file, start and end being at
+   the beginning of a line
+"""
+def readByteRange(filename, start, end):
+    with open(filename, 'rb') as fh:
+        fh.seek(start)
+        offset = start
+        while (offset < end):
+            line = fh.readline()
+            if not line:
+                break
+            offset = offset + len(line)
+            yield line.decode('utf-8')
+
+
+"""A chunk of data lines held as one bytes buffer plus NumPy arrays
+
+   chroms holds, per line, the index in chrom_names of its chromosome
+   (written without the "chr" prefix, the list is shared by the chunks of
+   a reader so codes are stable across chunks); pos the positions as
+   int64. lines, ref, alt and info are (n, 2) int64 arrays of [start, end)
+   offsets into buffer; a missing column is an empty range at the end of
+   its line.
+"""
+class ColumnChunk(object):
+
+    __slots__ = ('buffer', 'chrom_names', 'chroms', 'pos', 'lines', 'ref',
+        'alt', 'info')
+
+    def __init__(self, buffer, chrom_names, chroms, pos, lines, ref, alt,
+        info):
+        self.buffer = buffer
+        self.chrom_names = chrom_names
+        self.chroms = chroms
+        self.pos = pos
+        self.lines = lines
+        self.ref = ref
+        self.alt = alt
+        self.info = info
+
+    def __len__(self):
+        return len(self.pos)
+
+    def field(self, offsets, i):
+        return self.buffer[offsets[i, 0]:offsets[i, 1]]
+
+    def line(self, i):
+        return self.field(self.lines, i).decode('utf-8')
+
+    """Lines of the chunk, without line terminators, for the per-record
+       stages
+    """
+    def iterLines(self):
+        for i in range(len(self)):
+            yield self.line(i)
+
+
+"""Decimal value of the [start, end) byte ranges of buf (a uint8 array) and
+   whether each range is a non-empty run of digits
+"""
+def parseInts(buf, starts, ends):
+    lengths = ends - starts
+    valid = (lengths > 0) & (lengths < 19)
+    lengths = np.where(valid, lengths, 0)
+    total = int(lengths.sum())
+    values = np.zeros(len(starts), dtype=np.int64)
+    if (total == 0):
+        return values, valid
+
+    # one entry per digit: its offset in buf and its power of ten
+    firsts = np.cumsum(lengths) - lengths
+    rank = np.arange(total, dtype=np.int64) - np.repeat(firsts, lengths)
+    idx = np.repeat(starts, lengths) + rank
+    digits = buf[idx].astype(np.int64) - 48
+    exps = np.repeat(lengths, lengths) - 1 - rank
+    terms = digits * (np.int64(10) ** exps)
+
+    nondigit = (digits < 0) | (digits > 9)
+    line_of = np.repeat(np.arange(len(starts)), lengths)
+    valid[np.unique(line_of[nondigit])] = False
+    nonempty = lengths > 0
+    values[nonempty] = np.add.reduceat(terms, firsts[nonempty])
+    return values, valid
+
+
+"""Codes of the [start, end) byte ranges of buf (a uint8 array) as indices
+   in names, adding names not seen yet; a "chr" prefix is dropped
+"""
+def chromCodes(buf, starts, ends, names, codes):
+    lengths = ends - starts
+    prefixed = (lengths >= 3) & (buf[starts] == ord('c')) & \
+        (buf[np.minimum(starts + 1, len(buf) - 1)] == ord('h')) & \
+        (buf[np.minimum(starts + 2, len(buf) - 1)] == ord('r'))
+    starts = np.where(prefixed, starts + 3, starts)
+    lengths = ends - starts
+    width = max(1, int(lengths.max()) if len(lengths) > 0 else 1)
+
+    cols = np.arange(width)
+    matrix = buf[np.minimum(starts[:, None] + cols, len(buf) - 1)]
+    matrix = np.where(cols < lengths[:, None], matrix, 0).astype(np.uint8)
+    keys = np.ascontiguousarray(matrix).view(f"S{width}").ravel()
+    unique, inverse = np.unique(keys, return_inverse=True)
+
+    lookup = np.empty(len(unique), dtype=np.int32)
+    for k, key in enumerate(unique):
+        name = key.decode('utf-8')
+        if name not in codes:
+            codes[name] = len(names)
+            names.append(name)
+        lookup[k] = codes[name]
+    return lookup[inverse.ravel()]
+
+
+"""Reads a VCF (or pileup) file in chunks of about chunk_size bytes
+
+   Yields header and comment lines, and lines whose position is not an
+   integer, as strings without their line terminator, and runs of data
+   lines as ColumnChunk, in file order. Columns are found with NumPy over
+   the whole chunk, no line is split in Python.
+"""
+def readColumnar(filename, format='vcf', chunk_size=1 << 22, sep='\t',
+    commentchar='#'):
+
+    # as annotate.getFormatSpecificIndices
+    ref_col, alt_col = (3, 4) if (format == 'vcf') else (2, 3)
+    info_col = 7
+    names = []
+    codes = {}
+
+    with open(filename, 'rb') as fh:
+        while True:
+            data = fh.read(chunk_size)
+            if not data:
+                break
+            if not data.endswith(b'\n'):
+                data = data + fh.readline()
+            if not data.endswith(b'\n'):
+                data = data + b'\n'
+
+            for item in parseChunk(data, ref_col, alt_col, info_col,
+                ord(sep), ord(commentchar), names, codes):
+                yield item
+
+
+"""Splits one buffer of whole lines into pass-through lines and ColumnChunk
+"""
+def parseChunk(data, ref_col, alt_col, info_col, sep, commentchar, names,
+    codes):
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buf == 10)
+    starts = np.concatenate(([0], ends[:-1] + 1)).astype(np.int64)
+    ends = ends.astype(np.int64)
+    # drop \r of \r\n line terminators
+    ends = ends - ((ends > starts) & (buf[np.maximum(ends - 1, 0)] == 13))
+
+    # [start, end) of the first info_col + 1 columns of every line
+    tabs = np.flatnonzero(buf == sep).astype(np.int64)
+    firsts = np.searchsorted(tabs, starts)
+    counts = np.searchsorted(tabs, ends) - firsts
+    # lookups past the last tab of a line are masked, keep them in bounds
+    tabs = np.append(tabs, len(buf))
+
+    def column(c):
+        if (c == 0):
+            lo = starts
+        else:
+            lo = np.where(counts >= c,
+                tabs[np.minimum(firsts + c - 1, len(tabs) - 1)] + 1, ends)
+        hi = np.where(counts > c,
+            tabs[np.minimum(firsts + c, len(tabs) - 1)], ends)
+        return lo, np.maximum(lo, np.minimum(hi, ends))
+
+    chrom_lo, chrom_hi = column(0)
+    pos_lo, pos_hi = column(1)
+    pos, valid = parseInts(buf, pos_lo, pos_hi)
+    valid = valid & (buf[starts] != commentchar) & (counts > 0)
+
+    def offsets(c):
+        lo, hi = column(c)
+        return np.stack((lo, hi), axis=1)
+
+    lines = np.stack((starts, ends), axis=1)
+    ref = offsets(ref_col)
+    alt = offsets(alt_col)
+    info = offsets(info_col)
+
+    # runs of data lines between pass-through lines
+    i = 0
+    for j in list(np.flatnonzero(~valid)) + [len(starts)]:
+        if (j > i):
+            chroms = chromCodes(buf, chrom_lo[i:j], chrom_hi[i:j], names,
+                codes)
+            yield ColumnChunk(data, names, chroms, pos[i:j], lines[i:j],
+                ref[i:j], alt[i:j], info[i:j])
+        if (j < len(starts)):
+            yield data[starts[j]:ends[j]].decode('utf-8')
+        i = j + 1
+
+
 """Saves list of rows and columns in a text file
 """
 def save2txt(read_data, txtfile, compress=False, debug=True):
@@ -0,0 +1,605 @@
+# interval_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Stabbing indexes (in-memory, vectorized and sorted sweep) for the UCSC
+# range tables and the bigRefGene tables
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right, insort
+
+import numpy as np
+
+import annotate as ann
+import lookup_cache as lc
+import utils as u
+import vcf_record as vr
+
+"""Range tables that can be served from memory:
+   table -> (select list, chromosome column, start column, end column)
+   tfbsConsSites is split in one table per chromosome (see TFBS_CHROMS)
+"""
+RANGE_TABLES = {
+    'cytoBand': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'cpgIslandExt': ('chrom, chromStart, chromEnd, name', 'chrom',
+        'chromStart', 'chromEnd'),
+    'gadAll': ('*', 'chromosome', 'chromStart', 'chromEnd'),
+    'hugo': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'targetScanS': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'tfbsConsSites': ('chrom, chromStart, chromEnd, name', None,
+        'chromStart', 'chromEnd'),
+}
+
+"""Range tables queried with the chromosome without its "chr" prefix
+   (VcfRecord.code); the other tables are queried with it (VcfRecord.ucsc)
+"""
+CODE_CHROM_TABLES = ('gadAll', 'tfbsConsSites')
+
+TFBS_CHROMS = ['1','2','3','4','5','6','7','8','9','10','11','12','13',
+    '14','15','16','17','18','19','20','21','22','X','Y']
+
+"""Intervals per block of blockMaxima
+"""
+BLOCK = 32
+
+# Indexes already loaded by this worker process, keyed by table name
+_indexes = {}
+lc.onVersionChange(_indexes.clear)
+
+
+"""Array of values padded with INT64_MIN to whole blocks of BLOCK
+"""
+def padBlocks(values):
+    pad = -len(values) % BLOCK
+    return np.concatenate([values,
+        np.full(pad, np.iinfo(np.int64).min, dtype=np.int64)])
+
+
+"""Maxima of ends (sorted by start) over blocks of BLOCK intervals, then
+   over blocks of BLOCK of those and so on up to a single block, as a list
+   of int64 arrays from the finest level up
+"""
+def blockMaxima(ends):
+    values = np.frombuffer(ends, dtype=np.int64) \
+        if not isinstance(ends, np.ndarray) else ends
+    levels = []
+    while True:
+        values = padBlocks(values).reshape(-1, BLOCK).max(axis=1)
+        levels.append(values)
+        if (len(values) <= 1):
+            return levels
+
+
+"""Last block b' <= b of the finest level of blocks (see blockMaxima) whose
+   maximum end reaches lo; there has to be one
+   Goes up a level at the first block of a group and down again at the
+   first group that reaches lo, so whole groups are skipped at once
+"""
+def previousBlock(blocks, b, lo):
+    level = 0
+    while (blocks[level][b] < lo):
+        if (b % BLOCK):
+            b = b - 1
+        else:
+            level = level + 1
+            b = b // BLOCK - 1
+    while (level > 0):
+        level = level - 1
+        b = b * BLOCK + BLOCK - 1
+        while (blocks[level][b] < lo):
+            b = b - 1
+    return b
+
+
+"""Indices i <= j, last first, of the intervals (sorted by start) whose end
+   reaches lo
+   maxends, the running maximum of ends, stops the walk once no earlier
+   interval reaches lo; blocks (see blockMaxima) let it skip the blocks in
+   between that hold none, so one long interval early on does not make
+   every later query scan back to it
+"""
+def reachBack(ends, maxends, blocks, j, lo):
+    hits = []
+    while (j >= 0) and (maxends[j] >= lo):
+        b = j // BLOCK
+        if (blocks[0][b] >= lo):
+            for i in range(j, b * BLOCK - 1, -1):
+                if (maxends[i] < lo):
+                    return hits
+                if (ends[i] >= lo):
+                    hits.append(i)
+        j = b * BLOCK - 1
+        if (j >= 0) and (maxends[j] >= lo):
+            j = previousBlock(blocks, b - 1, lo) * BLOCK + BLOCK - 1
+    return hits
+
+
+"""Per-chromosome interval index answering "start <= pos <= end" queries
+
+   Intervals of each chromosome are sorted by start and carry a running
+   maximum of their ends and the maxima of their ends per block (see
+   blockMaxima), so a query bisects the starts and walks back only to the
+   earlier intervals that can still reach the position (see reachBack).
+   Matching rows are returned in the order they were added, i.e. the order
+   of the table.
+"""
+class IntervalIndex(object):
+
+    def __init__(self):
+        self.pending = {}
+        self.chroms = {}
+        self.size = 0
+
+    def add(self, chrom, start, end, row):
+        self.pending.setdefault(chrom, []).append(
+            (int(start), int(end), self.size, row))
+        self.size = self.size + 1
+
+    def build(self):
+        for chrom, entries in self.pending.items():
+            entries.sort(key=lambda e: e[0])
+            starts = array('q', [e[0] for e in entries])
+            ends = array('q', [e[1] for e in entries])
+            maxends = array('q', ends)
+            for i in range(1, len(maxends)):
+                if maxends[i] < maxends[i - 1]:
+                    maxends[i] = maxends[i - 1]
+            blocks = blockMaxima(ends)
+            order = array('q', [e[2] for e in entries])
+            rows = [e[3] for e in entries]
+            self.chroms[chrom] = (starts, ends, maxends, blocks, order, rows)
+        self.pending = {}
+        return self
+
+    def stab(self, chrom, pos):
+        entry = self.chroms.get(chrom)
+        if entry is None:
+            return []
+        starts, ends, maxends, blocks, order, rows = entry
+        hits = reachBack(ends, maxends, blocks, bisect_right(starts, pos) - 1,
+            pos)
+        if len(hits) > 1:
+            hits.sort(key=lambda h: order[h])
+        return [rows[h] for h in hits]
+
+    def first(self, chrom, pos):
+        hits = self.stab(chrom, pos)
+        if (len(hits) > 0):
+            return hits[0]
+        return None
+
+
+"""Merge-join of coordinate-sorted variants against a range table
+
+   rowsFor(chrom) yields (start, end, ordinal, row) for one chromosome
+   ordered by start, ordinal being the position of the row in the table.
+   Intervals enter an active set once the sweep passes their start and
+   leave it, off a heap keyed by end, once it passes their end, so each row
+   is handled a constant number of times (plus a bisect into the active
+   ordinals). Rows are returned in table order, as IntervalIndex.stab
+   returns them; the list is reused until the active set changes and is
+   not to be modified. A query that goes back in position, or returns to a
+   chromosome already left, means the input is not sorted: the sweep then
+   hands over to the IntervalIndex built by fallback() for the rest of the
+   job.
+"""
+class SweepIndex(object):
+
+    def __init__(self, rowsFor, fallback, name='sweep'):
+        self.name = name
+        self.rowsFor = rowsFor
+        self.fallback = fallback
+        self.index = None
+        self.rows = None
+        self.chrom = None
+        self.pos = None
+        self.seen = set()
+        self.upcoming = None
+        self.reset()
+
+    def reset(self):
+        self.ends = []
+        self.ordinals = []
+        self.active = {}
+        self.hits = []
+
+    def stab(self, chrom, pos):
+        if self.index is not None:
+            return self.index.stab(chrom, pos)
+
+        if (chrom != self.chrom):
+            if chrom in self.seen:
+                return self.unsorted(chrom, pos)
+            self.open(chrom)
+        elif (pos < self.pos):
+            return self.unsorted(chrom, pos)
+        self.pos = pos
+
+        changed = False
+        while self.upcoming is not None and self.upcoming[0] <= pos:
+            start, end, ordinal, row = self.upcoming
+            heapq.heappush(self.ends, (end, ordinal))
+            insort(self.ordinals, ordinal)
+            self.active[ordinal] = row
+            changed = True
+            self.upcoming = next(self.rows, None)
+        while self.ends and (self.ends[0][0] < pos):
+            _, ordinal = heapq.heappop(self.ends)
+            del self.ordinals[bisect_left(self.ordinals, ordinal)]
+            del self.active[ordinal]
+            changed = True
+        if changed:
+            self.hits = [self.active[o] for o in self.ordinals]
+        return self.hits
+
+    def first(self, chrom, pos):
+        hits = self.stab(chrom, pos)
+        if (len(hits) > 0):
+            return hits[0]
+        return None
+
+    def open(self, chrom):
+        self.close()
+        self.chrom = chrom
+        self.seen.add(chrom)
+        self.reset()
+        self.rows = iter(self.rowsFor(chrom))
+        self.upcoming = next(self.rows, None)
+
+    def unsorted(self, chrom, pos):
+        print(f"{self.name}: input is not coordinate-sorted at " + \
+            f"{chrom}:{pos}, switching to the interval index")
+        self.close()
+        self.index = self.fallback()
+        return self.index.stab(chrom, pos)
+
+    def close(self):
+        if self.rows is not None and hasattr(self.rows, 'close'):
+            self.rows.close()
+        self.rows = None
+        self.upcoming = None
+
+
+"""previousBlock for many (b, lo) at once, blocks being the levels of
+   blockMaxima padded with padBlocks and laid end to end in flat, level l
+   starting at offsets[l]
+   Every step looks at a whole group of BLOCK entries for each query
+"""
+def previousBlocks(flat, offsets, b, lo):
+    cols = np.arange(BLOCK)
+    found_b = np.empty(len(b), dtype=np.int64)
+    pending = np.arange(len(b))
+    level = np.zeros(len(b), dtype=np.int64)
+    while (len(pending) > 0):
+        group = b // BLOCK
+        values = flat[(offsets[level] + group * BLOCK)[:, None] + cols]
+        reach = (cols <= (b % BLOCK)[:, None]) & (values >= lo[:, None])
+        found = reach.any(axis=1)
+        last = group * BLOCK + BLOCK - 1 - np.argmax(reach[:, ::-1], axis=1)
+        done = found & (level == 0)
+        found_b[pending[done]] = last[done]
+        down = found & (level > 0)
+        b = np.where(down, last * BLOCK + BLOCK - 1, group - 1)
+        level = np.where(down, level - 1, level + 1)
+        pending, b, lo, level = pending[~done], b[~done], lo[~done], \
+            level[~done]
+    return found_b
+
+
+"""IntervalIndex answering batches of queries with NumPy
+
+   The sorted starts, ends, running maximum of ends and block maxima of
+   each chromosome are viewed as NumPy arrays. stabMany() resolves a batch
+   of positions with one searchsorted per chromosome, then walks back from
+   every match at once a block at a time, as reachBack does for one
+   position: the intervals of a block reaching a position are picked in one
+   step, and the blocks none of them reaches are skipped with
+   previousBlocks.
+"""
+class VectorIndex(object):
+
+    def __init__(self, index):
+        self.index = index
+        self.arrays = {}
+        for chrom, (starts, ends, maxends, blocks, order, rows) in \
+            index.chroms.items():
+            objects = np.empty(len(rows), dtype=object)
+            for i, row in enumerate(rows):
+                objects[i] = row
+            levels = [padBlocks(level) for level in blocks]
+            offsets = np.cumsum([0] + [len(level) for level in levels])
+            self.arrays[chrom] = (np.frombuffer(starts, dtype=np.int64),
+                padBlocks(np.frombuffer(ends, dtype=np.int64)),
+                np.frombuffer(maxends, dtype=np.int64),
+                np.concatenate(levels), offsets[:-1],
+                np.frombuffer(order, dtype=np.int64), objects)
+
+    def stab(self, chrom, pos):
+        return self.index.stab(chrom, pos)
+
+    def first(self, chrom, pos):
+        return self.index.first(chrom, pos)
+
+    """Rows overlapping each (chroms[i], positions[i])
+       Returns (offsets, rows): the rows stab() would return for query i
+       are rows[offsets[i]:offsets[i + 1]], in the same order
+    """
+    def stabMany(self, chroms, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        names, inverse = np.unique(np.asarray(chroms, dtype=str),
+            return_inverse=True)
+        cols = np.arange(BLOCK)
+
+        hit_queries = [np.zeros(0, dtype=np.int64)]
+        hit_order = [np.zeros(0, dtype=np.int64)]
+        hit_rows = [np.zeros(0, dtype=object)]
+        for k, chrom in enumerate(names.tolist()):
+            entry = self.arrays.get(chrom)
+            if entry is None:
+                continue
+            starts, ends, maxends, blocks, offsets, order, rows = entry
+            queries = np.flatnonzero(inverse == k)
+            pos = positions[queries]
+
+            active = np.arange(len(queries))
+            j = np.searchsorted(starts, pos, side='right') - 1
+            while (len(active) > 0):
+                reach = j >= 0
+                reach[reach] = maxends[j[reach]] >= pos[active[reach]]
+                active = active[reach]
+                j = j[reach]
+                lo = pos[active]
+
+                # the intervals of j's block up to j that reach the position
+                b = j // BLOCK
+                members = (b * BLOCK)[:, None] + cols
+                hit = (cols <= (j - b * BLOCK)[:, None]) & \
+                    (ends[members] >= lo[:, None])
+                query, col = np.nonzero(hit)
+                hit_queries.append(queries[active[query]])
+                hit_order.append(order[members[query, col]])
+                hit_rows.append(rows[members[query, col]])
+
+                # on to the last earlier block with an interval reaching it
+                j = b * BLOCK - 1
+                reach = j >= 0
+                reach[reach] = maxends[j[reach]] >= lo[reach]
+                active = active[reach]
+                b = previousBlocks(blocks, offsets, b[reach] - 1, lo[reach])
+                j = b * BLOCK + BLOCK - 1
+
+        hit_queries = np.concatenate(hit_queries)
+        ranked = np.lexsort((np.concatenate(hit_order), hit_queries))
+        offsets = np.searchsorted(hit_queries[ranked],
+            np.arange(len(positions) + 1))
+        return offsets, np.concatenate(hit_rows)[ranked]
+
+
+"""Per-stage view of a VectorIndex fed by prefetch()
+
+   prefetch() passes the records of a stage through in blocks, resolving
+   the positions of each block with one stabMany() before the stage reads
+   them; stab() and first() then answer from that block and fall back to
+   the index for anything else.
+"""
+class VectorBatch(object):
+
+    def __init__(self, index, table, block=4096):
+        self.index = index
+        self.block = block
+        self.chrom = 'code' if table in CODE_CHROM_TABLES else 'ucsc'
+        self.queries = {}
+        self.offsets = None
+        self.rows = None
+
+    def prefetch(self, records):
+        pending = []
+        for record in records:
+            pending.append(record)
+            if (len(pending) >= self.block):
+                yield from self.resolve(pending)
+                pending = []
+        yield from self.resolve(pending)
+
+    def resolve(self, pending):
+        keys = [(getattr(r, self.chrom), r.pos) for r in pending
+            if isinstance(r, vr.VcfRecord)]
+        offsets, rows = self.index.stabMany(
+            [k[0] for k in keys], [k[1] for k in keys])
+        self.offsets = offsets.tolist()
+        self.rows = rows.tolist()
+        self.queries = dict(zip(keys, range(len(keys))))
+        return pending
+
+    def stab(self, chrom, pos):
+        q = self.queries.get((chrom, pos))
+        if q is None:
+            return self.index.stab(chrom, pos)
+        return self.rows[self.offsets[q]:self.offsets[q + 1]]
+
+    def first(self, chrom, pos):
+        hits = self.stab(chrom, pos)
+        if (len(hits) > 0):
+            return hits[0]
+        return None
+
+
+"""The three bigRefGene tables answered with one in-memory probe
+
+   chrom_pos_equal_base and chrom_pos_equal_nobase are hashed on (CHR,
+   start); chrom_pos_unequal is an IntervalIndex on start <= pos <= end.
+   lookup() applies the precedence of the queries it replaces: rows of
+   chrom_pos_equal_base with matching (or complementary) alleles, else rows
+   of chrom_pos_equal_nobase, else rows of chrom_pos_unequal, each in table
+   order. Every row is held with its INFO fragment, rendered when the index
+   is loaded; fragments() returns those of the rows lookup() would return.
+"""
+class BigRefGeneIndex(object):
+
+    def __init__(self, ref_ind, alt_ind):
+        self.base = {}
+        self.nobase = {}
+        self.unequal = IntervalIndex()
+        self.alleles = (ref_ind, alt_ind)
+
+    def entries(self, chr, pos, ref, alt, compRef, compAlt):
+        ref_ind, alt_ind = self.alleles
+        entries = [e for e in self.base.get((chr, pos), [])
+            if (e[0][ref_ind], e[0][alt_ind]) in ((ref, alt), (compRef, compAlt))]
+        if (len(entries) > 0):
+            return entries
+        entries = self.nobase.get((chr, pos), [])
+        if (len(entries) > 0):
+            return entries
+        return self.unequal.stab(chr, pos)
+
+    def lookup(self, chr, pos, ref, alt, compRef, compAlt):
+        return [row for row, _ in self.entries(chr, pos, ref, alt, compRef,
+            compAlt)]
+
+    def fragments(self, chr, pos, ref, alt, compRef, compAlt):
+        return [fragment for _, fragment in self.entries(chr, pos, ref, alt,
+            compRef, compAlt)]
+
+
+"""Loads the bigRefGene tables into a BigRefGeneIndex
+"""
+def loadBigRefGene(cursor):
+    cursor.execute('select * from chrom_pos_equal_base;')
+    rows = cursor.fetchall()
+    names = [d[0] for d in cursor.description]
+    index = BigRefGeneIndex(names.index('haplotypeReference'),
+        names.index('haplotypeAlternate'))
+
+    for table, entries in (('chrom_pos_equal_base', index.base),
+        ('chrom_pos_equal_nobase', index.nobase)):
+        if (table != 'chrom_pos_equal_base'):
+            cursor.execute('select * from ' + table + ';')
+            rows = cursor.fetchall()
+            names = [d[0] for d in cursor.description]
+        chr_ind = names.index('CHR')
+        start_ind = names.index('start')
+        for row in rows:
+            entries.setdefault((str(row[chr_ind]), int(row[start_ind])),
+                []).append((row, ann.refSeqFragment(row)))
+
+    cursor.execute('select * from chrom_pos_unequal;')
+    rows = cursor.fetchall()
+    names = [d[0] for d in cursor.description]
+    chr_ind = names.index('CHR')
+    start_ind = names.index('start')
+    end_ind = names.index('end')
+    for row in rows:
+        index.unequal.add(str(row[chr_ind]), row[start_ind], row[end_ind],
+            (row, ann.refSeqFragment(row)))
+    index.unequal.build()
+    return index
+
+
+"""Returns rowsFor(chrom) for SweepIndex, streaming one chromosome of a range
+   table at a time from the database, ordered by start, through an unbuffered
+   cursor. conn should not be used for anything else while streaming.
+   Every row is numbered in table order before the sort (row_number() over
+   the row key of u.db_row_key), the order the other engines return rows
+   in. On MySQL this needs window functions (MySQL 8) and the RowKey
+   primary key on every range table.
+"""
+def streamRangeTable(conn, table):
+    columns, chrom_col, start_col, end_col = RANGE_TABLES[table]
+
+    def rowsFor(chrom):
+        if (chrom_col is None):
+            if chrom not in TFBS_CHROMS:
+                return
+            source = table + chrom
+            where = ''
+        else:
+            source = table
+            where = ' where ' + chrom_col + '="' + str(chrom) + '"'
+        select = source + '.*' if (columns == '*') else columns
+        sql = 'select row_number() over (order by ' + source + '.' + \
+            u.db_row_key(conn) + ') as sweep_ordinal, ' + select + \
+            ' from ' + source + where + ' order by ' + start_col + \
+            ', sweep_ordinal;'
+
+        cursor = u.db_stream_cursor(conn)
+        try:
+            cursor.execute(sql)
+            names = [d[0] for d in cursor.description][1:]
+            start_ind = names.index(start_col)
+            end_ind = names.index(end_col)
+            for row in cursor:
+                ordinal = row[0]
+                row = row[1:]
+                yield (int(row[start_ind]), int(row[end_ind]), ordinal, row)
+        finally:
+            cursor.close()
+
+    return rowsFor
+
+
+"""Loads one range table into an IntervalIndex
+"""
+def loadRangeTable(cursor, table):
+    columns, chrom_col, start_col, end_col = RANGE_TABLES[table]
+    index = IntervalIndex()
+
+    if (chrom_col is None):
+        # one table per chromosome, rows are keyed by the table suffix
+        for chrom in TFBS_CHROMS:
+            cursor.execute('select ' + columns + ' from ' + table + chrom + ';')
+            rows = cursor.fetchall()
+            names = [d[0] for d in cursor.description]
+            start_ind = names.index(start_col)
+            end_ind = names.index(end_col)
+            for row in rows:
+                index.add(chrom, row[start_ind], row[end_ind], row)
+        return index.build()
+
+    cursor.execute('select ' + columns + ' from ' + table + ';')
+    rows = cursor.fetchall()
+    names = [d[0] for d in cursor.description]
+    chrom_ind = names.index(chrom_col)
+    start_ind = names.index(start_col)
+    end_ind = names.index(end_col)
+    for row in rows:
+        index.add(str(row[chrom_ind]), row[start_ind], row[end_ind], row)
+    return index.build()
+
+
+"""Returns the index for a table, loading it on first use in this worker
+"""
+def getIndex(cursor, table):
+    if table not in _indexes:
+        _indexes[table] = loadRangeTable(cursor, table)
+    return _indexes[table]
+
+
+"""Returns the VectorIndex for a table, loading it on first use in this
+   worker
+"""
+def getVectorIndex(cursor, table):
+    key = 'vector:' + table
+    if key not in _indexes:
+        _indexes[key] = VectorIndex(getIndex(cursor, table))
+    return _indexes[key]
+
+
+"""Returns the BigRefGeneIndex, loading it on first use in this worker
+"""
+def getBigRefGeneIndex(cursor):
+    if 'bigRefGene' not in _indexes:
+        _indexes['bigRefGene'] = loadBigRefGene(cursor)
+    return _indexes['bigRefGene']
+
+### EOF
@@ -0,0 +1,274 @@
+# job_scheduler.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Admission control for the annotation jobs of annotator.py: jobs wait in a
+# local run queue and are started only when their estimated demand of CPU
+# slots, memory and reference database connections fits in what is left of
+# the instance's budgets
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import math
+import subprocess
+import collections
+
+import bgzf
+import driver
+import utils as u
+import stage_graph as sg
+import worker_pool as wp
+
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read('ann_config.ini')
+
+CPU_SLOTS = config.getint('scheduler', 'CpuSlots', fallback=0)
+MEMORY_MB = config.getint('scheduler', 'MemoryMB', fallback=0)
+DB_CONNECTIONS = config.getint('scheduler', 'DbConnections', fallback=0)
+BASE_MEMORY_MB = config.getfloat('scheduler', 'BaseMemoryMB', fallback=256)
+MEMORY_PER_INPUT_MB = config.getfloat('scheduler', 'MemoryPerInputMB',
+    fallback=2)
+COMPRESSION_RATIO = config.getfloat('scheduler', 'CompressionRatio',
+    fallback=5)
+
+"""Resources a job holds while it runs: CPU slots, memory (MB) and
+   reference database connections
+"""
+Demand = collections.namedtuple('Demand', ['cpu', 'memory', 'connections'])
+
+
+"""Memory budget (MB) when none is configured: 80% of physical memory
+"""
+def defaultMemory():
+    try:
+        pages = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 0
+    return 0.8 * pages / (1 << 20)
+
+
+"""Size in MB of the text of infile, compressed input counted
+   COMPRESSION_RATIO times its size
+"""
+def inputSize(infile):
+    if (infile is None) or not os.path.exists(infile):
+        return 0
+    size = os.path.getsize(infile) / (1 << 20)
+    if bgzf.isCompressed(infile):
+        size = size * COMPRESSION_RATIO
+    return size
+
+
+"""Database connections one annotating process opens at once with the
+   [pipeline] and [backends] settings: one per database of its stages, one
+   per concurrent branch beyond the first, and one per sweep
+"""
+def connectionsPerProcess(engine, fused):
+    if not fused:
+        return 1
+    backends = [driver.stageBackend(i, engine)
+        for i in range(len(driver.STAGES))]
+    connections = len(set(database for stage_engine, database in backends
+        if (stage_engine != 'snapshot')))
+    if driver.CONCURRENT_STAGES:
+        connections = connections + max(len(level) - 1
+            for level in sg.levels(driver.STAGE_INPUTS))
+    return connections + sum(1 for stage_engine, _ in backends
+        if (stage_engine == 'sweep'))
+
+
+"""Pooled connections a resident worker, and the annotator that forked it,
+   keep open between jobs after driver.preload: one per database the
+   pipeline uses
+"""
+def residentConnections():
+    engine = config.get('pipeline', 'Engine', fallback='sql')
+    return len(set([u.DB_BACKEND] + [database
+        for stage_engine, database in [driver.stageBackend(i, engine)
+            for i in range(len(driver.STAGES))]
+        if (stage_engine != 'snapshot')]))
+
+
+"""Number of resident workers for workers (0: one per core), lowered so
+   that the connections they and the annotator keep open (see
+   residentConnections) fit in the db_connections budget
+"""
+def poolSize(workers, db_connections=DB_CONNECTIONS):
+    workers = workers or os.cpu_count()
+    if db_connections:
+        workers = min(workers,
+            max(1, db_connections // residentConnections() - 1))
+    return workers
+
+
+"""Estimated demand of annotating infile (None: an input of no size)
+   A parallel run takes up to Workers CPU slots, one per shard of
+   CheckpointBytes of input, and the connections of each; memory grows
+   with the size of the input
+   resident is the number of connections the process running the job
+   already holds; a run in that process reuses them, parallel shards open
+   their own
+"""
+def estimateDemand(infile=None, resident=0):
+    fused = config.getboolean('pipeline', 'Fused', fallback=True)
+    engine = config.get('pipeline', 'Engine', fallback='sql')
+    parallel = config.getboolean('pipeline', 'Parallel', fallback=False)
+    size = inputSize(infile)
+
+    cpu = 1
+    if parallel:
+        shard_mb = driver.CHECKPOINT_BYTES / (1 << 20)
+        cpu = max(1, min(driver.WORKERS, math.ceil(size / shard_mb)))
+    connections = cpu * connectionsPerProcess(engine, fused or parallel)
+    if not parallel:
+        connections = max(0, connections - resident)
+    return Demand(cpu, BASE_MEMORY_MB + MEMORY_PER_INPUT_MB * size,
+        connections)
+
+
+"""Runs jobs through pool (a worker_pool.WorkerPool), or as
+   python run_file <args> when pool is None, admitting them in the order
+   they were submitted while their demand fits in the budgets
+   Budgets of 0 are the number of cores (cpu_slots), 80% of physical
+   memory (memory_mb) and no limit (db_connections). A job larger than a
+   budget is started alone once nothing else runs.
+   The connections the workers of pool and this process keep open between
+   jobs are taken off the db_connections budget for good.
+   on_launch, if given, is called with every job (a worker_pool.Job) once
+   it is started.
+   poll() has to be called regularly to collect finished jobs and start
+   queued ones.
+"""
+class Scheduler(object):
+
+    def __init__(self, cpu_slots=CPU_SLOTS, memory_mb=MEMORY_MB,
+        db_connections=DB_CONNECTIONS, pool=None, run_file=None,
+        on_launch=None):
+        self.budget = Demand(cpu_slots or os.cpu_count(),
+            memory_mb or defaultMemory(), db_connections)
+        self.pool = pool
+        self.run_file = run_file
+        self.on_launch = on_launch
+        self.queue = collections.deque()
+        self.running = {}
+        self.processes = {}
+        self.resident = 0
+        reserved = 0
+        if pool is not None:
+            self.resident = residentConnections()
+            reserved = (pool.size + 1) * self.resident
+        self.used = Demand(0, 0, reserved)
+        self.smallest = estimateDemand(resident=self.resident)
+
+    """Queues a job annotating infile, to be run in cwd with args, and
+       starts what fits
+    """
+    def submit(self, job_id, cwd, args, infile):
+        demand = estimateDemand(infile, self.resident)
+        self.queue.append((wp.Job(job_id, cwd, list(args)), demand))
+        print(f'Annotation job {job_id} queued ({demand.cpu} CPU, '
+            f'{demand.memory:.0f} MB, {demand.connections} connections)')
+        self.admit()
+
+    def fits(self, demand):
+        if not self.running:
+            return True
+        cpu, memory, connections = [used + need
+            for used, need in zip(self.used, demand)]
+        return (cpu <= self.budget.cpu) and \
+            ((not self.budget.memory) or (memory <= self.budget.memory)) and \
+            ((not self.budget.connections) or \
+                (connections <= self.budget.connections))
+
+    def workerFree(self):
+        return (self.pool is None) or (len(self.pool.idle()) > 0)
+
+    """Starts queued jobs, first come first served, while the next one fits
+    """
+    def admit(self):
+        while self.queue and self.workerFree() and \
+            self.fits(self.queue[0][1]):
+            job, demand = self.queue.popleft()
+            self.launch(job)
+            self.running[job.job_id] = demand
+            self.used = Demand(*[used + need
+                for used, need in zip(self.used, demand)])
+            if self.on_launch is not None:
+                self.on_launch(job)
+
+    """Ids of the jobs waiting in the run queue
+    """
+    def queued(self):
+        return [job.job_id for job, demand in self.queue]
+
+    def launch(self, job):
+        if self.pool is not None:
+            self.pool.submit(job.job_id, job.cwd, job.args)
+            return
+        self.processes[job.job_id] = (job, subprocess.Popen(["python",
+            self.run_file] + job.args, cwd=job.cwd))
+
+    def release(self, job_id):
+        demand = self.running.pop(job_id, None)
+        if demand is not None:
+            self.used = Demand(*[used - need
+                for used, need in zip(self.used, demand)])
+
+    """Collects the jobs that finished, waiting up to timeout seconds for
+       one, and starts queued jobs that now fit
+       Returns the finished jobs as (job, status, error)
+    """
+    def poll(self, timeout=0):
+        if self.pool is not None:
+            finished = self.pool.poll(timeout)
+        else:
+            finished = self.reap(timeout)
+        for job, status, error in finished:
+            self.release(job.job_id)
+        self.admit()
+        return finished
+
+    def reap(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            finished = []
+            for job_id, (job, process) in list(self.processes.items()):
+                if process.poll() is None:
+                    continue
+                del self.processes[job_id]
+                if (process.returncode == 0):
+                    finished.append((job, 'done', None))
+                else:
+                    finished.append((job, 'failed',
+                        f"exit status {process.returncode}"))
+            if finished or not self.processes or (time.time() >= deadline):
+                return finished
+            time.sleep(min(0.5, max(0, deadline - time.time())))
+
+    """True while jobs wait in the run queue or not even a job of the
+       smallest size would be admitted; no more jobs are to be taken then
+    """
+    def saturated(self):
+        return bool(self.queue) or not self.workerFree() or \
+            not self.fits(self.smallest)
+
+    """Number of jobs of the smallest size that would be admitted now
+    """
+    def capacity(self):
+        free = [total - used for total, used in zip(self.budget, self.used)]
+        counts = [free[0] // self.smallest.cpu]
+        if self.budget.memory:
+            counts.append(free[1] // self.smallest.memory)
+        if self.budget.connections and self.smallest.connections:
+            counts.append(free[2] // self.smallest.connections)
+        if self.pool is not None:
+            counts.append(len(self.pool.idle()))
+        # a job is admitted alone whatever its size
+        return max(0 if self.running else 1, int(min(counts)))
+
+### EOF
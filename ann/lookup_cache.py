@@ -0,0 +1,352 @@
+# lookup_cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Cross-job cache of reference database lookups
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from configparser import ConfigParser
+
+CONFIG_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+    'ann_config.ini')
+
+# The cache of this worker process, see getCache()
+_cache = None
+
+# The ReferenceVersion of the reference data held by this worker process,
+# and what empties the other caches of it (see onVersionChange)
+_version = None
+_resets = []
+
+
+"""Reads the [cache] settings; the file is read again on every call so a
+   new ReferenceVersion is picked up by long-lived workers
+"""
+def cacheConfig():
+    config = ConfigParser(os.environ)
+    config.read(CONFIG_FILE)
+    return {
+        'enabled': config.getboolean('cache', 'Enabled', fallback=False),
+        'max_entries': config.getint('cache', 'MaxEntries', fallback=100000),
+        'disk_store': config.get('cache', 'DiskStore', fallback=''),
+        'max_disk_entries': config.getint('cache', 'MaxDiskEntries',
+            fallback=1000000),
+        'version': config.get('cache', 'ReferenceVersion', fallback=''),
+    }
+
+
+"""Bounded least-recently-used cache of lookup results, optionally backed
+   by a DiskStore shared by the workers of the host
+   Entries belong to one version of the reference data; setVersion() with
+   another version drops them all.
+"""
+class LookupCache(object):
+
+    def __init__(self, max_entries, store=None, version=''):
+        self.max_entries = max_entries
+        self.store = store
+        self.version = version
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.store is not None:
+            self.store.reset(version)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits = self.hits + 1
+                return True, self.entries[key]
+
+        if self.store is not None:
+            found, value = self.store.get(key)
+            if found:
+                with self.lock:
+                    self.hits = self.hits + 1
+                    self.disk_hits = self.disk_hits + 1
+                    self.add(key, value)
+                return True, value
+
+        with self.lock:
+            self.misses = self.misses + 1
+        return False, None
+
+    def put(self, key, value):
+        with self.lock:
+            self.add(key, value)
+        if self.store is not None:
+            self.store.put(key, value)
+
+    # callers hold self.lock
+    def add(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while (len(self.entries) > self.max_entries):
+            self.entries.popitem(last=False)
+            self.evictions = self.evictions + 1
+
+    def setVersion(self, version):
+        if (version == self.version):
+            return
+        with self.lock:
+            self.entries.clear()
+            self.version = version
+        if self.store is not None:
+            self.store.reset(version)
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits,
+            'misses': self.misses, 'evictions': self.evictions}
+
+    def flush(self):
+        if self.store is not None:
+            self.store.flush()
+
+
+"""SQLite file holding lookup results for every worker process of a host
+   Writes are committed in batches; the oldest entries are dropped once
+   the file holds more than max_entries.
+"""
+class DiskStore(object):
+
+    def __init__(self, path, max_entries, commit_every=100):
+        self.path = path
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.conn = None
+        self.pid = None
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    # one connection per process, a forked worker opens its own
+    def connect(self):
+        if (self.pid != os.getpid()):
+            self.conn = sqlite3.connect(self.path, timeout=30,
+                check_same_thread=False)
+            self.conn.execute('pragma journal_mode=wal;')
+            self.conn.execute('create table if not exists lookups ' + \
+                '(key text primary key, value blob);')
+            self.conn.execute('create table if not exists meta ' + \
+                '(name text primary key, value text);')
+            self.conn.commit()
+            self.pid = os.getpid()
+            self.pending = 0
+        return self.conn
+
+    def get(self, key):
+        with self.lock:
+            row = self.connect().execute(
+                'select value from lookups where key = ?;', (key,)).fetchone()
+        if row is None:
+            return False, None
+        return True, pickle.loads(row[0])
+
+    def put(self, key, value):
+        with self.lock:
+            self.connect().execute(
+                'insert or replace into lookups values (?, ?);',
+                (key, pickle.dumps(value)))
+            self.pending = self.pending + 1
+            if (self.pending >= self.commit_every):
+                self.conn.commit()
+                self.pending = 0
+
+    def flush(self):
+        with self.lock:
+            conn = self.connect()
+            count = conn.execute('select count(*) from lookups;').fetchone()[0]
+            if (count > self.max_entries):
+                conn.execute('delete from lookups where rowid in (select ' + \
+                    'rowid from lookups order by rowid limit ?);',
+                    (count - self.max_entries,))
+            conn.commit()
+            self.pending = 0
+
+    def reset(self, version):
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute('select value from meta where name = ?;',
+                ('version',)).fetchone()
+            if row is None or (row[0] != version):
+                conn.execute('delete from lookups;')
+                conn.execute('insert or replace into meta values (?, ?);',
+                    ('version', version))
+                conn.commit()
+
+
+"""Name of the database a cursor reads from: the file of a SQLite
+   connection, the host, port and schema of a MySQL one
+"""
+def databaseName(cursor):
+    conn = getattr(cursor, 'connection', None)
+    if isinstance(conn, sqlite3.Connection):
+        for _, name, path in conn.execute('pragma database_list;'):
+            if (name == 'main'):
+                return 'sqlite:' + (path or f":memory:{id(conn)}")
+    if hasattr(conn, 'host'):
+        db = getattr(conn, 'db', None) or b''
+        if isinstance(db, bytes):
+            db = db.decode('utf-8')
+        return f"mysql:{conn.host}:{getattr(conn, 'port', '')}/{db}"
+    return type(conn).__name__
+
+
+"""Cursor putting a LookupCache in front of the reference lookups of a
+   stage (see fetchRows and fetchRowsMany)
+   A lookup is keyed by the database (see databaseName), the table and the
+   position looked up, (table, chrom, pos, ...), followed by whatever else
+   selects its rows (alleles, offsets); only the lookups the cache misses
+   go to the database, the rows of a batched statement being split per
+   key. Anything run through execute() is not cached.
+   hits and misses count the lookups of this cursor.
+"""
+class CachedCursor(object):
+
+    def __init__(self, cursor, cache, database=None):
+        self.cursor = cursor
+        self.cache = cache
+        self.database = database or databaseName(cursor)
+        self.hits = 0
+        self.misses = 0
+
+    def cacheKey(self, key):
+        return repr((self.database,) + tuple(key))
+
+    def lookup(self, key, sql):
+        found, rows = self.cache.get(self.cacheKey(key))
+        if found:
+            self.hits = self.hits + 1
+            return rows
+        self.misses = self.misses + 1
+        self.cursor.execute(sql)
+        rows = tuple(self.cursor.fetchall())
+        self.cache.put(self.cacheKey(key), rows)
+        return rows
+
+    def lookupMany(self, keys, sql, keyOf):
+        found = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            hit, rows = self.cache.get(self.cacheKey(key))
+            if hit:
+                self.hits = self.hits + 1
+                found[key] = rows
+            else:
+                self.misses = self.misses + 1
+                missing.append(key)
+
+        fetched = queryMany(self.cursor, missing, sql, keyOf)
+        for key, rows in fetched.items():
+            self.cache.put(self.cacheKey(key), rows)
+        found.update(fetched)
+        return found
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+
+"""Rows of one reference lookup: key is (table, chrom, pos, ...) and sql
+   the statement selecting its rows, run unless the cache in front of
+   cursor holds them
+"""
+def fetchRows(cursor, key, sql):
+    if isinstance(cursor, CachedCursor):
+        return cursor.lookup(key, sql)
+    cursor.execute(sql)
+    return tuple(cursor.fetchall())
+
+
+"""First row of a lookup (see fetchRows), or None
+"""
+def fetchRow(cursor, key, sql):
+    rows = fetchRows(cursor, key, sql)
+    return rows[0] if (len(rows) > 0) else None
+
+
+"""Rows of several lookups made with one statement: sql(keys) selects the
+   rows of keys and keyOf(names), given the column names of the result,
+   returns the function giving the key of a row
+   Returns {key: rows} for every key
+"""
+def fetchRowsMany(cursor, keys, sql, keyOf):
+    if isinstance(cursor, CachedCursor):
+        return cursor.lookupMany(keys, sql, keyOf)
+    return queryMany(cursor, list(dict.fromkeys(keys)), sql, keyOf)
+
+
+def queryMany(cursor, keys, sql, keyOf):
+    found = {key: [] for key in keys}
+    if (len(keys) > 0):
+        cursor.execute(sql(keys))
+        rowKey = keyOf([d[0] for d in cursor.description])
+        for row in cursor.fetchall():
+            key = rowKey(row)
+            if key in found:
+                found[key].append(row)
+    return {key: tuple(rows) for key, rows in found.items()}
+
+
+"""Registers reset(), called to empty a cache of reference data kept by
+   this worker process (interval indexes, transcripts, snapshots) when
+   ReferenceVersion changes
+"""
+def onVersionChange(reset):
+    _resets.append(reset)
+
+
+"""Empties the caches registered with onVersionChange if version is not the
+   one the data of this worker process was read for
+"""
+def checkVersion(version):
+    global _version
+    if (_version is not None) and (version != _version):
+        for reset in _resets:
+            reset()
+    _version = version
+
+
+"""Returns the cache of this worker process, or None if caching is off
+   The cache is kept across jobs and emptied when ReferenceVersion changes,
+   as are the caches registered with onVersionChange whether caching is on
+   or not.
+"""
+def getCache():
+    global _cache
+    settings = cacheConfig()
+    checkVersion(settings['version'])
+    if not settings['enabled']:
+        return None
+
+    if _cache is None:
+        store = None
+        if settings['disk_store']:
+            store = DiskStore(settings['disk_store'],
+                settings['max_disk_entries'])
+        _cache = LookupCache(settings['max_entries'], store=store,
+            version=settings['version'])
+    else:
+        _cache.setVersion(settings['version'])
+    return _cache
+
+
+"""Puts the cache of this worker process, if any, in front of cursor
+"""
+def cachedCursor(cursor):
+    if (_cache is None) or (cursor is None):
+        return cursor
+    return CachedCursor(cursor, _cache)
+
+### EOF
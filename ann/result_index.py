@@ -0,0 +1,281 @@
+# result_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Random-access index of an annotated file, written as a JSON sidecar: the
+# offset of the first record of every (chromosome, position bucket) and of
+# every Nth record, so a region or page of a result can be fetched with a
+# ranged GET of its bytes instead of the whole file
+#
+# Offsets into a BGZF file are virtual offsets as in tabix (offset of the
+# block in the file << 16 | offset of the record in the block's data);
+# into a plain file they are byte offsets
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import json
+import bisect
+
+import bgzf
+
+VERSION = 1
+
+"""Largest BGZF block; a record starting in a block may need all of it
+"""
+MAX_BLOCK = 1 << 16
+
+
+"""Name of the index of an annotated file
+"""
+def indexFileName(filename):
+    return filename + '.index.json'
+
+
+"""(offset, line) of every line of a plain or BGZF file, then (end offset,
+   None)
+"""
+def lineOffsets(filename, compressed):
+    with open(filename, 'rb') as fh:
+        if not compressed:
+            offset = 0
+            for line in fh:
+                yield offset, line
+                offset = offset + len(line)
+            yield offset, None
+            return
+
+        carry = b''
+        start = None
+        while True:
+            coffset = fh.tell()
+            block = bgzf.readBlock(fh)
+            if not block:
+                break
+            data = bgzf.inflateBlock(block)
+            pos = 0
+            while (pos < len(data)):
+                if start is None:
+                    start = (coffset << 16) | pos
+                nl = data.find(b'\n', pos)
+                if (nl < 0):
+                    carry = carry + data[pos:]
+                    break
+                yield start, carry + data[pos:nl + 1]
+                carry = b''
+                start = None
+                pos = nl + 1
+        if carry:
+            yield start, carry
+        # the end-of-file block, if any, holds no data
+        yield (coffset << 16), None
+
+
+"""CHROM and POS of a data line (bytes or text), or None for the lines the
+   stages pass through without parsing them (see vcf_record.record): blank
+   lines, lines of one field and lines whose POS is not a number
+"""
+def linePosition(line):
+    fields = line.strip().split(b'\t' if isinstance(line, bytes) else '\t',
+        2)
+    if (len(fields) < 2):
+        return None
+    try:
+        pos = int(fields[1].strip())
+    except ValueError:
+        return None
+    return fields[0].strip(), pos
+
+
+"""Index of filename, a VCF written plain or as BGZF
+   Each chromosome gets the offsets of its first record and of the record
+   after its last one, and, if its records are sorted and contiguous, the
+   offset of the first record in every bucket of positions it has records
+   in (flattened as [bucket, offset, bucket, offset, ...])
+   Lines that are not records (see linePosition) are not indexed.
+"""
+def buildIndex(filename, bucket=16384, every=10000):
+    compressed = bgzf.isBgzf(filename)
+    chroms = {}
+    pages = []
+    header_end = None
+    records = 0
+    current = None
+    last_pos = 0
+
+    for offset, line in lineOffsets(filename, compressed):
+        if (line is None):
+            end = offset
+            break
+        if line.startswith(b'#'):
+            continue
+        position = linePosition(line)
+        if position is None:
+            continue
+        if header_end is None:
+            header_end = offset
+        chrom = position[0].decode()
+        pos = position[1]
+
+        if (records % every == 0):
+            pages.append(offset)
+        records = records + 1
+
+        if (current is None) or (chrom != current['name']):
+            if current is not None:
+                current['end'] = offset
+            if chrom in chroms:
+                # seen before: only the whole span is of use
+                current = chroms[chrom]
+                current['sorted'] = False
+                current['buckets'] = []
+                continue
+            current = chroms[chrom] = {'name': chrom, 'start': offset,
+                'end': offset, 'sorted': True, 'buckets': []}
+            last_pos = 0
+        if current['sorted']:
+            if (pos < last_pos):
+                current['sorted'] = False
+                current['buckets'] = []
+            elif (len(current['buckets']) == 0) or \
+                (pos // bucket != current['buckets'][-2]):
+                current['buckets'].extend([pos // bucket, offset])
+            last_pos = pos
+
+    if current is not None:
+        current['end'] = end
+    for entry in chroms.values():
+        del entry['name']
+    return {
+        'version': VERSION,
+        'compressed': compressed,
+        'size': os.path.getsize(filename),
+        'bucket': bucket,
+        'every': every,
+        'records': records,
+        'header': [0, end if header_end is None else header_end],
+        'end': end,
+        'pages': pages,
+        'chroms': chroms,
+    }
+
+
+"""Writes the index of filename next to it
+"""
+def write(filename, index):
+    with open(indexFileName(filename), 'w') as fh:
+        json.dump(index, fh, separators=(',', ':'))
+
+
+def load(filename):
+    with open(indexFileName(filename)) as fh:
+        return json.load(fh)
+
+
+"""Index entry of chrom, written with or without the "chr" prefix
+"""
+def chromEntry(index, chrom):
+    for name in [chrom, 'chr' + chrom, chrom[3:]]:
+        if name in index['chroms']:
+            return name, index['chroms'][name]
+    return None, None
+
+
+"""Offsets [first, last) of the records of chrom that may lie in positions
+   [start, end], None if chrom has no records
+   The span is a superset at bucket granularity (the whole chromosome if
+   its records are unsorted); records are to be filtered by position.
+"""
+def regionOffsets(index, chrom, start=0, end=None):
+    _, entry = chromEntry(index, chrom)
+    if entry is None:
+        return None
+    first, last = entry['start'], entry['end']
+    if entry['sorted'] and entry['buckets']:
+        buckets = entry['buckets'][0::2]
+        offsets = entry['buckets'][1::2]
+        i = bisect.bisect_right(buckets, start // index['bucket']) - 1
+        if (i >= 0):
+            first = offsets[i]
+        if end is not None:
+            j = bisect.bisect_right(buckets, end // index['bucket'])
+            if (j < len(offsets)):
+                last = offsets[j]
+    return first, last
+
+
+"""Offsets [first, last) of the page-th run of every records
+"""
+def pageOffsets(index, page):
+    pages = index['pages']
+    if (page >= len(pages)):
+        return None
+    last = pages[page + 1] if (page + 1 < len(pages)) else index['end']
+    return pages[page], last
+
+
+"""Byte range [start, end) of the file to fetch (e.g. as an HTTP Range of
+   bytes=start-(end-1)) for the records at offsets [first, last)
+"""
+def byteRange(index, first, last):
+    if not index['compressed']:
+        return first, last
+    end = last >> 16
+    if (last & 0xffff):
+        end = min(index['size'], end + MAX_BLOCK)
+    return first >> 16, end
+
+
+"""Text of the records at offsets [first, last) out of data, the bytes of
+   the file from byteRange(index, first, last)[0] on
+"""
+def decodeRange(index, data, first, last):
+    if not index['compressed']:
+        return data[:last - first].decode()
+
+    fh = io.BytesIO(data)
+    base = first >> 16
+    text = []
+    while True:
+        coffset = base + fh.tell()
+        if (coffset > (last >> 16)) or \
+            ((coffset == (last >> 16)) and not (last & 0xffff)):
+            break
+        block = bgzf.readBlock(fh)
+        if not block:
+            break
+        block_data = bgzf.inflateBlock(block)
+        lo = (first & 0xffff) if (coffset == base) else 0
+        hi = (last & 0xffff) if (coffset == (last >> 16)) else len(block_data)
+        text.append(block_data[lo:hi])
+    return b''.join(text).decode()
+
+
+"""Records (lines) of chrom at positions [start, end] read from filename
+   through its index, as a reader of the fetched byte range would
+"""
+def readRegion(filename, index, chrom, start=0, end=None):
+    name, _ = chromEntry(index, chrom)
+    offsets = regionOffsets(index, chrom, start, end)
+    if offsets is None:
+        return []
+    lo, hi = byteRange(index, *offsets)
+    with open(filename, 'rb') as fh:
+        fh.seek(lo)
+        data = fh.read(hi - lo)
+
+    lines = []
+    for line in decodeRange(index, data, *offsets).splitlines():
+        position = linePosition(line)
+        if position is None:
+            continue
+        chrom, pos = position
+        if (chrom == name) and (pos >= start) and \
+            ((end is None) or (pos <= end)):
+            lines.append(line)
+    return lines
+
+### EOF
@@ -11,113 +11,131 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import sys
 import time
 import driver
+import stage_stats as sst
+import result_index as ri
+import columnar as co
 import boto3
 import json
 import botocore
 import shutil
 import os
+from decimal import Decimal
 from botocore.exceptions import ClientError, UnknownServiceError
 
 
-
-"""A rudimentary timer for coarse-grained profiling
+"""Annotates a job's input file, uploads the results and log to S3, starts
+   the archive state machine and marks the job COMPLETED
+   Called by __main__ below, once per job, or by the resident workers of
+   annotator.py (see worker_pool.py) with the job directory as working
+   directory; errors end it with sys.exit
 """
-class Timer(object):
-    def __init__(self, verbose=True):
-        self.verbose = verbose
-
-    def __enter__(self):
-        self.start = time.time()
-        return self
-
-    def __exit__(self, *args):
-        self.end = time.time()
-        self.secs = self.end - self.start
-        if self.verbose:
-            print(f"Approximate runtime: {self.secs:.2f} seconds")
-
-if __name__ == '__main__':
-
-    user_id = sys.argv[3]
-    JOBS_DIR = sys.argv[4]
-    region=sys.argv[5]
-    iam_username=sys.argv[6]
-    AWS_S3_RESULTS_BUCKET=sys.argv[7]
-    tb=sys.argv[8]
-    stateMachineArn=sys.argv[9]
+def annotateJob(infile, job_id, user_id, JOBS_DIR, region, iam_username,
+    AWS_S3_RESULTS_BUCKET, tb, stateMachineArn):
 
     # Call the AnnTools pipeline
-    if len(sys.argv) > 1:
-        with Timer():
-            driver.run(sys.argv[1], 'vcf')
-
-        # Reference for A7
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
-        # https://pynative.com/python-delete-files-and-directories/
-
-        # 1. Upload the results file to S3 results bucket
-        try:
-            s3_client = boto3.client('s3', region_name=region)
-        except UnknownServiceError as error:
-            sys.exit(1)
-        try:
-            file_name = sys.argv[1].split('/')[-1].split('.')[0]
-            job_id=sys.argv[2]
-        except:
-            print("Cannot get file_name and job_id!")
-            sys.exit(1)
+    stats = driver.run(infile, 'vcf')
+    print(sst.summary(stats))
+
+    # Reference for A7
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+    # https://pynative.com/python-delete-files-and-directories/
+
+    # 1. Upload the results file to S3 results bucket
+    try:
+        s3_client = boto3.client('s3', region_name=region)
+    except UnknownServiceError as error:
+        sys.exit(1)
+    try:
+        # x.vcf gives x.annot.vcf, or x.annot.vcf.gz when compressed;
+        # x.vcf.gz input gives the same names
+        annot_name = driver.annotatedFileName(infile).split('/')[-1]
+        log_name = infile.split('/')[-1] + ".count.log"
+    except:
+        print("Cannot get file_name and job_id!")
+        sys.exit(1)
+        
+    job_path=f"{JOBS_DIR}/{job_id}/"
+    result_path=f"{iam_username}/{user_id}/"
+    annot_file=result_path+annot_name
+    log_file=result_path+log_name
             
-        job_path=f"{JOBS_DIR}/{job_id}/"
-        result_path=f"{iam_username}/{sys.argv[3]}/{file_name}"
-        annot_file=result_path+".annot.vcf"
-        log_file=result_path+".vcf.count.log"
-                
+    try:
+        response = s3_client.upload_file(job_path+annot_name, AWS_S3_RESULTS_BUCKET, annot_file)
+    except ClientError as e:
+        print("Cannot upload the results file to S3")
+        sys.exit(1)
+    
+    # 2. Upload the log file to S3 results bucket
+    try:
+        response = s3_client.upload_file(job_path+log_name, AWS_S3_RESULTS_BUCKET, log_file)
+    except ClientError as e:
+        print("Cannot upload the log file to S3")
+        sys.exit(1)
+
+    # Upload the index of the results file, if one was written, so
+    # regions of the results can be fetched with ranged GETs
+    index_file = None
+    if os.path.exists(ri.indexFileName(job_path+annot_name)):
+        index_file = ri.indexFileName(annot_file)
         try:
-            response = s3_client.upload_file(job_path+file_name+".annot.vcf", AWS_S3_RESULTS_BUCKET, annot_file)
+            response = s3_client.upload_file(ri.indexFileName(job_path+annot_name), AWS_S3_RESULTS_BUCKET, index_file)
         except ClientError as e:
-            print("Cannot upload the results file to S3")
+            print("Cannot upload the index file to S3")
             sys.exit(1)
-        
-        # 2. Upload the log file to S3 results bucket
+
+    # Upload the columnar export of the results, if one was written
+    columnar_file = None
+    if os.path.exists(co.columnarFileName(job_path+annot_name)):
+        columnar_file = co.columnarFileName(annot_file)
         try:
-            response = s3_client.upload_file(job_path+file_name+".vcf.count.log", AWS_S3_RESULTS_BUCKET, log_file)
+            response = s3_client.upload_file(co.columnarFileName(job_path+annot_name), AWS_S3_RESULTS_BUCKET, columnar_file)
         except ClientError as e:
-            print("Cannot upload the log file to S3")
+            print("Cannot upload the columnar file to S3")
             sys.exit(1)
 
 
-        # 3. Invoke Stepfunction
-        try:
-            stepFn=boto3.client('stepfunctions', region_name=region)
-            response=stepFn.start_execution(stateMachineArn=stateMachineArn, input=json.dumps({'job_id':job_id, 'user_id':user_id, 'annot_file': annot_file}))
-        except ClientError as e:
-            print("Cannot upload the log file to S3")
-    
-        # 4. Updates the job item in the DynamoDB table 
-        # https://stackoverflow.com/questions/34447304/example-of-update-item-in-dynamodb-boto3
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
-        try:
-            db = boto3.resource('dynamodb', region_name=region)
-            table = db.Table(tb)
-            table.update_item(
-                Key={'job_id':job_id},
-                UpdateExpression='SET #att1=:val1, #att2=:val2, #att3=:val3, #att4=:val4, #att5=:val5',
-                ExpressionAttributeNames={"#att1": "s3_results_bucket","#att2": "s3_key_result_file",
-                    "#att3": "s3_key_log_file","#att4": "complete_time","#att5": "job_status"},
-                ExpressionAttributeValues={":val1": "gas-results",":val2": annot_file,":val3": log_file,
-                ":val4": round(time.time()),":val5": "COMPLETED"},
-                ReturnValues="UPDATED_NEW",
-            )
-        except ClientError as e:
-            print("Cannot insert data to the table")
-            sys.exit(1)
+    # 3. Invoke Stepfunction
+    try:
+        stepFn=boto3.client('stepfunctions', region_name=region)
+        response=stepFn.start_execution(stateMachineArn=stateMachineArn, input=json.dumps({'job_id':job_id, 'user_id':user_id, 'annot_file': annot_file}))
+    except ClientError as e:
+        print("Cannot upload the log file to S3")
+
+    # 4. Updates the job item in the DynamoDB table 
+    # https://stackoverflow.com/questions/34447304/example-of-update-item-in-dynamodb-boto3
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
+    try:
+        db = boto3.resource('dynamodb', region_name=region)
+        table = db.Table(tb)
+        table.update_item(
+            Key={'job_id':job_id},
+            UpdateExpression='SET #att1=:val1, #att2=:val2, #att3=:val3, #att4=:val4, #att5=:val5, #att6=:val6, #att7=:val7, #att8=:val8',
+            ExpressionAttributeNames={"#att1": "s3_results_bucket","#att2": "s3_key_result_file",
+                "#att3": "s3_key_log_file","#att4": "complete_time","#att5": "job_status",
+                "#att6": "stage_stats","#att7": "s3_key_index_file",
+                "#att8": "s3_key_columnar_file"},
+            ExpressionAttributeValues={":val1": "gas-results",":val2": annot_file,":val3": log_file,
+            ":val4": round(time.time()),":val5": "COMPLETED",
+            # DynamoDB takes numbers as Decimal, not float
+            ":val6": json.loads(json.dumps(stats), parse_float=Decimal),
+            ":val7": index_file, ":val8": columnar_file},
+            ReturnValues="UPDATED_NEW",
+        )
+    except ClientError as e:
+        print("Cannot insert data to the table")
+        sys.exit(1)
 
 
-            
+        
 
-        # 5. Clean up (delete) local job files
-        shutil.rmtree(job_path)
+    # 5. Clean up (delete) local job files
+    shutil.rmtree(job_path)
+
+
+if __name__ == '__main__':
 
+    if len(sys.argv) > 9:
+        annotateJob(*sys.argv[1:10])
     else:
         print("A valid .vcf file must be provided as input to this program.")
 
@@ -0,0 +1,474 @@
+# snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Local columnar snapshot of the annotator reference database
+#
+# Build a snapshot: python snapshot.py <snapshot_dir> [table ...]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import mmap
+import time
+import marshal
+import itertools
+from array import array
+from bisect import bisect_right
+
+import annotate as ann
+import file_utils as fu
+import interval_index as ix
+import lookup_cache as lc
+import utils as u
+
+"""Tables exported to a snapshot:
+   table -> (select list, chromosome column, start column, end column)
+   Rows are located by start <= pos <= end on each chromosome; tables looked
+   up by equality use the same column as start and end.
+"""
+SNAPSHOT_TABLES = {
+    'dbSNP': ('*', 'CHR', 'POS', 'POS'),
+    'chrom_pos_equal_base': ('*', 'CHR', 'start', 'start'),
+    'chrom_pos_equal_nobase': ('*', 'CHR', 'start', 'start'),
+    'chrom_pos_unequal': ('*', 'CHR', 'start', 'end'),
+    'refGene': ('*', 'chrom', 'txStart', 'txEnd'),
+    'gwasCatalog': ('*', 'chrom', 'chromEnd', 'chromEnd'),
+}
+SNAPSHOT_TABLES.update(ix.RANGE_TABLES)
+
+"""Tables whose rows are stored with the INFO fragment the stages write for
+   them, rendered when the snapshot is built: table -> rendering of a row
+"""
+FRAGMENT_TABLES = {
+    'chrom_pos_equal_base': ann.refSeqFragment,
+    'chrom_pos_equal_nobase': ann.refSeqFragment,
+    'chrom_pos_unequal': ann.refSeqFragment,
+}
+
+MANIFEST = 'manifest.json'
+
+# Snapshots already opened by this worker process, keyed by directory
+_snapshots = {}
+lc.onVersionChange(_snapshots.clear)
+
+
+"""Values of a column kept in memory before they are spilled to disk while
+   a chromosome is exported
+"""
+CHUNK = 65536
+
+
+"""Values of one column of a chromosome spilled to a temporary file in
+   chunks as the rows stream in, with the storage kind of the values seen
+   so far: 'i' int64, 'b' bytes, 's' text
+   Values that are neither int nor bytes (floats, decimals) are kept as text
+"""
+class ColumnSpill(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, 'wb')
+        self.chunk = []
+        self.kind = None
+        self.nulls = False
+
+    def append(self, v):
+        if v is None:
+            self.nulls = True
+        elif isinstance(v, bool) or not isinstance(v, (int, bytes)):
+            self.kind = 's'
+            v = str(v)
+        elif (self.kind != 's'):
+            k = 'i' if isinstance(v, int) else 'b'
+            self.kind = k if self.kind in (None, k) else 's'
+        self.chunk.append(v)
+        if (len(self.chunk) >= CHUNK):
+            self.flush()
+
+    def flush(self):
+        if self.chunk:
+            marshal.dump(self.chunk, self.fh)
+            self.chunk = []
+
+    def chunks(self):
+        if not self.fh.closed:
+            self.flush()
+            self.fh.close()
+        with open(self.path, 'rb') as fh:
+            while True:
+                try:
+                    yield marshal.load(fh)
+                except EOFError:
+                    return
+
+    def remove(self):
+        self.fh.close()
+        os.remove(self.path)
+
+
+"""A columnar file written one segment after the other from chunks of
+   bytes; every segment is 8-byte aligned so it can be cast from a memory
+   map
+"""
+class SegmentWriter(object):
+
+    def __init__(self, path):
+        self.fh = open(path, 'wb')
+        self.segments = {}
+
+    def segment(self, name, chunks):
+        offset = self.fh.tell()
+        for data in chunks:
+            self.fh.write(data)
+        length = self.fh.tell() - offset
+        self.fh.write(b'\0' * (-length % 8))
+        self.segments[name] = [offset, length]
+
+    """Writes the values of spill encoded by encode() as segment name, and
+       their offsets (spilled on the way) as segment name.off
+    """
+    def strings(self, name, spill, encode):
+        with open(self.fh.name + '.off', 'w+b') as offsets:
+
+            def data():
+                end = 0
+                offsets.write(array('q', [end]).tobytes())
+                for chunk in spill.chunks():
+                    values = [encode(v) for v in chunk]
+                    ends = array('q', itertools.accumulate(map(len, values),
+                        initial=end))
+                    offsets.write(ends[1:].tobytes())
+                    end = ends[-1]
+                    yield b''.join(values)
+
+            self.segment(name, data())
+            offsets.seek(0)
+            self.segment(name + '.off', iter(lambda: offsets.read(1 << 20),
+                b''))
+        os.remove(self.fh.name + '.off')
+
+    def close(self):
+        self.fh.close()
+
+
+"""Writes the rows of one chromosome as a columnar file
+   rows yields (ordinal, row) sorted by start, ordinal being the position
+   of the row in the table; the file holds the start, end, running maximum
+   of ends and ordinal arrays, then every column: an int64 array, or
+   offsets plus a data block for bytes/text, plus a null mask if needed,
+   and the fragment rendered by render() for every row if given.
+   Rows are spilled to temporary files next to path as they are read, so a
+   chromosome is never held in memory.
+   Returns the manifest entry for the file (None: no rows).
+"""
+def writeChrom(path, rows, start_ind, end_ind, render=None):
+    index = {name: ColumnSpill(f"{path}.{name}")
+        for name in ('start', 'end', 'maxend', 'order')}
+    columns = []
+    fragments = ColumnSpill(path + '.fragment') if render else None
+    maxend = None
+    count = 0
+
+    for ordinal, row in rows:
+        if not columns:
+            columns = [ColumnSpill(f"{path}.{c}") for c in range(len(row))]
+        start, end = int(row[start_ind]), int(row[end_ind])
+        maxend = end if (maxend is None) else max(maxend, end)
+        for name, v in (('start', start), ('end', end), ('maxend', maxend),
+            ('order', ordinal)):
+            index[name].append(v)
+        for c, v in enumerate(row):
+            columns[c].append(v)
+        if fragments is not None:
+            fragments.append(render(row))
+        count = count + 1
+
+    spills = list(index.values()) + columns + \
+        ([fragments] if fragments else [])
+    if (count == 0):
+        for spill in spills:
+            spill.remove()
+        return None
+
+    out = SegmentWriter(path)
+    for name, spill in index.items():
+        out.segment(name, (array('q', chunk).tobytes()
+            for chunk in spill.chunks()))
+
+    kinds = []
+    for c, spill in enumerate(columns):
+        kind = spill.kind or 's'
+        kinds.append(kind)
+        if spill.nulls:
+            out.segment(f"{c}.null", (bytes([v is None for v in chunk])
+                for chunk in spill.chunks()))
+        if (kind == 'i'):
+            out.segment(f"{c}", (array('q', [v or 0 for v in chunk]).tobytes()
+                for chunk in spill.chunks()))
+        elif (kind == 'b'):
+            out.strings(f"{c}", spill, lambda v: v or b'')
+        else:
+            out.strings(f"{c}", spill,
+                lambda v: b'' if (v is None) else str(v).encode('utf-8'))
+
+    if fragments is not None:
+        out.strings('fragment', fragments, lambda v: v.encode('utf-8'))
+
+    out.close()
+    for spill in spills:
+        spill.remove()
+    return {'file': os.path.basename(path), 'rows': count,
+        'kinds': kinds, 'segments': out.segments}
+
+
+"""Exports one table of the reference database into <snapshot_dir>/<table>/
+   Every chromosome is streamed through a server-side cursor sorted by
+   start, with the ordinal of each row in table order (row_number() over
+   the row key of u.db_row_key; MySQL 8 with the RowKey primary key) so
+   hits are still returned in table order
+"""
+def exportTable(conn, snapshot_dir, table):
+    columns, chrom_col, start_col, end_col = SNAPSHOT_TABLES[table]
+    table_dir = os.path.join(snapshot_dir, table)
+    fu.mkdirp(table_dir)
+    entry = {'chroms': {}}
+
+    if (chrom_col is None):
+        # one table per chromosome
+        sources = [(chrom, table + chrom, '') for chrom in ix.TFBS_CHROMS]
+    else:
+        cursor = conn.cursor()
+        cursor.execute('select distinct ' + chrom_col + ' from ' + table + ';')
+        sources = [(str(row[0]), table, ' where ' + chrom_col + '="' + \
+            str(row[0]) + '"') for row in cursor.fetchall()]
+        cursor.close()
+
+    for chrom, source, where in sources:
+        select = source + '.*' if (columns == '*') else columns
+        cursor = u.db_stream_cursor(conn)
+        cursor.execute('select row_number() over (order by ' + source + \
+            '.' + u.db_row_key(conn) + ') as snapshot_ordinal, ' + select + \
+            ' from ' + source + where + ' order by ' + start_col + \
+            ', snapshot_ordinal;')
+        names = [d[0] for d in cursor.description][1:]
+        if 'columns' not in entry:
+            entry['columns'] = names
+        path = os.path.join(table_dir, chrom + '.col')
+        chrom_entry = writeChrom(path,
+            ((row[0] - 1, row[1:]) for row in cursor),
+            names.index(start_col), names.index(end_col),
+            FRAGMENT_TABLES.get(table))
+        cursor.close()
+        if chrom_entry is None:
+            continue
+        entry['chroms'][chrom] = chrom_entry
+        print(f"{table} {chrom}: {chrom_entry['rows']} rows")
+
+    return entry
+
+
+"""Builds a snapshot of the given tables (all of them by default)
+"""
+def build(snapshot_dir, tables=None):
+    fu.mkdirp(snapshot_dir)
+    conn = u.db_connect()
+
+    manifest = {'version': time.strftime('%Y%m%d%H%M%S'), 'tables': {}}
+    for table in (tables or list(SNAPSHOT_TABLES)):
+        manifest['tables'][table] = exportTable(conn, snapshot_dir, table)
+    conn.close()
+
+    # the manifest is written last, a partial build is never picked up
+    with open(os.path.join(snapshot_dir, MANIFEST), 'w') as fh:
+        json.dump(manifest, fh)
+    return manifest
+
+
+"""Memory-mapped rows of one chromosome of a snapshot table
+   The block maxima of the ends (see interval_index.blockMaxima) are
+   computed when the chromosome is opened.
+   Fragments missing from snapshots built without them are rendered with
+   render() on the fly.
+"""
+class SnapshotChrom(object):
+
+    def __init__(self, path, entry, render=None):
+        self.fh = open(path, 'rb')
+        self.map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        segments = entry['segments']
+
+        def segment(name, cast=None):
+            offset, length = segments[name]
+            data = view[offset:offset + length]
+            return data.cast('q') if cast else data
+
+        self.starts = segment('start', 'q')
+        self.ends = segment('end', 'q')
+        self.maxends = segment('maxend', 'q')
+        self.blocks = ix.blockMaxima(self.ends)
+        self.order = segment('order', 'q')
+        self.columns = []
+        for c, kind in enumerate(entry['kinds']):
+            nulls = segment(f"{c}.null") if f"{c}.null" in segments else None
+            if (kind == 'i'):
+                self.columns.append((kind, segment(f"{c}", 'q'), None, nulls))
+            else:
+                self.columns.append((kind, segment(f"{c}"),
+                    segment(f"{c}.off", 'q'), nulls))
+        self.render = render
+        self.fragments = None
+        if 'fragment' in segments:
+            self.fragments = (segment('fragment'),
+                segment('fragment.off', 'q'))
+
+    def value(self, i, c):
+        kind, data, offsets, nulls = self.columns[c]
+        if nulls is not None and nulls[i]:
+            return None
+        elif (kind == 'i'):
+            return data[i]
+        elif (kind == 'b'):
+            return data[offsets[i]:offsets[i + 1]].tobytes()
+        return str(data[offsets[i]:offsets[i + 1]], 'utf-8')
+
+    def row(self, i):
+        return tuple(self.value(i, c) for c in range(len(self.columns)))
+
+    def fragment(self, i):
+        if self.fragments is None:
+            return self.render(self.row(i))
+        data, offsets = self.fragments
+        return str(data[offsets[i]:offsets[i + 1]], 'utf-8')
+
+
+"""One table of a snapshot, answering the same stab/first queries as
+   interval_index.IntervalIndex plus overlap queries, without a database
+   Rows are returned as the database would return them for select <columns>,
+   in table order.
+"""
+class SnapshotTable(object):
+
+    def __init__(self, snapshot_dir, table, entry):
+        self.dir = os.path.join(snapshot_dir, table)
+        self.table = table
+        self.entry = entry
+        self.columns = entry.get('columns', [])
+        self.chroms = {}
+
+    def chrom(self, chrom):
+        if chrom not in self.chroms:
+            entry = self.entry['chroms'].get(chrom)
+            self.chroms[chrom] = None if entry is None else \
+                SnapshotChrom(os.path.join(self.dir, entry['file']), entry,
+                    FRAGMENT_TABLES.get(self.table))
+        return self.chroms[chrom]
+
+    """Returns the SnapshotChrom of chrom and the indices of its rows
+       overlapping [lo, hi], in table order
+    """
+    def hits(self, chrom, lo, hi):
+        data = self.chrom(chrom)
+        if data is None:
+            return None, []
+        hits = ix.reachBack(data.ends, data.maxends, data.blocks,
+            bisect_right(data.starts, hi) - 1, lo)
+        if len(hits) > 1:
+            hits.sort(key=lambda h: data.order[h])
+        return data, hits
+
+    def overlap(self, chrom, lo, hi):
+        data, hits = self.hits(chrom, lo, hi)
+        return [data.row(h) for h in hits]
+
+    def stab(self, chrom, pos):
+        return self.overlap(chrom, pos, pos)
+
+    def first(self, chrom, pos):
+        hits = self.stab(chrom, pos)
+        if (len(hits) > 0):
+            return hits[0]
+        return None
+
+
+"""The three bigRefGene tables of a snapshot resolved in order of precedence:
+   chrom_pos_equal_base (matching alleles), chrom_pos_equal_nobase, then
+   chrom_pos_unequal
+   fragments() returns the stored fragments of the rows lookup() would
+   return, reading no other column than the alleles.
+"""
+class SnapshotBigRefGene(object):
+
+    def __init__(self, snapshot):
+        self.base = snapshot.table('chrom_pos_equal_base')
+        self.nobase = snapshot.table('chrom_pos_equal_nobase')
+        self.unequal = snapshot.table('chrom_pos_unequal')
+        ref_ind = self.base.columns.index('haplotypeReference')
+        alt_ind = self.base.columns.index('haplotypeAlternate')
+        self.alleles = (ref_ind, alt_ind)
+
+    def lookup(self, chr, pos, ref, alt, compRef, compAlt):
+        ref_ind, alt_ind = self.alleles
+        rows = [row for row in self.base.stab(chr, pos)
+            if (row[ref_ind], row[alt_ind]) in ((ref, alt), (compRef, compAlt))]
+        if (len(rows) > 0):
+            return rows
+        rows = self.nobase.stab(chr, pos)
+        if (len(rows) > 0):
+            return rows
+        return self.unequal.stab(chr, pos)
+
+    def fragments(self, chr, pos, ref, alt, compRef, compAlt):
+        ref_ind, alt_ind = self.alleles
+        data, hits = self.base.hits(chr, pos, pos)
+        hits = [h for h in hits if (data.value(h, ref_ind),
+            data.value(h, alt_ind)) in ((ref, alt), (compRef, compAlt))]
+        if (len(hits) > 0):
+            return [data.fragment(h) for h in hits]
+        for table in (self.nobase, self.unequal):
+            data, hits = table.hits(chr, pos, pos)
+            if (len(hits) > 0):
+                return [data.fragment(h) for h in hits]
+        return []
+
+
+"""An opened snapshot directory
+"""
+class Snapshot(object):
+
+    def __init__(self, snapshot_dir):
+        self.dir = snapshot_dir
+        with open(os.path.join(snapshot_dir, MANIFEST)) as fh:
+            self.manifest = json.load(fh)
+        self.version = self.manifest['version']
+        self.tables = {}
+
+    def table(self, table):
+        if table not in self.tables:
+            self.tables[table] = SnapshotTable(self.dir, table,
+                self.manifest['tables'][table])
+        return self.tables[table]
+
+
+"""Returns the snapshot in snapshot_dir, opening it on first use in this worker
+"""
+def getSnapshot(snapshot_dir):
+    if snapshot_dir not in _snapshots:
+        _snapshots[snapshot_dir] = Snapshot(snapshot_dir)
+    return _snapshots[snapshot_dir]
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1:
+        manifest = build(sys.argv[1], sys.argv[2:] or None)
+        print(f"Snapshot {manifest['version']} written to {sys.argv[1]}")
+    else:
+        print("Usage: python snapshot.py <snapshot_dir> [table ...]")
+
+### EOF
@@ -0,0 +1,220 @@
+# stage_graph.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Concurrent execution of independent annotation stages
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import queue
+import threading
+
+import annotate as ann
+import stage_stats as sst
+import vcf_record as vr
+
+# Records a branch may run ahead of the merged output
+LOOKAHEAD = 1000
+
+_END = object()
+
+
+"""Groups stages into levels of consecutive stages that do not read each
+   other's output; inputs[i] lists the stages whose output stage i reads
+"""
+def levels(inputs):
+    groups = []
+    for i, deps in enumerate(inputs):
+        if (len(groups) > 0) and not any(d in groups[-1] for d in deps):
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    return groups
+
+
+"""Copy of a record that keeps a journal of the changes stages make to it,
+   as (method, arguments), so they can be made again to the record it was
+   copied from (see replayJournal)
+"""
+class JournaledRecord(vr.VcfRecord):
+
+    __slots__ = ('journal',)
+
+    def strip(self):
+        self.journal.append(('strip', ()))
+        return super().strip()
+
+    def addInfo(self, text):
+        self.journal.append(('addInfo', (text,)))
+        super().addInfo(text)
+
+    def appendInfo(self, fragment):
+        self.journal.append(('appendInfo', (fragment,)))
+        super().appendInfo(fragment)
+
+    def setInfo(self, text):
+        self.journal.append(('setInfo', (text,)))
+        super().setInfo(text)
+
+    def padFields(self):
+        self.journal.append(('padFields', ()))
+        super().padFields()
+
+
+"""Journaled copy of a record for a branch; lines are returned as they are
+"""
+def journaled(item):
+    if not isinstance(item, vr.VcfRecord):
+        return item
+    copy = item.copy()
+    record = JournaledRecord.__new__(JournaledRecord)
+    for name in vr.VcfRecord.__slots__:
+        setattr(record, name, getattr(copy, name))
+    record.journal = []
+    return record
+
+
+"""Makes the changes of a journal to record, in the same order
+"""
+def replayJournal(record, journal):
+    for method, args in journal:
+        getattr(record, method)(*args)
+
+
+"""Runs the stages of a level side by side on the same records
+
+   Each stage runs once, in its own thread, over journaled copies of the
+   upstream records, with its own connection and engines: branches[i] is
+   (apply, close) from driver.openBranch, apply(lines, log, format) being
+   the stage set up as driver.applyStage sets it up. The records are then
+   passed through the stages in their declared order, the journal each
+   stage left on its copy of a record being replayed on the record itself,
+   so the INFO fragments are appended, and the counters recorded once the
+   stage is done, exactly as in a sequential run while the stages overlap
+   in time.
+
+   stages holds (label, fh_log) per stage of the level; wrap(lines, label)
+   is applied to the output of each stage. meters[i], if given, is the
+   meter apply() reports stage i to; the time the branch waits on its
+   input, and the replaying, are not counted.
+"""
+def runLevel(lines, stages, branches, format, wrap=None, meters=None):
+
+    stopped = threading.Event()
+    inputs = [queue.Queue(LOOKAHEAD) for _ in stages]
+    # the feed is held back by the inputs of the branches, so neither
+    # queue grows past LOOKAHEAD and the blocks a stage reads ahead (e.g.
+    # VectorBatch.prefetch); bounding them could stall the merge
+    merged = queue.Queue()
+    outputs = [queue.Queue() for _ in stages]
+    logs = [ann.CountLog() for _ in stages]
+
+    def put(q, item):
+        while not stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def drain(q):
+        while not stopped.is_set():
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def take(q):
+        item = q.get()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def feed():
+        try:
+            for line in lines:
+                if stopped.is_set():
+                    break
+                # parsed once here, so that the merged record is the one
+                # the journals of the branches are replayed on
+                line = vr.record(line)
+                for q in inputs:
+                    put(q, journaled(line))
+                put(merged, line)
+        except BaseException as e:
+            put(merged, e)
+        finally:
+            put(merged, _END)
+            for q in inputs:
+                put(q, _END)
+
+    def branch(i, records):
+        try:
+            for item in records:
+                put(outputs[i], item.journal if \
+                    isinstance(item, JournaledRecord) else None)
+            put(outputs[i], _END)
+        except BaseException as e:
+            put(outputs[i], e)
+
+    def replay(records, i):
+        label, fh_log = stages[i]
+        for item in records:
+            journal = take(outputs[i])
+            if journal is _END:
+                raise RuntimeError(f"{label} yielded fewer records than " + \
+                    "it read")
+            if journal is not None:
+                replayJournal(item, journal)
+            yield item
+        if take(outputs[i]) is not _END:
+            raise RuntimeError(f"{label} yielded more records than it read")
+        for kind, log_label, counts in logs[i].records:
+            fh_log.record(kind, log_label, **counts)
+
+    threads = []
+    try:
+        # the stages and their engines are set up here, and only read in
+        # the threads of the branches
+        pipes = []
+        for i, (apply, _) in enumerate(branches):
+            # time spent waiting on the feed is not the stage's
+            records = drain(inputs[i])
+            if meters and (meters[i] is not None):
+                records = sst.Clock(records)
+            pipes.append(apply(records, logs[i], format))
+
+        threads.append(threading.Thread(target=feed, daemon=True))
+        threads.extend(threading.Thread(target=branch, args=(i, pipe),
+            daemon=True) for i, pipe in enumerate(pipes))
+        for t in threads:
+            t.start()
+
+        records = drain(merged)
+        for i, (label, _) in enumerate(stages):
+            records = replay(records, i)
+            if wrap is not None:
+                records = wrap(records, label)
+
+        # nor is the replaying the time of any later stage
+        if meters:
+            records = sst.Clock(records)
+        for line in records:
+            yield line
+
+    finally:
+        # branches may still be inside a lookup if the run was cut short
+        stopped.set()
+        for t in threads:
+            t.join()
+        for _, close in branches:
+            close()
+
+### EOF
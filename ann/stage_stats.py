@@ -0,0 +1,229 @@
+# stage_stats.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Per-stage instrumentation of the annotation pipeline: wall and CPU time,
+# variants, reference queries and rows, lookup cache hits and file bytes of
+# every stage, written as a JSON sidecar next to the .count.log
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import time
+import threading
+
+import vcf_record as vr
+
+_clocks = threading.local()
+
+
+"""Counters of one stage of a job
+   Time is taken by the Clocks the stage's records are read through and
+   queries by the MeteredCursors handed to it; record() sums them up.
+   counted=False for stages that open their own connections (chained mode),
+   whose queries, rows and cache hits are not seen
+"""
+class StageMeter(object):
+
+    def __init__(self, label, name, counted=True):
+        self.label = label
+        self.name = name
+        self.counted = counted
+        self.backend = None
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.variants = 0
+        self.bytes_read = None
+        self.bytes_written = None
+        self.clocks = []
+        self.cursors = []
+
+    """Records read from items count towards this stage
+    """
+    def measure(self, items):
+        clock = Clock(items)
+        self.clocks.append(clock)
+        return clock
+
+    """cursor wrapped to count the queries and rows of this stage
+    """
+    def cursor(self, cursor):
+        if cursor is None:
+            return None
+        metered = MeteredCursor(cursor)
+        self.cursors.append(metered)
+        return metered
+
+    """Adds the hits and misses of a lookup_cache.CachedCursor
+    """
+    def watch(self, cursor):
+        if hasattr(cursor, 'hits'):
+            self.cursors.append(cursor)
+
+    """Takes the time, variants and bytes of a record() made by an earlier
+       run of the stage
+    """
+    def restore(self, record):
+        self.backend = record['backend']
+        self.wall = record['wall']
+        self.cpu = record['cpu']
+        self.variants = record['variants']
+        self.bytes_read = record['bytes_read']
+        self.bytes_written = record['bytes_written']
+
+    def record(self):
+        counted = (lambda n: n) if self.counted else (lambda n: None)
+        return {
+            'stage': self.label,
+            'name': self.name,
+            'backend': self.backend,
+            'wall': round(self.wall + sum([c.ownWall() for c in self.clocks]),
+                6),
+            'cpu': round(self.cpu + sum([c.ownCpu() for c in self.clocks]),
+                6),
+            'variants': self.variants + sum([c.variants for c in self.clocks]),
+            'queries': counted(sum([getattr(c, 'queries', 0)
+                for c in self.cursors])),
+            'rows': counted(sum([getattr(c, 'rows', 0) for c in self.cursors])),
+            'cache_hits': counted(sum([getattr(c, 'hits', 0)
+                for c in self.cursors])),
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+        }
+
+
+"""Iterates over items timing every step
+   Clocks nested in the same thread (a stage reading the output of another
+   through its Clock) are taken out of the time of the enclosing one, so
+   ownWall() and ownCpu() are the stage's own share. A Clock that belongs to
+   no StageMeter only serves to take the time spent in items (e.g. waiting
+   on a queue) out of the enclosing stage.
+"""
+class Clock(object):
+
+    def __init__(self, items):
+        self.items = items
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.inner_wall = 0.0
+        self.inner_cpu = 0.0
+        self.variants = 0
+
+    def __iter__(self):
+        stack = getattr(_clocks, 'stack', None)
+        if stack is None:
+            stack = _clocks.stack = []
+        items = iter(self.items)
+        perf_counter = time.perf_counter
+        thread_time = time.thread_time
+
+        while True:
+            stack.append(self)
+            wall = perf_counter()
+            cpu = thread_time()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                cpu = thread_time() - cpu
+                wall = perf_counter() - wall
+                stack.pop()
+                self.wall = self.wall + wall
+                self.cpu = self.cpu + cpu
+                if (len(stack) > 0):
+                    stack[-1].inner_wall = stack[-1].inner_wall + wall
+                    stack[-1].inner_cpu = stack[-1].inner_cpu + cpu
+            if isinstance(item, vr.VcfRecord):
+                self.variants = self.variants + 1
+            yield item
+
+    def ownWall(self):
+        return self.wall - self.inner_wall
+
+    def ownCpu(self):
+        return self.cpu - self.inner_cpu
+
+
+"""Cursor counting the statements run and the rows fetched through it
+"""
+class MeteredCursor(object):
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.queries = 0
+        self.rows = 0
+
+    def execute(self, sql, args=None):
+        self.queries = self.queries + 1
+        if args is None:
+            return self.cursor.execute(sql)
+        return self.cursor.execute(sql, args)
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.rows = self.rows + len(rows)
+        return rows
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.rows = self.rows + 1
+        return row
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+
+"""Stage records of the shards of a job added up, stage by stage
+"""
+def mergeRecords(shards):
+    merged = []
+    for records in zip(*shards):
+        total = dict(records[0])
+        for record in records[1:]:
+            for key, value in record.items():
+                if isinstance(value, (int, float)) and \
+                    not isinstance(value, bool) and (total[key] is not None):
+                    total[key] = total[key] + value
+        for key in ['wall', 'cpu']:
+            total[key] = round(total[key], 6)
+        merged.append(total)
+    return merged
+
+
+"""Process CPU time so far, finished child processes included
+"""
+def cpuTime():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+"""Name of the stage statistics sidecar of an input file
+"""
+def statsFileName(infile):
+    return infile + '.stats.json'
+
+
+"""Writes the statistics of a job to the sidecar of infile
+"""
+def write(infile, stats):
+    with open(statsFileName(infile), 'w') as fh:
+        json.dump(stats, fh, indent=2)
+        fh.write('\n')
+
+
+"""One line per stage, slowest first
+"""
+def summary(stats):
+    lines = [f"Approximate runtime: {stats['wall']:.2f} seconds " + \
+        f"({stats['cpu']:.2f} CPU, {stats['variants']} variants)"]
+    for stage in sorted(stats['stages'], key=lambda s: -s['wall']):
+        lines.append(f"  {stage['name']:<52} {stage['wall']:>8.2f}s " + \
+            f"{stage['cpu']:>8.2f}s CPU {stage['variants']:>9} variants")
+    return '\n'.join(lines)
+
+### EOF
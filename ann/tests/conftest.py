@@ -0,0 +1,83 @@
+# conftest.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Fixtures of the AnnTools tests: the synthetic dataset of bench_data.py
+# (a VCF and a SQLite stand-in for the reference database) and a helper
+# annotating it with driver.run
+#
+# Run from the repository root: python -m pytest -q ann/tests
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import sys
+import shutil
+import contextlib
+
+import pytest
+
+# the modules are imported flat and read ann_config.ini from the working
+# directory, as run.py and annotator.py do
+ANN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ANN_DIR)
+os.chdir(ANN_DIR)
+
+import bench_data as bd
+import bgzf
+import utils as u
+
+BENCH_VARIANTS = 3000
+
+
+"""The bench_data dataset, every reference database opened on its SQLite
+   file; (vcf path, database path)
+"""
+@pytest.fixture(scope='session')
+def bench(tmp_path_factory):
+    vcf, db = bd.makeDataset(str(tmp_path_factory.mktemp('bench')),
+        BENCH_VARIANTS)
+    u.db_use_sqlite(db)
+    yield vcf, db
+    u.db_use_sqlite(None)
+
+
+"""Runs driver.run on a copy of infile in workdir and returns the text of
+   the annotated file; compress and index default to off
+"""
+def annotateCopy(infile, workdir, **kwargs):
+    import driver
+
+    workdir.mkdir()
+    infile = shutil.copy(infile, str(workdir / 'in.vcf'))
+    kwargs = dict({'compress': 'none', 'index': False}, **kwargs)
+    with contextlib.redirect_stdout(io.StringIO()):
+        driver.run(infile, 'vcf', **kwargs)
+    with bgzf.openText(driver.annotatedFileName(infile,
+        kwargs['compress'])) as fh:
+        return fh.read()
+
+
+"""The bench VCF annotated the original way, stage by stage (chained)
+"""
+@pytest.fixture(scope='session')
+def chained(bench, tmp_path_factory):
+    return annotateCopy(bench[0], tmp_path_factory.mktemp('chained') / 'run',
+        fused=False)
+
+
+"""annotate(name, **kwargs) runs driver.run on a copy of the bench VCF in
+   its own directory and returns the text of the annotated file
+"""
+@pytest.fixture
+def annotate(bench, tmp_path):
+
+    def annotate(name, infile=None, **kwargs):
+        return annotateCopy(infile or bench[0], tmp_path / name, **kwargs)
+
+    return annotate
+
+### EOF
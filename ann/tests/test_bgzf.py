@@ -0,0 +1,59 @@
+# test_bgzf.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Round trips of the BGZF reader and writer of bgzf.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import gzip
+
+import pytest
+
+import bgzf
+
+
+def readText(filename):
+    with bgzf.openText(filename) as fh:
+        return fh.read()
+
+
+@pytest.mark.parametrize('threads', [1, 3])
+def test_compress_inflate_round_trip(bench, tmp_path, threads):
+    vcf = bench[0]
+    packed = str(tmp_path / 'in.vcf.gz')
+    plain = str(tmp_path / 'in.vcf')
+
+    bgzf.compressFile(vcf, packed, threads)
+    assert bgzf.isBgzf(packed) and bgzf.isCompressed(packed)
+    bgzf.inflateFile(packed, plain, threads)
+
+    with open(vcf) as fh:
+        text = fh.read()
+    assert readText(packed) == text
+    assert readText(plain) == text
+    # any gzip reader takes the file as a whole
+    with gzip.open(packed, 'rt') as fh:
+        assert fh.read() == text
+
+
+def test_parts_without_eof_concatenate(bench, tmp_path):
+    with open(bench[0]) as fh:
+        lines = fh.readlines()
+    chunks = [lines[i::3] for i in range(3)]
+
+    parts = []
+    for i, chunk in enumerate(chunks):
+        parts.append(str(tmp_path / f"part{i}"))
+        with bgzf.openWrite(parts[-1], 'bgzf', eof=False) as fh:
+            fh.write(''.join(chunk))
+    joined = str(tmp_path / 'joined.gz')
+    bgzf.concat(parts, joined, 'bgzf')
+
+    assert readText(joined) == ''.join(''.join(chunk) for chunk in chunks)
+    with open(joined, 'rb') as fh:
+        assert fh.read().endswith(bgzf.EOF_BLOCK)
+
+### EOF
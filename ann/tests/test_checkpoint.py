@@ -0,0 +1,104 @@
+# test_checkpoint.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# A job that fails part way resumes from its checkpoint manifest (see
+# checkpoint.py) and writes what an uninterrupted run writes
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import glob
+import shutil
+import functools
+import contextlib
+
+import pytest
+
+import bgzf
+import checkpoint as cp
+import driver
+
+
+def runJob(infile, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return driver.run(infile, 'vcf', compress='none', index=False,
+            checkpoint=True, **kwargs)
+
+
+def readText(filename):
+    with bgzf.openText(filename) as fh:
+        return fh.read()
+
+
+def failingStage(*args, **kwargs):
+    raise RuntimeError('stage failed')
+
+
+"""driver.STAGES with the file-based stages of failing replaced by
+   failingStage
+"""
+def failingStages(failing):
+    stages = list(driver.STAGES)
+    for i in failing:
+        label, _, stage, kwargs = stages[i]
+        stages[i] = (label, failingStage, stage, kwargs)
+    return stages
+
+
+def test_fused_job_resumes_after_failed_shard(bench, chained, tmp_path,
+    monkeypatch):
+    infile = shutil.copy(bench[0], str(tmp_path / 'in.vcf'))
+    monkeypatch.setattr(driver, 'runCheckpointed',
+        functools.partial(driver.runCheckpointed,
+            shard_bytes=os.path.getsize(infile) // 4 + 1))
+
+    annotateShard = driver.annotateShard
+    shards = []
+
+    def failAfterTwo(*args):
+        if (len(shards) == 2):
+            raise RuntimeError('shard failed')
+        shards.append(args)
+        return annotateShard(*args)
+
+    with monkeypatch.context() as m:
+        m.setattr(driver, 'annotateShard', failAfterTwo)
+        with pytest.raises(RuntimeError):
+            runJob(infile, fused=True, engine='sql')
+    assert os.path.exists(cp.manifestFileName(infile))
+    # the parts of the finished shards are kept for the relaunch
+    assert len(glob.glob(infile + '.part*')) == 2
+
+    stats = runJob(infile, fused=True, engine='sql')
+    assert stats['resumed'] == 2
+    assert readText(driver.annotatedFileName(infile, 'none')) == chained
+    assert not os.path.exists(cp.manifestFileName(infile))
+    assert glob.glob(infile + '.part*') == []
+
+
+def test_chained_job_resumes_after_failed_stage(bench, chained, tmp_path,
+    monkeypatch):
+    whole = shutil.copy(bench[0], str(tmp_path / 'whole.vcf'))
+    runJob(whole, fused=False)
+
+    infile = shutil.copy(bench[0], str(tmp_path / 'in.vcf'))
+    with monkeypatch.context() as m:
+        m.setattr(driver, 'STAGES', failingStages([3]))
+        with pytest.raises(RuntimeError):
+            runJob(infile, fused=False)
+    assert os.path.exists(cp.manifestFileName(infile))
+
+    # the stages done before the failure are not run again
+    monkeypatch.setattr(driver, 'STAGES', failingStages([0, 1, 2]))
+    stats = runJob(infile, fused=False)
+    assert stats['resumed'] == 1
+    assert readText(driver.annotatedFileName(infile, 'none')) == chained
+    assert readText(infile + '.count.log') == \
+        readText(whole + '.count.log')
+    assert not os.path.exists(cp.manifestFileName(infile))
+
+### EOF
@@ -0,0 +1,117 @@
+# test_columnar.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Round trip of the columnar export of columnar.py: the columns read back
+# hold the fields and INFO values of the annotated file
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import numpy as np
+import pytest
+
+import columnar as co
+import driver
+
+
+"""A value as text or as read from a column, made comparable: numbers and
+   booleans parsed the way the export types them, '.' missing (None)
+"""
+def normalize(value):
+    if (value is None) or (value == '.'):
+        return None
+    value = str(value)
+    if value in co.BOOLS:
+        return co.BOOLS[value]
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+
+"""Values of every key of an INFO field: key -> [value or None]
+"""
+def infoValues(info):
+    values = {}
+    for item in info.split(';'):
+        key, eq, value = item.partition('=')
+        if key not in ('', '.'):
+            values.setdefault(key, []).append(value if eq else None)
+    return values
+
+
+@pytest.mark.parametrize('row_group', [co.ROW_GROUP, 700])
+def test_columns_match_file(annotate, tmp_path, monkeypatch, row_group):
+    monkeypatch.setattr(driver, 'COLUMNAR_ROW_GROUP', row_group)
+    text = annotate('columnar', columnar=True)
+    lines = [line for line in text.splitlines() if not line.startswith('#')]
+    # the export strips the fields, as some stages pad them
+    fields = [[f.strip() for f in line.split('\t')] for line in lines]
+    info = [infoValues(f[7]) for f in fields]
+
+    with co.ColumnFile(co.columnarFileName(driver.annotatedFileName(
+        str(tmp_path / 'columnar' / 'in.vcf'), 'none'))) as cf:
+        assert cf.rows == len(lines)
+        assert len(cf.groups) == -(-len(lines) // row_group)
+        assert cf.read('CHROM').tolist() == [f[0] for f in fields]
+        assert cf.read('POS').tolist() == [int(f[1]) for f in fields]
+        # kept as the strings of the file, '.' missing
+        for i, name in enumerate(['ID', 'REF', 'ALT']):
+            assert cf.read(name).tolist() == \
+                [None if (f[i + 2] == '.') else f[i + 2] for f in fields]
+
+        keys = dict.fromkeys(key for values in info for key in values)
+        assert {name for name in cf.columns() if name.startswith('INFO/')} \
+            == {'INFO/' + key for key in keys}
+        for key in keys:
+            name = 'INFO/' + key
+            column = cf.read(name)
+            flag = all(v is None for values in info
+                for v in values.get(key, []))
+            listed = any('list_offsets' in group['columns'].get(name, {})
+                for group in cf.groups)
+            for row, values in enumerate(info):
+                if flag:
+                    assert bool(column[row]) == (key in values)
+                    continue
+                if listed:
+                    got = column[row].tolist()
+                elif column[row] is np.ma.masked:
+                    got = []
+                else:
+                    got = [column[row]]
+                assert [normalize(v) for v in got] == [normalize(v)
+                    for v in values.get(key, []) if v not in (None, '.')]
+
+
+"""Every column has one type in all row groups, and values are only stored
+   as numbers when they read back as the same text
+"""
+def test_column_types_hold_for_whole_export(tmp_path):
+    lines = ['#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO',
+        '1\t100\t007\tA\tC\t5\tPASS\tK=01;N=3;F=0.5',
+        '1\t200\t8\tA\tC\t5.5\tPASS\tK=2;N=4;F=1.50',
+        'X\t300\trs1\tA\tC\t.\tPASS\tN=5;F=0.25']
+    annotfile = str(tmp_path / 'in.annot.vcf')
+    with open(annotfile, 'w') as fh:
+        fh.write('\n'.join(lines) + '\n')
+    co.export(annotfile, co.columnarFileName(annotfile), row_group=1)
+
+    with co.ColumnFile(co.columnarFileName(annotfile)) as cf:
+        assert cf.read('CHROM').tolist() == ['1', '1', 'X']
+        assert cf.read('ID').tolist() == ['007', '8', 'rs1']
+        assert cf.read('QUAL').tolist() == ['5', '5.5', None]
+        assert cf.read('INFO/K').tolist() == ['01', '2', None]
+        assert cf.read('INFO/F').tolist() == ['0.5', '1.50', '0.25']
+        assert cf.read('INFO/N').tolist() == [3, 4, 5]
+        assert cf.read('POS').dtype == np.int64
+        for name in cf.columns():
+            kinds = {group['columns'][name]['type'] for group in cf.groups
+                if name in group['columns']}
+            assert (len(kinds) == 1) or (kinds == {'str', 'dict'}), name
+
+### EOF
@@ -0,0 +1,114 @@
+# test_equivalence.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Every way of running the pipeline must write the annotated file the
+# original chained stages write, byte for byte, on the bench_data dataset
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import sys
+import gzip
+import shutil
+import functools
+import subprocess
+import contextlib
+
+import pytest
+
+import driver
+import snapshot as sn
+
+"""driver.run arguments of every run compared with the chained one
+"""
+RUNS = {
+    'sql': {'engine': 'sql'},
+    'index': {'engine': 'index'},
+    'sweep': {'engine': 'sweep'},
+    'vector': {'engine': 'vector'},
+    'snapshot': {'engine': 'snapshot'},
+    'parallel': {'engine': 'sql', 'parallel': True},
+    'parallel-index': {'engine': 'index', 'parallel': True},
+    'checkpoint': {'engine': 'sql', 'checkpoint': True},
+    'bgzf': {'engine': 'sql', 'compress': 'bgzf'},
+}
+
+
+"""Output of the baseline pipeline (the chained stages as they were before
+   the fused pass, getBigRefGene included) on the bench dataset, written
+   with PYTHONHASHSEED=0 as the order of some INFO values follows set
+   iteration
+"""
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+    'bench3000.annot.vcf.gz')
+
+
+"""A snapshot of the bench database, built once
+"""
+@pytest.fixture(scope='session')
+def snapshot_dir(bench, tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('snapshot'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        sn.build(directory)
+    return directory
+
+
+@pytest.mark.parametrize('batch_size', [1, 50])
+@pytest.mark.parametrize('run', list(RUNS))
+def test_output_matches_chained(run, batch_size, chained, annotate,
+    snapshot_dir, monkeypatch):
+    monkeypatch.setitem(driver.STAGES[0][3], 'batch_size', batch_size)
+    monkeypatch.setattr(driver, 'SNAPSHOT_DIR', snapshot_dir)
+    # several shards even on a single core
+    monkeypatch.setattr(driver, 'runParallel',
+        functools.partial(driver.runParallel, workers=3))
+    assert annotate(run, **RUNS[run]) == chained
+
+
+def readLog(workdir):
+    with open(str(workdir / 'in.vcf.count.log')) as fh:
+        return fh.read()
+
+
+"""Stages run side by side (see stage_graph.runLevel) write the file and the
+   counters of the stages run one after the other
+"""
+@pytest.mark.parametrize('engine', ['sql', 'vector'])
+def test_concurrent_stages_match_sequential(engine, chained, annotate,
+    tmp_path, monkeypatch):
+    annotate('sequential', engine=engine)
+    monkeypatch.setattr(driver, 'annotateLines',
+        functools.partial(driver.annotateLines, concurrent=True))
+    assert annotate('concurrent', engine=engine) == chained
+    assert readLog(tmp_path / 'concurrent') == \
+        readLog(tmp_path / 'sequential')
+
+
+"""Annotates a copy of the bench VCF in a new interpreter run with
+   PYTHONHASHSEED=0, the seed GOLDEN was written with
+"""
+def annotateSeeded(bench, workdir, **kwargs):
+    infile = shutil.copy(bench[0], str(workdir / 'in.vcf'))
+    script = 'import sys, utils as u, driver; ' + \
+        'u.db_use_sqlite(sys.argv[2]); ' + \
+        'driver.run(sys.argv[1], "vcf", compress="none", index=False, ' + \
+        f'**{kwargs!r})'
+    subprocess.run([sys.executable, '-c', script, infile, bench[1]],
+        cwd=os.path.dirname(os.path.abspath(driver.__file__)),
+        env=dict(os.environ, PYTHONHASHSEED='0'),
+        stdout=subprocess.DEVNULL, check=True)
+    with open(driver.annotatedFileName(infile, 'none')) as fh:
+        return fh.read()
+
+
+@pytest.mark.parametrize('run', ['chained', 'sql'])
+def test_output_matches_baseline_golden(run, bench, tmp_path):
+    kwargs = {'fused': False} if (run == 'chained') else RUNS[run]
+    with gzip.open(GOLDEN, 'rt') as fh:
+        assert annotateSeeded(bench, tmp_path, **kwargs) == fh.read()
+
+### EOF
@@ -0,0 +1,65 @@
+# test_interval_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the stabbing indexes of interval_index.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import random
+
+import interval_index as ix
+
+
+"""Random intervals on two chromosomes as (chrom, start, end, ordinal)
+"""
+def randomIntervals(rng, n):
+    return [(rng.choice(['1', '2']), start, start + rng.choice([0, 5, 50,
+        500, 5000]), k) for k, start in enumerate(rng.randint(0, 10000)
+        for _ in range(n))]
+
+
+def buildIndex(intervals):
+    index = ix.IntervalIndex()
+    for chrom, start, end, k in intervals:
+        index.add(chrom, start, end, ('row', k))
+    return index.build()
+
+
+def sweepIndex(intervals, index):
+    def rowsFor(chrom):
+        for c, start, end, k in sorted(intervals, key=lambda i: i[1]):
+            if (c == chrom):
+                yield start, end, k, ('row', k)
+    return ix.SweepIndex(rowsFor, lambda: index)
+
+
+def test_sweep_returns_rows_in_table_order_as_index():
+    rng = random.Random(4)
+    intervals = randomIntervals(rng, 400)
+    index = buildIndex(intervals)
+    sweep = sweepIndex(intervals, index)
+    for chrom in ['1', '2']:
+        for pos in sorted(rng.randint(0, 16000) for _ in range(300)):
+            assert sweep.stab(chrom, pos) == index.stab(chrom, pos)
+            assert sweep.first(chrom, pos) == index.first(chrom, pos)
+    assert sweep.index is None
+
+
+def test_sweep_hands_over_to_index_on_unsorted_input():
+    rng = random.Random(5)
+    intervals = randomIntervals(rng, 100)
+    index = buildIndex(intervals)
+    sweep = sweepIndex(intervals, index)
+    sweep.stab('1', 5000)
+    assert sweep.stab('1', 100) == index.stab('1', 100)
+    assert sweep.index is index
+
+
+def test_sweep_engine_output_matches_index_engine(annotate):
+    assert annotate('sweep', engine='sweep') == \
+        annotate('index', engine='index')
+
+### EOF
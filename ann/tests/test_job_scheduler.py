@@ -0,0 +1,68 @@
+# test_job_scheduler.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the admission control of job_scheduler.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import job_scheduler as js
+import worker_pool as wp
+
+
+"""Stand-in for worker_pool.WorkerPool whose jobs finish on the next poll
+"""
+class FakePool(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.jobs = {}
+
+    def idle(self):
+        return list(range(self.size - len(self.jobs)))
+
+    def submit(self, job_id, cwd, args):
+        self.jobs[job_id] = wp.Job(job_id, cwd, list(args))
+
+    def poll(self, timeout=0):
+        finished = [(job, 'done', None) for job in self.jobs.values()]
+        self.jobs = {}
+        return finished
+
+
+def test_jobs_are_launched_only_when_admitted():
+    launched = []
+    scheduler = js.Scheduler(cpu_slots=1, memory_mb=0, db_connections=0,
+        pool=FakePool(2), on_launch=lambda job: launched.append(job.job_id))
+
+    scheduler.submit('a', '.', [], None)
+    scheduler.submit('b', '.', [], None)
+    assert launched == ['a']
+    assert scheduler.queued() == ['b']
+
+    scheduler.poll()
+    assert launched == ['a', 'b']
+    assert scheduler.queued() == []
+
+
+def test_pooled_connections_count_against_budget():
+    resident = js.residentConnections()
+    scheduler = js.Scheduler(cpu_slots=8, memory_mb=0,
+        db_connections=5 * resident, pool=FakePool(3))
+    assert scheduler.used.connections == 4 * resident
+
+    # a job run in a worker reuses the connections the worker holds
+    demand = js.estimateDemand(resident=resident)
+    assert demand.connections == max(0, js.estimateDemand().connections -
+        resident)
+
+
+def test_pool_is_sized_from_connection_budget():
+    resident = js.residentConnections()
+    assert js.poolSize(8, db_connections=4 * resident) == 3
+    assert js.poolSize(8, db_connections=0) == 8
+    assert js.poolSize(8, db_connections=1) == 1
+
+### EOF
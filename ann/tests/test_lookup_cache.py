@@ -0,0 +1,96 @@
+# test_lookup_cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the cross-job lookup cache of lookup_cache.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sqlite3
+
+import driver
+import lookup_cache as lc
+
+
+def makeDatabase(path, name):
+    conn = sqlite3.connect(str(path))
+    conn.execute('create table genes (chrom text, pos integer, name text);')
+    conn.execute('insert into genes values ("1", 100, ?);', (name,))
+    conn.commit()
+    return conn
+
+
+"""Turns the cache of this process on (off once the test is over)
+"""
+def enableCache(monkeypatch):
+    settings = dict(lc.cacheConfig(), enabled=True, disk_store='')
+    monkeypatch.setattr(lc, 'cacheConfig', lambda: settings)
+    monkeypatch.setattr(lc, '_cache', None)
+    return lc.getCache()
+
+
+def test_cache_keys_on_database_and_position(tmp_path):
+    cache = lc.LookupCache(10)
+    sql = 'select name from genes where chrom = "1" and pos = 100;'
+    names = []
+    for path, name in ((tmp_path / 'a.db', 'A'), (tmp_path / 'b.db', 'B')):
+        cursor = lc.CachedCursor(makeDatabase(path, name).cursor(), cache)
+        for _ in range(2):
+            names.append(lc.fetchRow(cursor, ('genes', '1', 100), sql)[0])
+        assert (cursor.hits == 1) and (cursor.misses == 1)
+    assert names == ['A', 'A', 'B', 'B']
+
+
+def test_batched_lookups_split_per_key(tmp_path):
+    conn = makeDatabase(tmp_path / 'a.db', 'A')
+    conn.execute('insert into genes values ("1", 200, "B");')
+    cursor = lc.CachedCursor(conn.cursor(), lc.LookupCache(10))
+    statements = []
+
+    def sql(keys):
+        statements.append(keys)
+        return 'select * from genes where pos in (' + \
+            ', '.join(str(key[2]) for key in keys) + ');'
+
+    def keyOf(names):
+        return lambda row: ('genes', row[0], row[1])
+
+    keys = [('genes', '1', pos) for pos in (100, 200, 300)]
+    found = lc.fetchRowsMany(cursor, keys[:2], sql, keyOf)
+    assert found == {keys[0]: (('1', 100, 'A'),), keys[1]: (('1', 200, 'B'),)}
+    # single lookups and other batches reuse the rows of every position
+    assert lc.fetchRows(cursor, keys[1], 'select 1;') == (('1', 200, 'B'),)
+    found = lc.fetchRowsMany(cursor, keys, sql, keyOf)
+    assert found[keys[2]] == ()
+    assert statements == [keys[:2], keys[2:]]
+    assert (cursor.hits == 3) and (cursor.misses == 3)
+
+
+def test_version_change_empties_resident_caches(monkeypatch):
+    import interval_index as ix
+    import snapshot as sn
+    import transcripts as tm
+
+    caches = (ix._indexes, sn._snapshots, tm._transcripts)
+    monkeypatch.setattr(lc, '_version', '1')
+    for cache in caches:
+        monkeypatch.setitem(cache, 'stale', None)
+    lc.checkVersion('1')
+    assert all('stale' in cache for cache in caches)
+    lc.checkVersion('2')
+    assert not any('stale' in cache for cache in caches)
+
+
+def test_cached_dbsnp_batches_match_uncached(annotate, monkeypatch):
+    monkeypatch.setitem(driver.STAGES[0][3], 'batch_size', 50)
+    expected = annotate('uncached', engine='sql')
+
+    cache = enableCache(monkeypatch)
+    assert annotate('cold', engine='sql') == expected
+    misses = cache.misses
+    assert annotate('warm', engine='sql') == expected
+    assert (cache.misses == misses) and (cache.hits > 0)
+
+### EOF
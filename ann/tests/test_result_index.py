@@ -0,0 +1,94 @@
+# test_result_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Round trips of the random-access index of result_index.py: regions and
+# pages read through the index are the records of the annotated file
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import random
+
+import pytest
+
+import bgzf
+import driver
+import result_index as ri
+
+
+def dataLines(text):
+    return [line for line in text.splitlines() if not line.startswith('#')]
+
+
+"""Annotates the bench VCF with compress and returns (annotated file, its
+   text)
+"""
+def annotatedFile(annotate, tmp_path, compress):
+    text = annotate(compress, compress=compress)
+    return driver.annotatedFileName(str(tmp_path / compress / 'in.vcf'),
+        compress), text
+
+
+@pytest.mark.parametrize('compress', ['none', 'bgzf'])
+def test_regions_match_file(annotate, tmp_path, compress):
+    outfile, text = annotatedFile(annotate, tmp_path, compress)
+    index = ri.buildIndex(outfile, bucket=1000, every=500)
+    ri.write(outfile, index)
+    index = ri.load(outfile)
+    lines = dataLines(text)
+    assert index['records'] == len(lines)
+
+    records = [(line, line.split('\t', 2)[0], int(line.split('\t', 2)[1]))
+        for line in lines]
+    rng = random.Random(1)
+    for chrom in dict.fromkeys(c for _, c, _ in records):
+        found = [p for _, c, p in records if (c == chrom)]
+        windows = [(0, None)] + [tuple(sorted(rng.sample(found, 2)))
+            for _ in range(5) if (len(found) > 1)]
+        for start, end in windows:
+            expected = [line for line, c, p in records if (c == chrom) and
+                (p >= start) and ((end is None) or (p <= end))]
+            assert ri.readRegion(outfile, index, chrom, start, end) == \
+                expected
+
+
+@pytest.mark.parametrize('compress', ['none', 'bgzf'])
+def test_pages_match_file(annotate, tmp_path, compress):
+    outfile, text = annotatedFile(annotate, tmp_path, compress)
+    index = ri.buildIndex(outfile, every=700)
+
+    pages = []
+    with open(outfile, 'rb') as fh:
+        page = 0
+        while ri.pageOffsets(index, page) is not None:
+            first, last = ri.pageOffsets(index, page)
+            lo, hi = ri.byteRange(index, first, last)
+            fh.seek(lo)
+            pages.append(ri.decodeRange(index, fh.read(hi - lo), first,
+                last))
+            page = page + 1
+
+    assert len(pages) == -(-index['records'] // 700)
+    assert dataLines(''.join(pages)) == dataLines(text)
+
+
+"""Blank lines and lines without a numeric POS, which the stages pass
+   through, are neither indexed nor read as records
+"""
+@pytest.mark.parametrize('compress', ['none', 'bgzf'])
+def test_unparsed_lines_are_skipped(tmp_path, compress):
+    lines = ['##fileformat=VCFv4.1', '#CHROM\tPOS\tID', '1\t100\ta', '',
+        '1\tPOS\tb', '1\t200\tc', 'x', '2\t50\td']
+    outfile = str(tmp_path / 'in.annot.vcf')
+    with bgzf.openWrite(outfile, compress) as fh:
+        fh.write('\n'.join(lines) + '\n')
+
+    index = ri.buildIndex(outfile, bucket=100, every=2)
+    assert index['records'] == 3
+    assert ri.readRegion(outfile, index, '1') == ['1\t100\ta', '1\t200\tc']
+    assert ri.readRegion(outfile, index, '1', 150) == ['1\t200\tc']
+    assert ri.readRegion(outfile, index, '2') == ['2\t50\td']
+
+### EOF
@@ -0,0 +1,91 @@
+# test_worker_pool.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the resident annotation workers of worker_pool.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import time
+import shutil
+
+import bgzf
+import driver
+import run
+import worker_pool as wp
+
+
+"""Stand-in for boto3 keeping what a job sends to AWS under directory:
+   uploads in <bucket>/<key>, the last job item update in item.json
+"""
+class FakeAws(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def client(self, service, region_name=None):
+        return self
+
+    def resource(self, service, region_name=None):
+        return self
+
+    def upload_file(self, path, bucket, key):
+        target = os.path.join(self.directory, bucket, key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy(path, target)
+
+    def start_execution(self, **kwargs):
+        return {}
+
+    def Table(self, name):
+        return self
+
+    def update_item(self, **kwargs):
+        with open(os.path.join(self.directory, 'item.json'), 'w') as fh:
+            json.dump(kwargs['ExpressionAttributeValues'], fh, default=str)
+
+
+def finish(pool, timeout=300):
+    deadline = time.time() + timeout
+    finished = []
+    while (pool.busy() or pool.queued()) and (time.time() < deadline):
+        finished.extend(pool.poll(1))
+    return finished
+
+
+def test_parallel_job_runs_in_resident_worker(bench, annotate, tmp_path,
+    monkeypatch):
+    expected = annotate('serial')
+    aws = tmp_path / 'aws'
+    monkeypatch.setattr(run, 'boto3', FakeAws(str(aws)))
+    monkeypatch.setitem(driver.config['pipeline'], 'Parallel', 'true')
+
+    jobs_dir = tmp_path / 'jobs'
+    job_dir = jobs_dir / 'job-1'
+    job_dir.mkdir(parents=True)
+    infile = shutil.copy(bench[0], str(job_dir / 'in.vcf'))
+
+    pool = wp.WorkerPool(run.annotateJob, workers=1)
+    pool.start()
+    try:
+        pool.submit('job-1', str(job_dir), [infile, 'job-1', 'user-1',
+            str(jobs_dir), 'us-east-1', 'tester', 'results', 'jobs',
+            'arn:states'])
+        finished = finish(pool)
+    finally:
+        pool.close(timeout=30)
+
+    assert [(job.job_id, status, error)
+        for job, status, error in finished] == [('job-1', 'done', None)]
+    with open(aws / 'item.json') as fh:
+        item = json.load(fh)
+    assert item[':val5'] == 'COMPLETED'
+    with bgzf.openText(str(aws / 'results' / item[':val2'])) as fh:
+        assert fh.read() == expected
+    assert not job_dir.exists()
+
+### EOF
@@ -0,0 +1,95 @@
+# transcripts.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Compiled refGene transcript models
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+import lookup_cache as lc
+
+# Transcripts compiled by this worker process, keyed by refGene row; the
+# least recently used are dropped past MAX_TRANSCRIPTS
+_transcripts = OrderedDict()
+lc.onVersionChange(_transcripts.clear)
+MAX_TRANSCRIPTS = 200000
+
+# refGene columns written in front of the region of a transcript, as
+# collapseGeneNames does with annotate.indicesKnownGenes
+LABEL_COLUMNS = [(12, 'name2'), (1, 'name'), (3, 'transcriptStrand')]
+
+
+"""A refGene row with its exon bounds parsed into int arrays
+
+   Exons are matched as start <= pos <= end. When starts and ends are both
+   in increasing order (as in refGene) the matching exons are found with
+   two bisections, otherwise every exon is tested.
+"""
+class Transcript(object):
+
+    __slots__ = ('txStart', 'txEnd', 'cdsStart', 'cdsEnd', 'exonCount',
+        'exonStarts', 'exonEnds', 'strand', 'label', 'ordered')
+
+    def __init__(self, row):
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.exonStarts = array('q', parseBounds(row[9], self.exonCount))
+        self.exonEnds = array('q', parseBounds(row[10], self.exonCount))
+        self.strand = str(row[3])
+
+        names = []
+        for i, name in LABEL_COLUMNS:
+            r = str(row[i])
+            if (len(r) > 0):
+                names.append(name + '=' + r.strip() + ';')
+        self.label = ''.join(names)
+
+        self.ordered = all(self.exonStarts[e] <= self.exonStarts[e + 1] and
+            self.exonEnds[e] <= self.exonEnds[e + 1]
+            for e in range(len(self.exonStarts) - 1))
+
+    """Indices of the exons containing pos, in increasing order
+    """
+    def exonsAt(self, pos):
+        if (len(self.exonStarts) < self.exonCount) or \
+            (len(self.exonEnds) < self.exonCount):
+            raise IndexError(f"exonCount {self.exonCount} exceeds the " + \
+                "exon bounds of the transcript")
+        if self.ordered:
+            return range(bisect_left(self.exonEnds, pos),
+                bisect_right(self.exonStarts, pos))
+        return [e for e in range(self.exonCount)
+            if self.exonStarts[e] <= pos <= self.exonEnds[e]]
+
+
+"""First count values of a comma separated list of exon bounds
+"""
+def parseBounds(blob, count):
+    if isinstance(blob, bytes):
+        blob = blob.decode('utf-8')
+    return [int(b) for b in str(blob).split(',')[:count]]
+
+
+"""Returns the compiled model of a refGene row, compiling it on first use in
+   this worker process
+"""
+def getTranscript(row):
+    tx = _transcripts.get(row)
+    if tx is not None:
+        _transcripts.move_to_end(row)
+        return tx
+    tx = _transcripts[row] = Transcript(row)
+    while (len(_transcripts) > MAX_TRANSCRIPTS):
+        _transcripts.popitem(last=False)
+    return tx
+
+### EOF
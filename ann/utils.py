@@ -13,25 +13,95 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import sqlite3
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+    'ann_config.ini'))
+
+# Seconds the RDS secret is reused before it is fetched again
+DB_SECRET_TTL = config.getint('database', 'SecretTTL', fallback=300)
+# Idle connections kept open by the pool of this worker process
+DB_POOL_SIZE = config.getint('database', 'PoolSize', fallback=4)
+# Connections idle for longer than this are pinged before reuse (seconds)
+DB_HEALTH_CHECK_INTERVAL = config.getint('database', 'HealthCheckInterval',
+    fallback=30)
+
+# Reference database of the stages not given another in [backends]:
+# mysql (RDS) or sqlite (the local file SqliteFile)
+DB_BACKEND = config.get('database', 'Backend', fallback='mysql')
+DB_SQLITE_FILE = config.get('database', 'SqliteFile', fallback='')
+# Primary key of the MySQL reference tables, the order rows are numbered in
+DB_ROW_KEY = config.get('database', 'RowKey', fallback='id')
+
+# MySQL error code for a rejected login (e.g. after a secret rotation)
+ER_ACCESS_DENIED = 1045
+
+_secret = {'value': None, 'expires': 0}
+_secret_lock = threading.Lock()
+
+# SQLite file every backend is opened on, see db_use_sqlite()
+_sqlite = {'path': None, 'factory': None}
+
+
+"""Get the RDS secret from AWS Secrets Manager, reusing it for DB_SECRET_TTL
+   seconds; refresh=True fetches it again regardless
 """
-def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+def db_secret(refresh=False):
+    with _secret_lock:
+        if refresh or _secret['value'] is None or \
+            time.time() >= _secret['expires']:
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+            AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+                ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+            asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(
+                    SecretId='rds/anntools_database')
+                _secret['value'] = json.loads(asm_response['SecretString'])
+            except ClientError as e:
+                print("Unable to retrieve RDS credentials from AWS Secrets " + \
+                    f"Manager: {e}")
+                raise e
+            _secret['expires'] = time.time() + DB_SECRET_TTL
+
+        return _secret['value']
+
+
+"""Get connection to reference database of a backend, Backend by default
+   mysql: credentials come from the cached secret; a rejected login
+   refreshes the secret once in case it was rotated
+   sqlite: the file SqliteFile, with the tables and columns of the
+   annotator schema
+"""
+def db_connect(backend=None):
+    backend = backend or DB_BACKEND
+    if _sqlite['path'] is not None:
+        return sqlite3.connect(_sqlite['path'],
+            factory=_sqlite['factory'], check_same_thread=False)
+    if (backend == 'sqlite'):
+        return sqlite3.connect(DB_SQLITE_FILE, factory=SqliteConnection,
+            check_same_thread=False)
+    if (backend != 'mysql'):
+        raise ValueError(f"Unknown reference database backend: {backend}")
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
+        return db_open(db_secret())
+    except pymysql.err.OperationalError as e:
+        if (e.args[0] != ER_ACCESS_DENIED):
+            raise e
+        return db_open(db_secret(refresh=True))
+
 
+"""Open a connection with the given RDS secret
+"""
+def db_open(rds_secret):
     # Extract database connection parameters
     rds_host = rds_secret['host']
     mysql_port = rds_secret['port']
@@ -48,6 +118,169 @@ def db_connect():
         db=database_name)
 
 
+"""SQLite connection with the parts of the PyMySQL connection API the
+   pool relies on
+"""
+class SqliteConnection(sqlite3.Connection):
+
+    def ping(self, reconnect=True):
+        self.execute('select 1;')
+
+
+"""Open every new reference database connection, whatever its backend,
+   on a local SQLite file with the tables and columns of the annotator
+   schema (see bench_data.py); path=None goes back to the backends
+   factory is the sqlite3.Connection class used, SqliteConnection or a
+   subclass of it
+"""
+def db_use_sqlite(path, factory=SqliteConnection):
+    for pool in list(_pools.values()):
+        pool.close()
+    _sqlite['path'] = path
+    _sqlite['factory'] = factory
+
+
+"""Pool of reference database connections shared by every stage of a job
+   and by successive jobs in the same worker process
+
+   acquire() hands out an idle connection (pinging it first if it has been
+   idle for longer than health_check seconds, and replacing it if the ping
+   fails) or opens a new one. release() ends the connection's transaction so
+   the next user sees current data, and keeps it for reuse unless the pool
+   is full or the connection is broken.
+"""
+class DbPool(object):
+
+    def __init__(self, size=DB_POOL_SIZE,
+        health_check=DB_HEALTH_CHECK_INTERVAL, backend=None):
+        self.backend = backend
+        self.size = size
+        self.health_check = health_check
+        self.idle = []
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+        self.reconnected = 0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if (len(self.idle) == 0):
+                    break
+                conn, released = self.idle.pop()
+            if (time.time() - released < self.health_check):
+                self.reused = self.reused + 1
+                return conn
+            try:
+                conn.ping(reconnect=True)
+                self.reused = self.reused + 1
+                return conn
+            except Exception as e:
+                print(f"Dropping stale database connection: {e}")
+                self.reconnected = self.reconnected + 1
+                db_close(conn)
+
+        self.opened = self.opened + 1
+        return db_connect(self.backend)
+
+    def release(self, conn):
+        try:
+            conn.rollback()
+        except Exception:
+            db_close(conn)
+            return
+        with self.lock:
+            if (len(self.idle) < self.size):
+                self.idle.append((conn, time.time()))
+                return
+        db_close(conn)
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn, _ in idle:
+            db_close(conn)
+
+    # A forked child must not use (or close) the sockets of its parent
+    def forget(self):
+        self.idle = []
+        self.lock = threading.Lock()
+
+
+"""Close a connection, ignoring errors from one that is already broken
+"""
+def db_close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+# One pool per backend, and the pool of each connection handed out
+_pools = {}
+_leased = {}
+_pools_lock = threading.Lock()
+
+
+"""Pool of the connections to a backend (Backend by default)
+"""
+def db_pool(backend=None):
+    backend = backend or DB_BACKEND
+    with _pools_lock:
+        if backend not in _pools:
+            _pools[backend] = DbPool(backend=backend)
+        return _pools[backend]
+
+
+# A forked child must not use (or close) the sockets of its parent
+def db_forget_pools():
+    global _pools_lock
+    for pool in _pools.values():
+        pool.forget()
+    _leased.clear()
+    _pools_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=db_forget_pools)
+
+
+"""Get a pooled connection to the reference database of a backend (Backend
+   by default); hand it back with db_release() instead of closing it
+"""
+def db_acquire(backend=None):
+    pool = db_pool(backend)
+    conn = pool.acquire()
+    _leased[id(conn)] = pool
+    return conn
+
+
+"""Return a connection obtained from db_acquire() to its pool
+"""
+def db_release(conn):
+    pool = _leased.pop(id(conn), None) or db_pool()
+    pool.release(conn)
+
+
+"""Unbuffered cursor: rows are streamed from the server as they are read
+   (SQLite cursors already step through rows as they are read)
+"""
+def db_stream_cursor(conn):
+    if isinstance(conn, sqlite3.Connection):
+        return conn.cursor()
+    return conn.cursor(pymysql.cursors.SSCursor)
+
+
+"""Column that orders the rows of a reference table the way the server reads
+   them: the rowid of a SQLite table, the primary key RowKey of a MySQL
+   (InnoDB) one
+"""
+def db_row_key(conn):
+    if isinstance(conn, sqlite3.Connection):
+        return 'rowid'
+    return DB_ROW_KEY
+
+
 """Column inices for pileup and VCF
 """
 def getFormatSpecificIndices(format='vcf'):
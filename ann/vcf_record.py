@@ -0,0 +1,154 @@
+# vcf_record.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Parsed VCF/pileup record passed between the annotation stages
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import utils as u
+
+INFO = 7
+
+
+"""One data line, split once and written once
+
+   chrom is the chromosome as written in the file, code the same without
+   the "chr" prefix (dbSNP, bigRefGene, gadAll, tfbsConsSites) and ucsc
+   with it (UCSC tables); pos is the position as an int. INFO is kept as a
+   list of fragments that stages append to and that is only joined when a
+   stage reads it or the record is written; values read from it are parsed
+   once until it changes.
+"""
+class VcfRecord(object):
+
+    __slots__ = ('fields', 'chrom', 'code', 'ucsc', 'pos', 'info', 'values')
+
+    def __init__(self, fields, chrom, pos):
+        self.fields = fields
+        self.chrom = chrom
+        self.code = chrom.replace('chr', '') if chrom.startswith('chr') \
+            else chrom
+        self.ucsc = chrom if chrom.startswith('chr') else 'chr' + chrom
+        self.pos = pos
+        self.info = [fields[INFO]] if (len(fields) > INFO) else None
+        self.values = None
+
+    def infoText(self):
+        if (len(self.info) > 1):
+            self.info = [''.join(self.info)]
+        return self.info[0]
+
+    def infoEndsWith(self, suffix):
+        for fragment in reversed(self.info):
+            if fragment:
+                return fragment.endswith(suffix)
+        return ''.endswith(suffix)
+
+    """Appends text to INFO as is
+    """
+    def addInfo(self, text):
+        self.info.append(text)
+        self.values = None
+
+    """Appends a fragment to INFO, separated by ';' unless INFO already ends
+       with one
+    """
+    def appendInfo(self, fragment):
+        if self.infoEndsWith(';'):
+            self.info.append(fragment)
+        else:
+            self.info.append(';' + fragment)
+        self.values = None
+
+    def setInfo(self, text):
+        self.info = [text]
+        self.values = None
+
+    """Value of the first INFO key containing key (see utils.parse_field),
+       read with quotes removed
+    """
+    def infoValue(self, key):
+        if self.values is None:
+            self.values = {}
+        if key not in self.values:
+            text = self.infoText().replace("\"", "").replace("\'", "")
+            self.values[key] = str(u.parse_field(text.strip(), key, ';', '='))
+        return self.values[key]
+
+    """Each stage used to read its input stripped, which removes trailing
+       blanks from INFO when it is the last column
+    """
+    def strip(self):
+        if (len(self.fields) == INFO + 1):
+            text = self.infoText()
+            if text != text.rstrip():
+                self.info = [text.rstrip()]
+                self.values = None
+        return self
+
+    """Prefixes every column but the first with a space, as written by
+       addOverlapWithGadAll ('\\t '.join) for the records it annotates
+    """
+    def padFields(self):
+        for i in range(1, len(self.fields)):
+            if (i != INFO):
+                self.fields[i] = ' ' + self.fields[i]
+        self.info.insert(0, ' ')
+        self.values = None
+
+    def copy(self):
+        record = VcfRecord.__new__(VcfRecord)
+        record.fields = list(self.fields)
+        record.chrom = self.chrom
+        record.code = self.code
+        record.ucsc = self.ucsc
+        record.pos = self.pos
+        record.info = list(self.info) if self.info is not None else None
+        record.values = self.values
+        return record
+
+    def __str__(self):
+        if self.info is None:
+            return '\t'.join(self.fields)
+        self.fields[INFO] = self.infoText()
+        return '\t'.join(self.fields)
+
+
+"""Returns item as a VcfRecord, or as a stripped line for comment, header
+   and other lines without a numeric position, which stages pass through
+"""
+def record(item, sep='\t'):
+    if isinstance(item, VcfRecord):
+        return item.strip()
+
+    line = item.strip()
+    if line.startswith('#'):
+        return line
+    fields = line.split(sep)
+    if (len(fields) < 2):
+        return line
+    try:
+        pos = int(fields[1].strip())
+    except ValueError:
+        return line
+    return VcfRecord(fields, fields[0].strip(), pos)
+
+
+"""Records of lines (or of the records of an upstream stage)
+"""
+def records(lines, sep='\t'):
+    for item in lines:
+        yield record(item, sep=sep)
+
+
+"""Copy of a record for another consumer; lines are returned as they are
+"""
+def copy(item):
+    if isinstance(item, VcfRecord):
+        return item.copy()
+    return item
+
+### EOF
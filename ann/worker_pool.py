@@ -0,0 +1,210 @@
+# worker_pool.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Resident pool of annotation workers: processes forked once, after the
+# parent has imported the pipeline and loaded what it keeps in memory, that
+# run one job after another instead of a new interpreter per job
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import atexit
+import traceback
+import collections
+import multiprocessing
+from multiprocessing.connection import wait
+
+
+"""A job of the pool: target(*args) run with cwd as working directory
+"""
+Job = collections.namedtuple('Job', ['job_id', 'cwd', 'args'])
+
+
+"""Body of a worker process: runs initializer, then the jobs sent over
+   conn until it gets None or has run max_jobs of them
+   Every job is run in its own working directory and reported back as
+   ('done' | 'failed', job_id, error)
+"""
+def workerMain(conn, target, initializer, max_jobs):
+    if initializer is not None:
+        initializer()
+    home = os.getcwd()
+    handled = 0
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            # the pool is gone
+            break
+        if job is None:
+            break
+        status = 'done'
+        error = None
+        try:
+            os.makedirs(job.cwd, exist_ok=True)
+            os.chdir(job.cwd)
+            target(*job.args)
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                status = 'failed'
+                error = f"exit status {e.code}"
+        except Exception:
+            status = 'failed'
+            error = traceback.format_exc()
+        finally:
+            os.chdir(home)
+            sys.stdout.flush()
+        conn.send((status, job.job_id, error))
+        handled = handled + 1
+        if max_jobs and (handled >= max_jobs):
+            break
+    conn.close()
+
+
+"""Pool of workers forked from this process running target for each job
+   Jobs wait in a local run queue until a worker is idle. A worker that
+   dies is replaced and its job run again up to retries times, then
+   reported as failed; workers are also replaced after max_jobs jobs (0:
+   never) so that what a job leaves behind does not pile up.
+   poll() has to be called regularly to dispatch jobs and collect results.
+   Workers are not daemonic, so that a job can run its own pool of
+   processes (Parallel=true); close() stops them, and is run at exit if it
+   was not called.
+"""
+class WorkerPool(object):
+
+    def __init__(self, target, workers=0, initializer=None, max_jobs=0,
+        retries=1):
+        self.target = target
+        self.size = workers or os.cpu_count()
+        self.initializer = initializer
+        self.max_jobs = max_jobs
+        self.retries = retries
+        self.context = multiprocessing.get_context('fork')
+        self.queue = collections.deque()
+        self.workers = {}
+        self.jobs = {}
+        self.attempts = {}
+        self.next_id = 0
+        atexit.register(self.close)
+
+    def start(self):
+        while (len(self.workers) < self.size):
+            self.spawn()
+
+    def spawn(self):
+        parent, child = self.context.Pipe()
+        process = self.context.Process(target=workerMain, args=(child,
+            self.target, self.initializer, self.max_jobs))
+        process.start()
+        child.close()
+        self.workers[self.next_id] = (process, parent)
+        self.next_id = self.next_id + 1
+
+    """Queues a job; it is dispatched by this or a later poll()
+    """
+    def submit(self, job_id, cwd, args):
+        self.queue.append(Job(job_id, cwd, list(args)))
+        self.dispatch()
+
+    def idle(self):
+        return [wid for wid in self.workers if wid not in self.jobs]
+
+    def busy(self):
+        return len(self.jobs)
+
+    def queued(self):
+        return len(self.queue)
+
+    def dispatch(self):
+        for wid in self.idle():
+            if not self.queue:
+                break
+            job = self.queue.popleft()
+            try:
+                self.workers[wid][1].send(job)
+            except (BrokenPipeError, OSError):
+                # the worker is gone; poll() replaces it
+                self.queue.appendleft(job)
+                continue
+            self.jobs[wid] = job
+
+    """Collects the results of finished jobs, waiting up to timeout seconds
+       for one, replaces dead workers and dispatches queued jobs
+       Returns the finished jobs as (job, status, error)
+    """
+    def poll(self, timeout=0):
+        finished = []
+        sources = {}
+        for wid, (process, conn) in self.workers.items():
+            sources[conn] = wid
+            sources[process.sentinel] = wid
+        ready = wait(list(sources), timeout) if sources else []
+
+        dead = set()
+        for source in ready:
+            wid = sources[source]
+            process, conn = self.workers[wid]
+            if (source is conn):
+                try:
+                    status, job_id, error = conn.recv()
+                except (EOFError, OSError):
+                    dead.add(wid)
+                    continue
+                job = self.jobs.pop(wid)
+                self.attempts.pop(job.job_id, None)
+                finished.append((job, status, error))
+            else:
+                dead.add(wid)
+
+        for wid in dead:
+            process, conn = self.workers.pop(wid)
+            process.join()
+            job = self.jobs.pop(wid, None)
+            # a worker retiring after max_jobs reports its last job first
+            try:
+                if (job is not None) and conn.poll():
+                    status, job_id, error = conn.recv()
+                    self.attempts.pop(job.job_id, None)
+                    finished.append((job, status, error))
+                    job = None
+            except (EOFError, OSError):
+                pass
+            conn.close()
+            if job is not None:
+                attempts = self.attempts.get(job.job_id, 0) + 1
+                if (attempts <= self.retries):
+                    self.attempts[job.job_id] = attempts
+                    self.queue.appendleft(job)
+                else:
+                    self.attempts.pop(job.job_id, None)
+                    finished.append((job, 'failed', "worker exited with " + \
+                        f"status {process.exitcode}"))
+
+        self.start()
+        self.dispatch()
+        return finished
+
+    """Lets the workers finish their jobs and stops them; workers still
+       running after timeout seconds (None: no limit) are terminated
+    """
+    def close(self, timeout=None):
+        for process, conn in self.workers.values():
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process, conn in self.workers.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            conn.close()
+        self.workers = {}
+        self.jobs = {}
+
+### EOF
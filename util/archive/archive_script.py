@@ -29,6 +29,13 @@ RESULT_BUCKET=config['s3']['AWS_S3_RESULTS_BUCKET']
 VAULT_NAME=config['glacier']['VAULT_NAME']
 TABLE_NAME=config['dynamodb']['AWS_DYNAMODB_ANNOTATIONS_TABLE']
 
+# Files of a job archived together: the DynamoDB attribute of the S3 key of
+# each file and the one its Glacier archive ID is put in (the result index
+# and columnar export are only there if the job wrote them)
+ARCHIVED_FILES = [('s3_key_result_file', 'results_file_archive_id'),
+  ('s3_key_index_file', 'index_file_archive_id'),
+  ('s3_key_columnar_file', 'columnar_file_archive_id')]
+
 
 '''Capstone - Exercise 7
 Archive free user results files
@@ -98,12 +105,24 @@ def handle_archive_queue(sqs=None):
 
       assert user_role == config['gas']['FREE_USER_IDENTIFIER']
       print("Still a free user, archiving")
+      try:
+        dynamodb = boto3.resource('dynamodb', region_name=region)
+        ann_table = dynamodb.Table(TABLE_NAME)
+        item = ann_table.get_item(Key={'job_id': job_id})['Item']
+      except (ClientError, KeyError) as e:
+        print("Cannot get the job from DynamoDB ", e)
+        sys.exit(1)
+      # the message names the result file
+      keys = [(annot_file, ARCHIVED_FILES[0][1])]
+      keys.extend((item[key_name], archive_name)
+        for key_name, archive_name in ARCHIVED_FILES[1:] if item.get(key_name))
+
       try:
         s3 = boto3.client('s3', region_name=region)
-        data = s3.get_object(Bucket=RESULT_BUCKET, Key=annot_file)
-        archive_file = data['Body'].read()
+        archive_files = [s3.get_object(Bucket=RESULT_BUCKET, Key=key)['Body'].read()
+          for key, _ in keys]
       except ClientError as e:
-        print('Cannot read result file from s3')
+        print('Cannot read result files from s3')
         # Delete message  
         print('Deleting the archival message')
         try:
@@ -121,25 +140,27 @@ def handle_archive_queue(sqs=None):
       # https://docs.aws.amazon.com/code-samples/latest/catalog/python-glacier-upload_archive.py.html
       try:
         glacier = boto3.client('glacier', region_name = region)
-        archive = glacier.upload_archive(vaultName=VAULT_NAME, body=archive_file)
+        archive_ids = [glacier.upload_archive(vaultName=VAULT_NAME,
+          body=archive_file)['archiveId'] for archive_file in archive_files]
       except ClientError as e:
         sys.exit(1)
       print("Deleting data from S3")
       try:
-        s3.delete_object(Bucket=RESULT_BUCKET, Key=annot_file)
+        for key, _ in keys:
+          s3.delete_object(Bucket=RESULT_BUCKET, Key=key)
       except ClientError as e:
         sys.exit(1)
 
-      print("Putting archive ID to DynamoDB")
+      print("Putting archive IDs to DynamoDB")
       try:
-        dynamodb = boto3.resource('dynamodb', region_name=region)
-        ann_table = dynamodb.Table(TABLE_NAME)
+        names = [archive_name for _, archive_name in keys]
         response = ann_table.update_item(
           Key={'job_id': job_id},
-          UpdateExpression="SET results_file_archive_id = :archive_id",
-          ExpressionAttributeValues={':archive_id': archive['archiveId']})
+          UpdateExpression="SET " + ", ".join(f"{name} = :{name}" for name in names),
+          ExpressionAttributeValues={f':{name}': archive_id
+            for name, archive_id in zip(names, archive_ids)})
       except ClientError as e:
-        print("Cannot put archive ID to DynamoDB ", e)
+        print("Cannot put archive IDs to DynamoDB ", e)
         sys.exit(1)
 
       # Delete message  
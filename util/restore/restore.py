@@ -47,8 +47,10 @@ def lambda_handler(event, context):
     except KeyError as e:
         print(e)
         raise e
+    # the results file, or its index or columnar export archived with it
+    key_name = metadata.get('s3_key', 's3_key_result_file')
 
-    print("Extracting user_id and s3_key_result_file from dynamodb")
+    print(f"Extracting user_id and {key_name} from dynamodb")
     try:
         dynamodb = boto3.resource('dynamodb', region_name=REGION_NAME)
         ann_table = dynamodb.Table(DYNAMODB_TABLE)
@@ -58,7 +60,7 @@ def lambda_handler(event, context):
     try:
         item = response['Item']
         user_id = item['user_id']
-        s3_key_result_file = item['s3_key_result_file']
+        s3_key = item[key_name]
     except KeyError as e:
         raise e
 
@@ -68,7 +70,7 @@ def lambda_handler(event, context):
         response = s3.put_object(
                             Body = data,
                             Bucket = RESULT_BUCKET,
-                            Key = s3_key_result_file)
+                            Key = s3_key)
     except ClientError as e:
         print(e)
         raise e
@@ -80,6 +82,11 @@ def lambda_handler(event, context):
         print(e)
         raise e
 
+    # the job is restored once its results file is
+    if (key_name != 's3_key_result_file'):
+        print("Lambda function successfully completed")
+        return
+
     print("Updating glacier job status in dynamodb")    
     try:
         response = ann_table.update_item(
@@ -24,6 +24,11 @@ REGION_NAME = config['aws']['AwsRegionName']
 TABLE_NAME = config['dynamodb']['table_name']
 VAULT_NAME = config['glacier']['vault_name']
 
+# Files archived with the results file, if the job wrote them: the DynamoDB
+# attribute of the S3 key of each and the one of its Glacier archive ID
+SIDE_FILES = [('s3_key_index_file', 'index_file_archive_id'),
+  ('s3_key_columnar_file', 'columnar_file_archive_id')]
+
 '''Capstone - Exercise 9
 Initiate thawing of archived objects from Glacier
 '''
@@ -66,28 +71,39 @@ def handle_thaw_queue(sqs=None):
           return
         continue
 
+      # The restore Lambda puts each archive back under the S3 key named by
+      # the attribute in its description
+      archives = [('s3_key_result_file', archive_id)]
+      archives.extend((key_name, msg_body[archive_name])
+        for key_name, archive_name in SIDE_FILES if archive_name in msg_body)
+
       # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier.html#Glacier.Client.initiate_job
       print(f"Initiating archive retrieval for {job_id}")
-      job_params = {"Type": "archive-retrieval", 
-                    "ArchiveId": archive_id,
-                    "Description": json.dumps({"job_id": job_id}),
-                    "SNSTopic": config['sns']['results_restore_topic'],
-                    "Tier": "Expedited"}
-      try:
-        response = glacier.initiate_job(
-                        vaultName=VAULT_NAME, 
-                        jobParameters=job_params)
-      except glacier.exceptions.InsufficientCapacityException as e:
-        print("Expedited retrieval didn't work with error:", e)
-        print("Attempting standard retrieval")
+      initiated = True
+      for key_name, archive_id in archives:
+        job_params = {"Type": "archive-retrieval", 
+                      "ArchiveId": archive_id,
+                      "Description": json.dumps({"job_id": job_id,
+                        "s3_key": key_name}),
+                      "SNSTopic": config['sns']['results_restore_topic'],
+                      "Tier": "Expedited"}
         try:
-          job_params["Tier"] = "Standard"
           response = glacier.initiate_job(
                           vaultName=VAULT_NAME, 
                           jobParameters=job_params)
-        except Exception as e:
-          print("Exception occured:", e)
-          continue
+        except glacier.exceptions.InsufficientCapacityException as e:
+          print("Expedited retrieval didn't work with error:", e)
+          print("Attempting standard retrieval")
+          try:
+            job_params["Tier"] = "Standard"
+            response = glacier.initiate_job(
+                            vaultName=VAULT_NAME, 
+                            jobParameters=job_params)
+          except Exception as e:
+            print("Exception occured:", e)
+            initiated = False
+      if not initiated:
+        continue
 
       print("Deleting message")
       # Delete message
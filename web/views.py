@@ -280,6 +280,12 @@ def retrieve_data_from_glacier():
               'job_id': item['job_id'],
               's3_key_result_file': item['s3_key_result_file'],
               'results_file_archive_id': item['results_file_archive_id']}
+      # the result index and columnar export are archived with the results
+      for key_name, archive_name in (('s3_key_index_file', 'index_file_archive_id'),
+          ('s3_key_columnar_file', 'columnar_file_archive_id')):
+        if archive_name in item.keys():
+          data[key_name] = item[key_name]
+          data[archive_name] = item[archive_name]
       print(f"Found new item to be retrieved, archive file with job_id: {item['job_id']}")
       print("Adding glacier job status to dynamodb")    
       try: